@@ -0,0 +1,71 @@
+# coding: utf8
+"""Memory benchmark: DebianTree.build() building the Packages files in memory
+vs streaming them (max_memory), for growing numbers of packages.
+
+The memory used by the package index itself is not counted
+(only what is allocated while building).
+
+Usage: python -m benchmarks.build [count]
+"""
+
+import email
+import pathlib
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mothman import record, tree
+
+from benchmarks.records import _control, _fileinfo
+
+# stanza cache budget for the streaming build.
+MAX_MEMORY = 1 << 20
+
+
+def make_tree(root, count):
+    (root / "Release").write_text("Origin: benchmark\n")
+    debian_tree = tree.DebianTree(root, scan_cache=False)
+
+    for i in range(count):
+        info = _fileinfo(i)
+        size = info.pop("filesize")
+        debian_tree._insert(
+            record.PackageRecord(
+                str(root / f"package{i}.deb"),
+                tuple(email.message_from_string(_control(i)).items()),
+                tuple((h, bytes.fromhex(info[h])) for h in debian_tree.digests),
+                size,
+            )
+        )
+
+    debian_tree._tree.names()
+    return debian_tree
+
+
+def measure(count, max_memory):
+    with tempfile.TemporaryDirectory() as tempdir:
+        debian_tree = make_tree(pathlib.Path(tempdir), count)
+
+        tracemalloc.start()
+        start = time.perf_counter()
+        debian_tree.build(compress_using=[tree.CAT, tree.GZIP], max_memory=max_memory)
+        seconds = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return peak, seconds
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    for n in (count // 4, count // 2, count):
+        print(f"per {n} packages:")
+        for name, max_memory in (("in memory", None), ("streamed", MAX_MEMORY)):
+            peak, seconds = measure(n, max_memory)
+            print(f"  {name:<12} {peak / 1024 / 1024:8.2f} MiB peak {seconds:6.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# coding: utf8
+"""Import-time benchmark for the CLI entry point (what every 'mothman build' pays for).
+Exits with a non-zero status if the budget is exceeded, or if modules only some
+commands need (HTTP, PGP, etc.) are imported at startup, so it can be run in CI.
+
+Usage: python -m benchmarks.importtime [budget in ms, default 80]
+"""
+
+import re
+import subprocess
+import sys
+
+# modules that must not be imported just to start the CLI.
+FORBIDDEN = (
+    "requests",
+    "urllib3",
+    "http.server",
+    "socketserver",
+    "pgpy",
+    "arpy",
+    "tarfile",
+    "mothman.mirror",
+    "mothman.templates",
+)
+
+RE_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$")
+
+
+def importtime(module="mothman.cli"):
+    """Return a list of (module, self us, cumulative us, depth) imported by module."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    imports = []
+    started = False
+
+    for line in proc.stderr.splitlines():
+        match = RE_LINE.match(line)
+        if match is None:
+            continue
+
+        self_us, cumulative_us, indent, name = match.groups()
+        # skip anything imported at interpreter startup (site, etc.)
+        if not started and not name.startswith("mothman"):
+            continue
+        started = True
+
+        imports.append((name, int(self_us), int(cumulative_us), len(indent) // 2))
+
+    return imports
+
+
+def main():
+    budget_ms = float(sys.argv[1]) if len(sys.argv) > 1 else 80
+
+    imports = importtime()
+    total_ms = sum(cumulative for _, _, cumulative, depth in imports if depth == 0) / 1000
+
+    print("slowest imports (cumulative):")
+    for name, _, cumulative, _ in sorted(imports, key=lambda i: i[2], reverse=True)[:10]:
+        print(f"  {cumulative / 1000:8.2f} ms  {name}")
+
+    print(f"total: {total_ms:.2f} ms (budget {budget_ms:.2f} ms)")
+
+    failed = False
+
+    forbidden = sorted({name for name, *_ in imports if name in FORBIDDEN})
+    if forbidden:
+        print(f"FAIL: imported at startup: {', '.join(forbidden)}")
+        failed = True
+
+    if total_ms > budget_ms:
+        print("FAIL: over budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+# coding: utf8
+"""Memory benchmark: pydpkg.Dpkg objects in a nested defaultdict (the old DebianTree._tree)
+vs PackageRecords in a PackageIndex.
+
+Usage: python -m benchmarks.records [count]
+"""
+
+import email
+import hashlib
+import sys
+import tracemalloc
+from collections import defaultdict
+
+from mothman import pydpkg, record
+
+CONTROL = """Package: com.example.package{i}
+Version: 1.{i}.0-1
+Architecture: iphoneos-arm
+Name: Example Package {i}
+Author: Example Author <author@example.com>
+Maintainer: Example Author <author@example.com>
+Section: Tweaks
+Depends: firmware (>= 12.0), mobilesubstrate
+Description: An example package for benchmarking.
+"""
+
+
+def _control(i):
+    return CONTROL.format(i=i)
+
+
+def _fileinfo(i):
+    data = str(i).encode()
+    info = {h: getattr(hashlib, h)(data).hexdigest() for h in ("md5", "sha1", "sha256")}
+    info["filesize"] = 1000 + i
+    return info
+
+
+def old_tree(count):
+    tree = defaultdict(lambda: defaultdict(dict))
+    for i in range(count):
+        # Dpkg only checks that the file exists, so point it at this script.
+        debinfo = pydpkg.Dpkg(__file__)
+        debinfo._message = email.message_from_string(_control(i))
+        debinfo._control_str = debinfo._message.as_string()
+        debinfo._headers = dict(debinfo._message.items())
+        debinfo._fileinfo = _fileinfo(i)
+        tree[debinfo.Package][debinfo.Version][debinfo.Architecture] = debinfo
+    return tree
+
+
+def new_tree(count):
+    index = record.PackageIndex()
+    for i in range(count):
+        info = _fileinfo(i)
+        size = info.pop("filesize")
+        index.add(
+            record.PackageRecord(
+                __file__,
+                tuple(email.message_from_string(_control(i)).items()),
+                tuple((k, bytes.fromhex(v)) for k, v in info.items()),
+                size,
+            )
+        )
+    # include the cost of the sorted order.
+    index.names()
+    return index
+
+
+def measure(func, count):
+    tracemalloc.start()
+    result = func(count)  # noqa: F841
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return current, peak
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+    print(f"per {count} packages:")
+    for name, func in (
+        ("Dpkg + defaultdict", old_tree),
+        ("PackageRecord + PackageIndex", new_tree),
+    ):
+        current, peak = (n / 1024 / 1024 for n in measure(func, count))
+        print(f"{name:<30} {peak:8.2f} MiB peak {current:8.2f} MiB retained")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+# coding: utf8
+"""Extract files bundled in packages (i.e the icon in 'Icon: file:///...',
+or screenshots given as file:// URLs in the metadata) so depictions can use them.
+
+Only the data archive (data.tar.{gz,xz,bz2,lzma}) is read, as a stream,
+and reading stops as soon as all the wanted files are found.
+Extracted files are cached by the SHA256 of the package file
+(in the user-level cache dir), so each package version is only decompressed once.
+"""
+
+import concurrent.futures
+import hashlib
+import json
+import logging
+import pathlib
+import posixpath
+import tarfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["AssetCache", "AssetError", "extract", "extract_all", "referenced", "rewrite"]
+
+_log = logging.getLogger("mothman")
+
+# where extracted files are cached (relative to the user cache dir).
+ASSETS_NAME = "assets"
+# the name of the index of a package's extracted files (in its cache folder).
+INDEX_NAME = "index.json"
+# files bigger than this are not extracted.
+MAX_SIZE = 16 << 20
+
+FILE_SCHEME = "file://"
+# metadata keys (see mothman.depictions.Generic) that can refer to bundled files.
+META_KEYS = ("header_image", "screenshots")
+
+# member paths (absolute, i.e '/Library/icon.png') to the paths of the extracted files
+# (None if the file is not in the package).
+Assets = Dict[str, Optional[pathlib.Path]]
+
+
+class AssetError(Exception):
+    pass
+
+
+def _member_path(url: str) -> str:
+    return posixpath.normpath("/" + url[len(FILE_SCHEME) :].lstrip("/"))
+
+
+def _tar_path(name: str) -> str:
+    # the absolute path of a member of a data archive ('./Library/x.png' -> '/Library/x.png').
+    # (only a literal './' prefix is removed, so './.hidden/x' stays hidden)
+    if name.startswith("./"):
+        name = name[2:]
+    return posixpath.normpath("/" + name.lstrip("/"))
+
+
+def referenced(control: dict, other_info: Optional[dict] = None) -> List[str]:
+    """Get the files a package refers to in its control fields (Icon)
+    and metadata (header_image and screenshots, if they are file:// URLs).
+
+    Args:
+        control: The control fields of the package.
+        other_info: The metadata of the package (see mothman.meta). Defaults to None.
+
+    Returns:
+        The paths of the files in the package (absolute, i.e '/Library/icon.png').
+    """
+
+    urls = [control.get("Icon") or ""]
+
+    for key in META_KEYS:
+        value = (other_info or {}).get(key)
+        if isinstance(value, str):
+            urls.append(value)
+        elif isinstance(value, list):
+            urls.extend(v for v in value if isinstance(v, str))
+
+    paths = []
+    for url in urls:
+        if url.startswith(FILE_SCHEME):
+            path = _member_path(url)
+            if path not in paths:
+                paths.append(path)
+
+    return paths
+
+
+def extract(deb: Path, paths: Iterable[str]) -> Dict[str, bytes]:
+    """Extract files from the data archive of a package.
+
+    Args:
+        deb: The path to the package file.
+        paths: The paths of the files (absolute, i.e '/Library/icon.png').
+
+    Returns:
+        A dict of the paths that were found to their content.
+
+    Raises:
+        AssetError, if the package has no (supported) data archive.
+    """
+
+    from arpy import Archive  # type: ignore
+
+    wanted = set(paths)
+    found: Dict[str, bytes] = {}
+
+    with Archive(str(deb)) as archive:
+        archive.read_all_headers()
+
+        member = next(
+            (f for name, f in archive.archived_files.items() if name.startswith(b"data.tar")),
+            None,
+        )
+        if member is None:
+            raise AssetError(f"no data archive in {deb}")
+
+        try:
+            # a stream, so nothing after the last wanted file is decompressed.
+            with tarfile.open(fileobj=member, mode="r|*") as tar:
+                for info in tar:
+                    path = _tar_path(info.name)
+                    if path not in wanted:
+                        continue
+
+                    wanted.discard(path)
+
+                    if not info.isfile():
+                        _log.debug("[%s] %s is not a regular file", pathlib.Path(deb).name, path)
+                    elif info.size > MAX_SIZE:
+                        _log.warning("[%s] %s is too big to extract", pathlib.Path(deb).name, path)
+                    else:
+                        found[path] = tar.extractfile(info).read()  # type: ignore
+
+                    if not wanted:
+                        break
+        except tarfile.TarError as e:
+            raise AssetError(f"can't read the data archive in {deb}: {e}") from e
+
+    return found
+
+
+class AssetCache:
+    """A cache of files extracted from packages, keyed by the SHA256 of the package file.
+    Files that are not in a package are remembered too, so they aren't looked for again.
+
+    Args:
+        path: The folder to keep the cache in.
+            If None, the 'assets' folder in the user cache dir is used. Defaults to None.
+
+    Attributes:
+        path (pathlib.Path): See Args.
+    """
+
+    def __init__(self, path: Optional[Path] = None):
+        self.path = utils.user_cache_dir() / ASSETS_NAME if path is None else pathlib.Path(path)
+
+    def _folder(self, sha256: str) -> pathlib.Path:
+        return self.path / sha256[:2] / sha256
+
+    def _index(self, sha256: str) -> Dict[str, Optional[str]]:
+        try:
+            with (self._folder(sha256) / INDEX_NAME).open() as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def get(self, sha256: str, paths: Iterable[str]) -> Optional[Assets]:
+        """Get the extracted files of a package.
+
+        Args:
+            sha256: The SHA256 hex digest of the package file.
+            paths: The paths of the files in the package.
+
+        Returns:
+            The extracted files (see Assets),
+            or None if any of the files were not looked for yet.
+        """
+
+        index = self._index(sha256)
+        folder = self._folder(sha256)
+        assets: Assets = {}
+
+        for path in paths:
+            if path not in index:
+                return None
+
+            name = index[path]
+            assets[path] = None if name is None else folder / name
+
+        return assets
+
+    def put(self, sha256: str, paths: Iterable[str], found: Dict[str, bytes]) -> Assets:
+        """Add the extracted files of a package.
+
+        Args:
+            sha256: The SHA256 hex digest of the package file.
+            paths: The paths of the files that were looked for.
+            found: The files that were found (see extract()).
+
+        Returns:
+            The extracted files (see Assets).
+        """
+
+        folder = self._folder(sha256)
+        folder.mkdir(parents=True, exist_ok=True)
+
+        index = self._index(sha256)
+        assets: Assets = {}
+
+        for path in paths:
+            if path not in found:
+                index[path] = None
+                assets[path] = None
+                continue
+
+            # named by the hash of the path, with the original extension.
+            name = hashlib.sha256(path.encode("utf8")).hexdigest()[:16] + posixpath.splitext(path)[1]
+            with utils.open_atomic(folder / name, "wb") as f:
+                f.write(found[path])
+
+            index[path] = name
+            assets[path] = folder / name
+
+        with utils.open_atomic(folder / INDEX_NAME) as f:
+            json.dump(index, f, sort_keys=True)
+
+        return assets
+
+
+def _extract(deb: pathlib.Path, sha256: Optional[str], paths: List[str], cache: AssetCache):
+    if sha256 is None:
+        sha256 = utils.fileinfo(deb, hashes=("sha256",))["sha256"]
+
+    assets = cache.get(sha256, paths)
+    if assets is not None:
+        return assets
+
+    _log.debug("[%s] extracting %s", deb.name, ", ".join(paths))
+    try:
+        found = extract(deb, paths)
+    except AssetError as e:
+        _log.warning("[%s] %s", deb.name, e)
+        found = {}
+
+    return cache.put(sha256, paths, found)
+
+
+def extract_all(
+    debs: Iterable[Tuple[Path, Optional[str], List[str]]],
+    pool: concurrent.futures.Executor,
+    cache: Optional[AssetCache] = None,
+) -> Dict[str, Assets]:
+    """Extract files from many packages in parallel (from the cache if possible).
+
+    Args:
+        debs: Tuples of (path to the package file, its SHA256 hex digest or None,
+            paths of the files to extract).
+        pool: The executor to extract in.
+        cache: The cache to use. If None, the user-level cache is used. Defaults to None.
+
+    Returns:
+        A dict of the paths to the package files (as strings) to their extracted files.
+    """
+
+    cache = AssetCache() if cache is None else cache
+
+    futures = {
+        str(deb): pool.submit(_extract, pathlib.Path(deb), sha256, paths, cache)
+        for deb, sha256, paths in debs
+        if paths
+    }
+
+    return {deb: future.result() for deb, future in futures.items()}
+
+
+def rewrite(control: dict, other_info: dict, urls: Dict[str, str]) -> dict:
+    """Replace the file:// URLs in a package's metadata with the URLs of the extracted files,
+    and add the URL of the icon (as 'icon').
+
+    Args:
+        control: The control fields of the package.
+        other_info: The metadata of the package.
+        urls: A dict of paths of files in the package to their URLs.
+
+    Returns:
+        The new metadata (other_info is not changed).
+    """
+
+    def _url(value):
+        if isinstance(value, str) and value.startswith(FILE_SCHEME):
+            return urls.get(_member_path(value), value)
+        return value
+
+    other_info = dict(other_info)
+
+    for key in META_KEYS:
+        value = other_info.get(key)
+        if isinstance(value, list):
+            other_info[key] = [_url(v) for v in value]
+        elif value is not None:
+            other_info[key] = _url(value)
+
+    icon = _url(control.get("Icon"))
+    if icon is not None and not icon.startswith(FILE_SCHEME) and "icon" not in other_info:
+        other_info["icon"] = icon
+
+    return other_info
@@ -0,0 +1,184 @@
+# coding: utf8
+"""Build many repos at once (i.e variants of a repo that share most of their packages),
+sharing one worker pool and one scan cache between them.
+"""
+
+import concurrent.futures
+import json
+import logging
+import os
+import pathlib
+import time
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mothman import cache, pydpkg, repo, utils
+from mothman.utils import Path
+
+__all__ = ["build_all", "prescan"]
+
+_log = logging.getLogger("mothman")
+
+# a package file and its stat() result.
+_File = Tuple[pathlib.Path, os.stat_result]
+
+
+def _hash(file: _File, hashes: Iterable[str]) -> Tuple[_File, Optional[dict]]:
+    try:
+        info = utils.fileinfo(file[0], hashes=hashes)
+    except OSError as e:
+        _log.warning("[%s] failed to hash: %s", file[0].name, e)
+        return file, None
+
+    del info["filesize"]
+    return file, info
+
+
+def _parse(file: _File) -> Tuple[_File, Optional[tuple]]:
+    try:
+        return file, tuple(pydpkg.Dpkg(file[0]).message.items())
+    except Exception as e:
+        # the repo's own build reports this properly.
+        _log.warning("[%s] failed to parse: %s", file[0].name, e)
+        return file, None
+
+
+def _load_template(root: Path) -> dict:
+    with (pathlib.Path(root) / repo.CONFIG_NAME).open() as f:
+        return json.load(f)
+
+
+def prescan(
+    roots: Iterable[Path],
+    scan_cache: cache.SharedScanCache,
+    pool: concurrent.futures.Executor,
+    digests: Iterable[str] = utils.FILEINFO_HASHES,
+    debtype: str = "deb",
+) -> int:
+    """Scan the package files of many repos into a shared scan cache, in parallel.
+    Each file (by inode) is hashed only once, and each distinct file content
+    is parsed only once, no matter how many repos it is in.
+
+    Args:
+        roots: The roots of the repos.
+        scan_cache: The shared scan cache.
+        pool: The executor to hash/parse files in.
+        digests: The hashes to compute. sha256 is always computed.
+        debtype: The type of the packages to scan for (see mothman.tree.DebianTree).
+            Defaults to 'deb'.
+
+    Returns:
+        The number of files that were scanned (not already in the cache).
+    """
+
+    hashes = sorted({*utils.check_hashes(digests), "sha256"})
+
+    # files that aren't in the cache yet, by (device, inode)
+    files: Dict[Tuple[int, int], _File] = {}
+
+    for root in roots:
+        deb_path = pathlib.Path(root) / _load_template(root)["deb_path"]
+        # (the same files DebianTree.add_debs() finds)
+        for debfile in sorted(deb_path.glob(f"*.{debtype}")):
+            stat = debfile.stat()
+            cached = scan_cache.get(debfile, stat)
+
+            if cached is None or any(h not in cached[1] for h in hashes):
+                files.setdefault((stat.st_dev, stat.st_ino), (debfile, stat))
+
+    if not files:
+        return 0
+
+    _log.info("scanning %s new/changed package file(s)", len(files))
+
+    by_content: Dict[str, List[Tuple[_File, dict]]] = defaultdict(list)
+    for file, info in pool.map(lambda f: _hash(f, hashes), files.values()):
+        if info is not None:
+            by_content[info["sha256"]].append((file, info))
+
+    # only parse one copy of each content that was never seen before.
+    fields = {}
+    new: List[Tuple[str, _File]] = []
+    for sha256, copies in by_content.items():
+        cached = scan_cache.get_content(sha256)
+        if cached is not None:
+            fields[sha256] = cached[0]
+        else:
+            new.append((sha256, copies[0][0]))
+
+    parsed = pool.map(_parse, [file for _, file in new])
+    for (sha256, _), (_, package_fields) in zip(new, parsed):
+        if package_fields is not None:
+            fields[sha256] = package_fields
+
+    for sha256, copies in by_content.items():
+        if sha256 not in fields:
+            continue
+
+        for (debfile, stat), info in copies:
+            scan_cache.put(debfile, stat, fields[sha256], info)
+
+    return len(files)
+
+
+def build_all(
+    repos: Dict[Path, str],
+    workers: Optional[int] = None,
+    scan_cache: Optional[cache.SharedScanCache] = None,
+    build_kwargs: Optional[dict] = None,
+    **kwargs,
+) -> Dict[str, Optional[Exception]]:
+    """Build many repos in one process.
+
+    All package files are scanned first (in parallel, see prescan()), then each repo
+    is built in turn, rendering its depictions in the same worker pool.
+
+    Args:
+        repos: A dict of repo roots to their hosts (see mothman.repo.Repository).
+        workers: The number of worker threads.
+            If None, the default of concurrent.futures.ThreadPoolExecutor is used.
+            Defaults to None.
+        scan_cache: The scan cache to share between the repos.
+            If None, the user-level shared cache is used (see cache.SharedScanCache).
+            Defaults to None.
+        build_kwargs: Passed to Repository.build(). Defaults to None.
+        **kwargs: Passed to Repository.
+
+    Returns:
+        A dict of repo roots to the error raised while building them
+        (None if the repo was built successfully).
+    """
+
+    shared = cache.SharedScanCache() if scan_cache is None else scan_cache
+    results: Dict[str, Optional[Exception]] = {}
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        start = time.perf_counter()
+        # scan for the hashes of every repo at once.
+        digests = set(kwargs.get("digests", ()))
+        if not digests:
+            for root in repos:
+                digests.update(_load_template(root).get("digests", utils.FILEINFO_HASHES))
+
+        scanned = prescan(repos, shared, pool, digests, kwargs.get("debtype", "deb"))
+        _log.info(
+            "scanned %s package file(s) in %.2fs", scanned, time.perf_counter() - start
+        )
+
+        for root, host in repos.items():
+            _log.info("[%s] building", root)
+            try:
+                repository = repo.Repository(
+                    host, root, scan_cache=shared, executor=pool, **kwargs
+                )
+                repository.build(**(build_kwargs or {}))
+            except Exception as e:
+                _log.error("[%s] failed to build: %s", root, e)
+                results[str(root)] = e
+            else:
+                results[str(root)] = None
+
+    shared.prune()
+    shared.save()
+
+    return results
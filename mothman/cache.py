@@ -0,0 +1,222 @@
+# coding: utf8
+"""A persistent cache of scanned package files (control fields and digests),
+so unchanged packages don't have to be parsed and hashed again on every build.
+"""
+
+import json
+import logging
+import os
+import pathlib
+from typing import Dict, List, Optional, Tuple
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["ScanCache", "SharedScanCache"]
+
+_log = logging.getLogger("mothman")
+
+# Where the scan cache is kept (relative to the repo root).
+CACHE_PATH = ".mothman/scan.json"
+# Where the shared scan cache is kept (relative to the user cache dir).
+SHARED_CACHE_NAME = "scan.json"
+
+# bump this if the format of the cache changes.
+CACHE_VERSION = 1
+
+Fields = Tuple[Tuple[str, str], ...]
+
+
+class ScanCache:
+    """A cache of scanned package files, keyed by path.
+    An entry is only valid as long as the file's size and mtime don't change.
+    Digests are stored per hash, so if the set of hashes changes,
+    only the missing hashes need to be computed.
+
+    Args:
+        path: The path to the cache file. If it does not exist, the cache starts out empty.
+
+    Attributes:
+        path (pathlib.Path): See Args.
+        content_addressed (bool): Whether or not entries can be looked up by
+            the SHA256 digest of the file (see get_content()).
+    """
+
+    content_addressed = False
+
+    def __init__(self, path: Path):
+        self.path = pathlib.Path(path)
+        self._entries: Dict[str, dict] = {}
+        self._dirty = False
+
+        try:
+            with self.path.open() as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            _log.warning("[%s] scan cache is corrupt, ignoring", self.path)
+            return
+
+        if data.get("version") == CACHE_VERSION:
+            self._entries = data["entries"]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _key(self, file: Path, stat: os.stat_result) -> str:
+        return str(pathlib.Path(file).resolve())
+
+    def get(
+        self, file: Path, stat: os.stat_result
+    ) -> Optional[Tuple[Fields, Dict[str, str]]]:
+        """Get the cached (control fields, hex digests) of a package file.
+
+        Args:
+            file: The path to the package file.
+            stat: The stat() result of the file.
+
+        Returns:
+            The cached info, or None if there is no valid entry for the file.
+        """
+
+        entry = self._entries.get(self._key(file, stat))
+
+        if entry is None or (entry["size"], entry["mtime"]) != (
+            stat.st_size,
+            stat.st_mtime_ns,
+        ):
+            return None
+
+        return tuple(tuple(f) for f in entry["fields"]), dict(entry["digests"])  # type: ignore
+
+    def put(
+        self, file: Path, stat: os.stat_result, fields: Fields, digests: Dict[str, str]
+    ):
+        """Cache the control fields and hex digests of a package file.
+
+        Args:
+            file: The path to the package file.
+            stat: The stat() result of the file (when it was scanned).
+            fields: The control fields as (name, value) pairs.
+            digests: A dict of hash names to hex digests.
+        """
+
+        self._entries[self._key(file, stat)] = {
+            "size": stat.st_size,
+            "mtime": stat.st_mtime_ns,
+            "fields": [list(f) for f in fields],
+            "digests": digests,
+        }
+        self._dirty = True
+
+    def prune(self) -> List[str]:
+        """Remove entries of files that no longer exist.
+
+        Returns:
+            The paths of the removed entries.
+        """
+
+        removed = [k for k in self._entries if not self._exists(k)]
+        for key in removed:
+            del self._entries[key]
+
+        if removed:
+            self._dirty = True
+
+        return removed
+
+    def _exists(self, key: str) -> bool:
+        return os.path.exists(key)
+
+    def get_content(self, sha256: str) -> Optional[Tuple[Fields, Dict[str, str]]]:
+        """Get the cached (control fields, hex digests) of any file with the given
+        content. Only supported if content_addressed is True.
+
+        Args:
+            sha256: The SHA256 hex digest of the file.
+
+        Returns:
+            The cached info, or None if no file with that content was scanned.
+        """
+
+        return None
+
+    def save(self):
+        """Write the cache to disk (only if it has changed)."""
+
+        if not self._dirty:
+            return
+
+        _log.debug("[%s] saving scan cache (%s entries)", self.path, len(self))
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        with utils.open_atomic(self.path) as f:
+            json.dump({"version": CACHE_VERSION, "entries": self._entries}, f)
+
+        self._dirty = False
+
+
+class SharedScanCache(ScanCache):
+    """A scan cache shared by many repos (by default in the user cache dir).
+
+    Entries are keyed by device and inode (instead of path), so hardlinked copies
+    of a package in different repos share an entry. Entries can also be looked up
+    by content (SHA256), so plain copies only need to be hashed, not parsed.
+
+    Args:
+        path: The path to the cache file.
+            If None, it is kept in the user cache dir (see mothman.utils.user_cache_dir).
+    """
+
+    content_addressed = True
+
+    def __init__(self, path: Optional[Path] = None):
+        super().__init__(utils.user_cache_dir() / SHARED_CACHE_NAME if path is None else path)
+
+        # sha256 -> key
+        self._content: Dict[str, str] = {
+            entry["digests"]["sha256"]: key
+            for key, entry in self._entries.items()
+            if "sha256" in entry["digests"]
+        }
+
+    def _key(self, file: Path, stat: os.stat_result) -> str:
+        return f"{stat.st_dev}:{stat.st_ino}"
+
+    def _exists(self, key: str) -> bool:
+        # the file the entry was made from must still be there (and be the same file).
+        try:
+            stat = os.stat(self._entries[key]["path"])
+        except OSError:
+            return False
+
+        return self._key("", stat) == key
+
+    def put(
+        self, file: Path, stat: os.stat_result, fields: Fields, digests: Dict[str, str]
+    ):
+        super().put(file, stat, fields, digests)
+
+        key = self._key(file, stat)
+        self._entries[key]["path"] = str(pathlib.Path(file).resolve())
+
+        if "sha256" in digests:
+            self._content[digests["sha256"]] = key
+
+    def get_content(self, sha256: str) -> Optional[Tuple[Fields, Dict[str, str]]]:
+        entry = self._entries.get(self._content.get(sha256, ""))
+
+        if entry is None or entry["digests"].get("sha256") != sha256:
+            return None
+
+        return tuple(tuple(f) for f in entry["fields"]), dict(entry["digests"])  # type: ignore
+
+    def prune(self) -> List[str]:
+        removed = super().prune()
+
+        self._content = {
+            sha256: key for sha256, key in self._content.items() if key in self._entries
+        }
+
+        return removed
@@ -0,0 +1,318 @@
+# coding: utf8
+"""Check that every package in a repo can be installed (all dependencies resolve),
+and find dependency cycles.
+"""
+
+import fnmatch
+import logging
+import operator
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from mothman.index import Relation, fold_name, parse_relations
+from mothman.record import Key, PackageRecord, version_key
+
+__all__ = ["Checker", "EXTERNAL"]
+
+_log = logging.getLogger("mothman")
+
+# packages that are provided by the device/package manager, not by repos.
+# they can't be looked up in the repo, but a package's constraints on one of them
+# (i.e 'firmware (>= 14.0), firmware (<< 13.0)') must still be satisfiable together.
+EXTERNAL = ("firmware", "cy+*", "gsc.*")
+
+# relation operators ('<' and '>' are deprecated aliases of '<=' and '>=').
+OPERATORS: Dict[str, Callable] = {
+    "<<": operator.lt,
+    "<=": operator.le,
+    "<": operator.le,
+    "=": operator.eq,
+    ">=": operator.ge,
+    ">": operator.ge,
+    ">>": operator.gt,
+}
+
+# fields that must be satisfied for a package to be installable.
+DEPENDS_FIELDS = ("Pre-Depends", "Depends")
+
+# operators that set a lower/upper bound on a version, and whether the bound is inclusive.
+LOWER_BOUNDS = {">=": True, ">": True, ">>": False, "=": True}
+UPPER_BOUNDS = {"<=": True, "<": True, "<<": False, "=": True}
+
+
+class Checker:
+    """A dependency checker over a set of package records.
+
+    Satisfiability of each relation (package, operator, version) is computed once,
+    and installability is found by propagating failures backwards through the
+    dependency graph (so dependency cycles don't make packages uninstallable by themselves).
+
+    Args:
+        records: The package records to check.
+        external: Glob patterns of package names provided outside of the repo
+            (i.e by the device). They are not looked up in the repo, but a package is
+            uninstallable if its version constraints on one of them can't all be met.
+            Defaults to EXTERNAL.
+    """
+
+    def __init__(self, records: Iterable[PackageRecord], external: Iterable[str] = EXTERNAL):
+        self._records: Dict[Key, PackageRecord] = {r.key: r for r in records}
+        # (matched against folded names, see mothman.index.fold_name)
+        self._external = tuple(fold_name(pattern) for pattern in external)
+
+        # folded name -> [(provided version or None, key of the record providing it)]
+        self._candidates: Dict[str, List[Tuple[Optional[str], Key]]] = defaultdict(list)
+
+        for key, package_record in self._records.items():
+            self._candidates[fold_name(key[0])].append((key[1], key))
+
+            for group in parse_relations(package_record.get("Provides")):
+                for name, op, version in group:
+                    self._candidates[name].append((version if op == "=" else None, key))
+
+        self._satisfying: Dict[Relation, Optional[Set[Key]]] = {}
+        self._groups: Dict[Key, List[List[Relation]]] = {
+            key: [
+                group
+                for field in DEPENDS_FIELDS
+                for group in parse_relations(r.get(field))
+            ]
+            for key, r in self._records.items()
+        }
+
+    def _is_external(self, name: str) -> bool:
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self._external)
+
+    def external_conflicts(self, key: Key) -> List[str]:
+        """Find a package's constraints on external packages that can't all be met at once.
+        Only dependencies without alternatives are considered.
+
+        Args:
+            key: The key of the package's record.
+
+        Returns:
+            The conflicting constraints (as strings, i.e 'firmware (>= 14.0), firmware (<< 13.0)'),
+            one per external package.
+        """
+
+        constraints: Dict[str, List[Relation]] = defaultdict(list)
+        for group in self._groups[key]:
+            # (unversioned relations have an empty operator)
+            if len(group) == 1 and group[0][1] and self._is_external(group[0][0]):
+                constraints[group[0][0]].append(group[0])
+
+        return [
+            ", ".join(_format_group([relation]) for relation in relations)
+            for relations in constraints.values()
+            if not _satisfiable(relations)
+        ]
+
+    def satisfying(self, relation: Relation) -> Optional[Set[Key]]:
+        """Get the keys of records that satisfy a relation (memoized).
+
+        Args:
+            relation: A (name, operator, version) tuple, see mothman.index.parse_relations.
+
+        Returns:
+            The set of keys, or None if the relation is external (always satisfied).
+        """
+
+        try:
+            return self._satisfying[relation]
+        except KeyError:
+            pass
+
+        name, op, version = relation
+
+        if self._is_external(name):
+            result = None
+        else:
+            result = set()
+            compare = OPERATORS.get(op) if op else None
+            wanted = version_key(version) if compare is not None else None
+
+            for candidate_version, key in self._candidates.get(name, ()):
+                if not op:
+                    result.add(key)
+                elif candidate_version is not None and compare(
+                    version_key(candidate_version), wanted
+                ):
+                    result.add(key)
+
+        self._satisfying[relation] = result
+        return result
+
+    def uninstallable(self) -> Dict[Key, List[str]]:
+        """Find packages that can't be installed.
+
+        Returns:
+            A dict of record keys to the dependency groups that can't be satisfied
+            (as strings, i.e 'a (>= 1.0) | b'), and conflicting constraints on
+            external packages (see external_conflicts()).
+        """
+
+        installable = set(self._records)
+        external_conflicts = {key: self.external_conflicts(key) for key in self._records}
+        # reverse edges: key -> keys of records that (may) depend on it
+        dependents: Dict[Key, Set[Key]] = defaultdict(set)
+
+        for key, groups in self._groups.items():
+            for group in groups:
+                for relation in group:
+                    for candidate in self.satisfying(relation) or ():
+                        dependents[candidate].add(key)
+
+        def broken_groups(key):
+            broken = []
+            for group in self._groups[key]:
+                # (iterate over the candidates instead of using set operations:
+                # installable shrinks, and set operations would scan its whole table.)
+                if not any(
+                    keys is None or any(k in installable for k in keys)
+                    for keys in map(self.satisfying, group)
+                ):
+                    broken.append(group)
+            return broken
+
+        worklist = list(self._records)
+        while worklist:
+            key = worklist.pop()
+            if key not in installable or not (external_conflicts[key] or broken_groups(key)):
+                continue
+
+            installable.discard(key)
+            worklist.extend(k for k in dependents[key] if k in installable)
+
+        return {
+            key: external_conflicts[key] + [_format_group(group) for group in broken_groups(key)]
+            for key in sorted(set(self._records) - installable)
+        }
+
+    def cycles(self) -> List[List[str]]:
+        """Find dependency cycles between packages (by name).
+
+        Returns:
+            A list of cycles, each a sorted list of package names.
+        """
+
+        graph: Dict[str, Set[str]] = defaultdict(set)
+        for key, groups in self._groups.items():
+            for group in groups:
+                for relation in group:
+                    for candidate in self.satisfying(relation) or ():
+                        graph[key[0]].add(candidate[0])
+
+        # iterative Tarjan's algorithm (repos can have very deep dependency chains).
+        index: Dict[str, int] = {}
+        lowlink: Dict[str, int] = {}
+        stack: List[str] = []
+        on_stack: Set[str] = set()
+        cycles = []
+
+        for start in sorted(graph):
+            if start in index:
+                continue
+
+            work = [(start, iter(sorted(graph[start])))]
+            index[start] = lowlink[start] = len(index)
+            stack.append(start)
+            on_stack.add(start)
+
+            while work:
+                node, children = work[-1]
+                child = next(children, None)
+
+                if child is not None:
+                    if child not in index:
+                        index[child] = lowlink[child] = len(index)
+                        stack.append(child)
+                        on_stack.add(child)
+                        work.append((child, iter(sorted(graph[child]))))
+                    elif child in on_stack:
+                        lowlink[node] = min(lowlink[node], index[child])
+                    continue
+
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+
+                if lowlink[node] == index[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+
+                    if len(component) > 1 or node in graph[node]:
+                        cycles.append(sorted(component))
+
+        return cycles
+
+    def check(self) -> dict:
+        """Check all packages.
+
+        Returns:
+            A report as a dict (JSON-serialisable):
+            {
+                "packages": ...,  # number of packages checked
+                "uninstallable": {
+                    "name_version_arch": ["unsatisfiable dependency", ...],
+                    ...
+                },
+                "cycles": [["name", ...], ...],
+            }
+        """
+
+        uninstallable = self.uninstallable()
+        cycles = self.cycles()
+
+        _log.info(
+            "checked %s packages: %s uninstallable, %s cycle(s)",
+            len(self._records),
+            len(uninstallable),
+            len(cycles),
+        )
+
+        return {
+            "packages": len(self._records),
+            "uninstallable": {"_".join(k): v for k, v in uninstallable.items()},
+            "cycles": cycles,
+        }
+
+
+def _format_group(group: List[Relation]) -> str:
+    return " | ".join(
+        f"{name} ({op} {version})" if op else name for name, op, version in group
+    )
+
+
+def _satisfiable(relations: List[Relation]) -> bool:
+    # whether some version meets all the (versioned) relations at once.
+    # bounds are (version key, inclusive).
+    lower: Optional[Tuple[tuple, bool]] = None
+    upper: Optional[Tuple[tuple, bool]] = None
+
+    for _, op, version in relations:
+        key = version_key(version)
+
+        if op in LOWER_BOUNDS:
+            bound = (key, LOWER_BOUNDS[op])
+            # the tightest lower bound is the highest (exclusive wins a tie).
+            if lower is None or (key, not bound[1]) > (lower[0], not lower[1]):
+                lower = bound
+
+        if op in UPPER_BOUNDS:
+            bound = (key, UPPER_BOUNDS[op])
+            # the tightest upper bound is the lowest (exclusive wins a tie).
+            if upper is None or (key, bound[1]) < (upper[0], upper[1]):
+                upper = bound
+
+    if lower is None or upper is None:
+        return True
+
+    if lower[0] == upper[0]:
+        return lower[1] and upper[1]
+    return lower[0] < upper[0]
@@ -1,22 +1,15 @@
 # coding: utf8
+# NOTE: Only import what every command needs here.
+# Anything else (requests, http.server, etc.) is imported in the command that uses it,
+# so commands like 'build' start up fast (see benchmarks/importtime.py).
 
-import email.message
 import functools
-import http.server
-import io
-import json
 import logging
 import pathlib
-import shutil
-import socket
-import socketserver
-import zipfile
 
 import click
-import coloredlogs  # type: ignore
-import requests
 
-from mothman import repo
+from mothman import repo, utils
 from .__version__ import __version__
 
 click.option = functools.partial(click.option, show_default=True)  # type: ignore
@@ -64,6 +57,8 @@ def release_prompt():
 
 # https://stackoverflow.com/a/28950776
 def get_ip():
+    import socket
+
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     try:
         # doesn't even have to be reachable
@@ -83,6 +78,8 @@ def get_ip():
 )
 def cli(verbosity):
     """Cydia/Sileo repository manager/configurator."""
+    import coloredlogs  # type: ignore
+
     # set up logger
     coloredlogs.install(
         fmt=" %(levelname)-8s :: %(message)s",
@@ -106,42 +103,37 @@ def cli(verbosity):
     help=f"name of the template to use ({', '.join(t for t in repo.TEMPLATES)})",
     default="repo.me",
 )
-def init(repo_path, template_name):
+@click.option(
+    "--offline",
+    help="don't download the template (use the cached one, or a bare repo)",
+    is_flag=True,
+)
+def init(repo_path, template_name, offline):
     """Initalise a repository at path."""
-    repo_path = pathlib.Path(repo_path)
+    import email.message
+    import json
 
-    template = repo.TEMPLATES[template_name]
+    from mothman import templates
 
-    username, reponame = template["github"].split("/")
+    repo_path = pathlib.Path(repo_path)
 
-    _log.info("downloading template %s/%s", username, reponame)
+    template = repo.TEMPLATES[template_name]
 
-    response = requests.get(
-        f"https://github.com/{username}/{reponame}/archive/master.zip",
-        allow_redirects=True,
-    )
+    try:
+        zip_path = templates.fetch(template_name, template, offline=offline)
+    except templates.TemplateError as e:
+        raise click.ClickException(str(e))
 
     repo_path.mkdir(exist_ok=True)
 
-    with zipfile.ZipFile(io.BytesIO(response.content)) as zf:
-
-        _log.info("extracting zip file")
-        template_root = f"{reponame}-master"
-
-        for zinfo in zf.infolist():
-            _log.debug("extracting %s", zinfo.filename)
-            zinfo.filename = zinfo.filename.replace(template_root, "")
-
-            zf.extract(zinfo, str(repo_path))
+    if zip_path is not None:
+        templates.extract(zip_path, repo_path, exclude=template["exclude"])
+    else:
+        _log.warning(
+            "template %s is not cached, creating a bare repo instead", template_name
+        )
 
-    # remove unecessary files
-    for pattern in template["exclude"]:
-        for path in repo_path.glob(pattern):
-            _log.debug("deleting excluded file %s", path)
-            if path.is_file():
-                path.unlink()
-            elif path.is_dir():
-                shutil.rmtree(path)
+    (repo_path / template["deb_path"]).mkdir(parents=True, exist_ok=True)
 
     existing_release = (repo_path / "Release").is_file()
 
@@ -172,23 +164,457 @@ def init(repo_path, template_name):
     )
 
 
-def _build(host, path):
-    tree = repo.Repository(host, path)
-    tree.build()
+def _build(host, path, profile=False, max_memory=None, metrics_path=None, **kwargs):
+    tree = repo.Repository(host, path, **kwargs)
+    tree.build(profile=profile, max_memory=max_memory)
+
+    if metrics_path is not None:
+        _log.info("writing metrics to %s", metrics_path)
+        tree.metrics.write_textfile(metrics_path)
 
 
 @cli.command()
 @click.argument("host")
 @click.option("-p", "--path", help="path to the repo", default=".")
-def build(host, path):
+@click.option(
+    "-k",
+    "--keep-versions",
+    help="only keep the newest N versions of each package",
+    type=click.IntRange(min=1),
+    default=None,
+)
+@click.option(
+    "--max-age",
+    help="prune versions older than N days (the newest version is always kept)",
+    type=click.IntRange(min=0),
+    default=None,
+)
+@click.option(
+    "--archive",
+    help="move pruned packages to this folder (relative to the repo)",
+    default=None,
+)
+@click.option(
+    "-d",
+    "--digest",
+    "digests",
+    help="hashes to add to Packages/Release (overrides 'digests' in mothman.json)",
+    type=click.Choice(list(utils.PACKAGES_FIELDS)),
+    multiple=True,
+)
+@click.option(
+    "--fast",
+    help=f"only compute {', '.join(utils.FAST_HASHES)} (skip legacy hashes)",
+    is_flag=True,
+)
+@click.option(
+    "--compact/--no-compact",
+    help="write minified depictions with .gz copies and a combined manifest "
+    "(overrides 'compact' in mothman.json)",
+    default=None,
+)
+@click.option(
+    "--assets/--no-assets",
+    help="extract icons/screenshots referenced with file:// URLs from the debs for depictions "
+    "(overrides 'assets' in mothman.json)",
+    default=None,
+)
+@click.option(
+    "-j", "--jobs", help="how many depictions to render at once", type=int, default=None
+)
+@click.option("--profile", help="log how long each build stage took", is_flag=True)
+@click.option(
+    "--dedupe",
+    help="replace debs with the same content with links to one copy",
+    type=click.Choice(["auto", "reflink", "hardlink"]),
+    default=None,
+)
+@click.option(
+    "--max-memory",
+    help="stream the Packages files instead of building them in memory, "
+    "caching at most N MiB of stanzas (for very large repos)",
+    type=click.IntRange(min=0),
+    default=None,
+)
+@click.option(
+    "--generations",
+    help="stage the index files in a new generation and publish it atomically, "
+    "keeping the last N generations for rollback",
+    type=click.IntRange(min=1),
+    default=None,
+)
+@click.option(
+    "--progress",
+    help="log the progress of scanning/building (rates and ETA) every so often",
+    is_flag=True,
+)
+@click.option(
+    "--metrics",
+    "metrics_path",
+    help="write metrics of the build to this file in the Prometheus textfile format",
+    type=click.Path(dir_okay=False),
+    default=None,
+)
+def build(
+    host,
+    path,
+    keep_versions,
+    max_age,
+    archive,
+    digests,
+    fast,
+    compact,
+    assets,
+    jobs,
+    profile,
+    dedupe,
+    max_memory,
+    generations,
+    progress,
+    metrics_path,
+):
     """Build a repository at path, using hostname."""
-    _build(host, path)
+    import datetime
+
+    from mothman import metrics
+
+    kwargs = {}
+    if fast:
+        kwargs["digests"] = utils.FAST_HASHES
+    elif digests:
+        kwargs["digests"] = digests
+
+    _build(
+        host,
+        path,
+        keep_versions=keep_versions,
+        max_age=None if max_age is None else datetime.timedelta(days=max_age),
+        archive_path=archive,
+        compact=compact,
+        assets=assets,
+        workers=jobs,
+        profile=profile,
+        max_memory=None if max_memory is None else max_memory << 20,
+        dedupe=dedupe,
+        generations=generations,
+        progress=metrics.log_event if progress else None,
+        metrics_path=metrics_path,
+        **kwargs,
+    )
+
+
+@cli.command()
+@click.argument("generation", type=int, required=False)
+@click.option("-p", "--path", help="path to the repo", default=".")
+def rollback(generation, path):
+    """Publish an older generation of the index files (the previous one by default).
+
+    The repo must have been built with --generations.
+    """
+    from mothman import generations
+
+    try:
+        number = generations.Generations(path).rollback(generation)
+    except generations.GenerationError as e:
+        raise click.ClickException(str(e))
+
+    click.echo(f"rolled back to generation {number}")
+
+
+@cli.command()
+@click.argument("files", nargs=-1, required=True, type=click.File("rb"))
+@click.option("-p", "--path", help="path to the repo", default=".")
+@click.option(
+    "--name",
+    help="filename to save a deb read from stdin as  [default: <package>_<version>_<arch>.deb]",
+    default=None,
+    show_default=False,
+)
+@click.option("--delete", help="delete the debs of the packages that are replaced", is_flag=True)
+def add(files, path, name, delete):
+    """Copy debs into the repository at path (use - to read one from stdin).
+
+    Each deb is hashed and parsed while it is copied, so the next build doesn't read it again.
+    """
+    import json
+
+    from mothman import tree
+
+    with (pathlib.Path(path) / repo.CONFIG_NAME).open() as f:
+        template = json.load(f)
+
+    debian_tree = tree.DebianTree(path, digests=template.get("digests", utils.FILEINFO_HASHES))
+    debian_tree.deb_path = debian_tree.root / template["deb_path"]
+
+    if delete:
+        # the packages have to be in the tree to be replaced.
+        debian_tree.add_debs(debian_tree.deb_path)
+
+    for file in files:
+        # (stdin may not have a name, i.e if it was replaced)
+        label = getattr(file, "name", "<stdin>")
+        filename = name if label == "<stdin>" else pathlib.Path(label).name
+
+        try:
+            debian_tree.ingest(file, filename, delete=delete)
+        except (tree.DebError, OSError) as e:
+            raise click.ClickException(f"{label}: {e}")
+
+
+@cli.command("build-all")
+@click.argument("repos", nargs=-1, required=True, metavar="PATH=HOST...")
+@click.option("-j", "--jobs", help="how many worker threads to use", type=int, default=None)
+@click.option(
+    "--fast",
+    help=f"only compute {', '.join(utils.FAST_HASHES)} (skip legacy hashes)",
+    is_flag=True,
+)
+@click.option(
+    "--compact/--no-compact",
+    help="write minified depictions (overrides 'compact' in each mothman.json)",
+    default=None,
+)
+@click.option("--profile", help="log how long each build stage took", is_flag=True)
+def build_all(repos, jobs, fast, compact, profile):
+    """Build many repositories at once, sharing a scan cache between them.
+
+    Each repo is given as PATH=HOST (see 'build').
+    """
+    from mothman import batch
+
+    roots = {}
+    for spec in repos:
+        path, sep, host = spec.partition("=")
+        if not sep or not path or not host:
+            raise click.BadParameter(f"expected PATH=HOST, got {spec!r}", param_hint="REPOS")
+        roots[path] = host
+
+    kwargs = {}
+    if fast:
+        kwargs["digests"] = utils.FAST_HASHES
+
+    results = batch.build_all(
+        roots,
+        workers=jobs,
+        build_kwargs={"profile": profile},
+        compact=compact,
+        **kwargs,
+    )
+
+    failed = [root for root, error in results.items() if error is not None]
+    if failed:
+        raise click.ClickException(f"failed to build {len(failed)} repo(s): {', '.join(failed)}")
+
+
+@cli.command()
+@click.argument("paths", nargs=-1, required=True)
+@click.option(
+    "-m",
+    "--mode",
+    help="how to replace duplicates (auto = reflink if supported, otherwise hardlink)",
+    type=click.Choice(["auto", "reflink", "hardlink"]),
+    default="auto",
+)
+@click.option("-n", "--dry-run", help="only report what would be done", is_flag=True)
+@click.option("--json", "as_json", help="output the report as JSON", is_flag=True)
+def dedupe(paths, mode, dry_run, as_json):
+    """Replace duplicate debs in the given repos/folders with links to one copy."""
+    import json
+
+    from mothman import cache
+    from mothman import dedupe as _dedupe
+
+    debfiles = []
+    for path in map(pathlib.Path, paths):
+        if (path / repo.CONFIG_NAME).is_file():
+            with (path / repo.CONFIG_NAME).open() as f:
+                path = path / json.load(f)["deb_path"]
+
+        debfiles.extend(sorted(path.glob("*.deb")) if path.is_dir() else [path])
+
+    scan_cache = cache.SharedScanCache()
+    report = _dedupe.dedupe(debfiles, mode=mode, scan_cache=scan_cache, dry_run=dry_run)
+    scan_cache.save()
+
+    if as_json:
+        click.echo(json.dumps(report, indent=4))
+    else:
+        for dup, src in report["replaced"].items():
+            click.echo(f"{dup} -> {src}")
+        click.echo(
+            f"{'would reclaim' if dry_run else 'reclaimed'} "
+            f"{report['reclaimed'] / (1 << 20):.1f} MiB in {len(report['replaced'])} file(s)"
+        )
+
+    if report["failed"]:
+        raise click.ClickException(f"failed to dedupe {len(report['failed'])} file(s)")
+
+
+@cli.command()
+@click.option("-p", "--path", help="path to the repo", default=".")
+@click.option(
+    "-e",
+    "--external",
+    help="packages provided outside of the repo (glob patterns, adds to the defaults)",
+    multiple=True,
+)
+@click.option("--json", "as_json", help="output the report as JSON", is_flag=True)
+def check(path, external, as_json):
+    """Check that all packages in the repo at path can be installed."""
+    import json
+
+    from mothman import check as _check
+    from mothman import tree
+
+    with (pathlib.Path(path) / repo.CONFIG_NAME).open() as f:
+        template = json.load(f)
+
+    debian_tree = tree.DebianTree(path)
+    debian_tree.add_debs(debian_tree.root / template["deb_path"])
+
+    report = debian_tree.check(external=_check.EXTERNAL + external)
+
+    if as_json:
+        click.echo(json.dumps(report, indent=4))
+    else:
+        for package, groups in report["uninstallable"].items():
+            click.echo(f"{package}: unsatisfiable dependencies: {', '.join(groups)}")
+        for cycle in report["cycles"]:
+            # (the members of a cycle, not a path through it)
+            click.echo(f"dependency cycle between: {', '.join(cycle)}")
+
+    if report["uninstallable"]:
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.option("-p", "--path", help="path to the published repo", default=".")
+@click.option("-j", "--jobs", help="how many processes to hash with", type=int, default=None)
+@click.option("--json", "as_json", help="output the report as JSON", is_flag=True)
+def verify(path, jobs, as_json):
+    """Check that all files listed in Release/Packages match their sizes and hashes."""
+    import json
+
+    from mothman import verify as _verify
+
+    try:
+        report = _verify.verify(path, workers=jobs)
+    except _verify.VerifyError as e:
+        raise click.ClickException(str(e))
+
+    if as_json:
+        click.echo(json.dumps(report, indent=4))
+
+    if not report["ok"]:
+        raise SystemExit(1)
+
+
+@cli.command()
+@click.argument("dest")
+@click.option("-p", "--path", help="path to the repo", default=".")
+@click.option("-j", "--jobs", help="how many files to hash/copy at once", type=int, default=None)
+@click.option(
+    "-x",
+    "--exclude",
+    help="glob of files (relative to the repo) to not publish",
+    multiple=True,
+)
+@click.option(
+    "--base-url",
+    help="print changed files as URLs under this base URL (i.e for a CDN purge)",
+    default=None,
+)
+@click.option("-n", "--dry-run", help="only report what would be done", is_flag=True)
+@click.option("--json", "as_json", help="output the report as JSON", is_flag=True)
+def publish(dest, path, jobs, exclude, base_url, dry_run, as_json):
+    """Copy the files of the repo at path that changed since the last publish to dest.
+
+    The paths (or URLs, see --base-url) of all changed and deleted files are printed.
+    """
+    import json
+
+    from mothman import publish as _publish
+
+    try:
+        report = _publish.publish(path, dest, workers=jobs, exclude=exclude, dry_run=dry_run)
+    except _publish.PublishError as e:
+        raise click.ClickException(str(e))
+
+    if as_json:
+        click.echo(json.dumps(report, indent=4))
+        return
+
+    for relpath in report["copied"] + report["deleted"]:
+        click.echo(relpath if base_url is None else f"{base_url.rstrip('/')}/{relpath}")
+
+
+@cli.command()
+@click.argument("url")
+@click.option("-p", "--path", help="path to mirror into", default=".")
+@click.option(
+    "--deb-path",
+    help=(
+        "folder (relative to path) to put debs in "
+        "[default: deb_path in mothman.json, or the remote layout]"
+    ),
+    default=None,
+    show_default=False,
+)
+@click.option("-j", "--jobs", help="how many debs to download at once", default=8)
+def mirror(url, path, deb_path, jobs):
+    """Mirror the repository at url (i.e https://repo.example.com) into path."""
+    import json
+
+    from mothman import mirror as _mirror
+
+    config_path = pathlib.Path(path) / repo.CONFIG_NAME
+
+    if deb_path is None and config_path.is_file():
+        with config_path.open() as f:
+            deb_path = json.load(f)["deb_path"]
+
+    results = _mirror.Mirror(url, path, deb_path=deb_path, workers=jobs).run()
+
+    if results["failed"]:
+        raise click.ClickException(
+            f"failed to mirror {len(results['failed'])} package file(s)"
+        )
+
+
+@cli.command()
+@click.argument("host")
+@click.option("-p", "--path", help="path to the repo", default=".")
+@click.option(
+    "--bind", help="address to bind to (local only by default)", default="127.0.0.1"
+)
+@click.option("--port", help="port to serve at", default=8080)
+@click.option(
+    "--token",
+    help="require this bearer token for uploads/deletes",
+    envvar="MOTHMAN_TOKEN",
+    default=None,
+)
+def serve(host, path, bind, port, token):
+    """Serve a repository at path, rebuilding it live as debs are uploaded/deleted."""
+    import asyncio
+
+    from mothman import daemon
+
+    server = daemon.Daemon(repo.Repository(host, path), token=token)
+
+    try:
+        asyncio.run(server.serve_forever(bind, port))
+    except KeyboardInterrupt:
+        pass
 
 
 @cli.command()
 @click.option("-p", "--port", help="port to serve at", default=8000)
 def demo(port):
     """Build a repo with the current IP address as the host."""
+    import http.server
+    import socketserver
+
     current_ip = "0.0.0.0"
     _build(f"current_ip:{port}", ".")
 
@@ -0,0 +1,411 @@
+# coding: utf8
+"""A long-running repository server: holds a Repository in memory, accepts deb uploads
+and deletions over a local HTTP API, and serves the repo (indexes straight from memory).
+
+API:
+    PUT /api/debs/<filename>  upload a deb (replacing the same package/version/arch)
+    DELETE /api/packages/<name>[/<version>[/<arch>]]  remove a package (and its files)
+    GET /api/status  the current generation and number of packages
+
+Every change publishes a new generation of the indexes (Packages*/Release).
+Readers always get a complete generation, even while a rebuild is in progress.
+A change and its rebuild are one batch: if the rebuild fails, the change is rolled back
+(and no package files are deleted).
+Besides the indexes, only the files that would be published are served
+(not hidden files such as .mothman/, or mothman.json).
+"""
+
+import asyncio
+import email.utils
+import fnmatch
+import hashlib
+import io
+import json
+import logging
+import mimetypes
+import os
+import pathlib
+import urllib.parse
+from typing import Callable, Dict, List, Optional, Tuple
+
+from mothman import repo, tree
+
+__all__ = ["Daemon", "Generation"]
+
+_log = logging.getLogger("mothman")
+
+CHUNKSIZE = 65536
+# limit on the size of request headers.
+HEADER_LIMIT = 65536
+
+REASONS = {
+    200: "OK",
+    201: "Created",
+    304: "Not Modified",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    409: "Conflict",
+    411: "Length Required",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str = ""):
+        super().__init__(message or REASONS[status])
+        self.status = status
+
+
+class Generation:
+    """An immutable snapshot of the published indexes.
+
+    Args:
+        number: The generation number (increases with every change).
+        files: A dict of filenames (relative to the root) to their content.
+        packages: The number of (unique) packages in the indexes. Defaults to 0.
+
+    Attributes:
+        number (int): See Args.
+        files (dict): A dict of filenames to (content, ETag).
+        packages (int): See Args.
+    """
+
+    __slots__ = ("number", "files", "packages")
+
+    def __init__(self, number: int, files: Dict[str, bytes], packages: int = 0):
+        self.number = number
+        self.packages = packages
+        self.files = {
+            name: (content, '"{}"'.format(hashlib.sha256(content).hexdigest()))
+            for name, content in files.items()
+        }
+
+
+class _UploadStream(io.RawIOBase):
+    # a blocking, read-only view of a request body, for reading it in a worker thread
+    # (the reads run on the event loop).
+
+    def __init__(self, reader: asyncio.StreamReader, length: int, loop: asyncio.AbstractEventLoop):
+        super().__init__()
+        self._reader = reader
+        self._remaining = length
+        self._loop = loop
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        if not self._remaining:
+            return b""
+
+        size = CHUNKSIZE if size < 0 else size
+        chunk = asyncio.run_coroutine_threadsafe(
+            self._reader.read(min(size, CHUNKSIZE, self._remaining)), self._loop
+        ).result()
+
+        if not chunk:
+            raise HTTPError(400, "upload ended early")
+
+        self._remaining -= len(chunk)
+        return chunk
+
+
+class Daemon:
+    """A repository server.
+
+    Args:
+        repository: The repository to serve.
+        compress_using: Formats to compress the Packages file in (see DebianTree.build).
+            Defaults to [CAT, GZIP].
+        token: If not None, API requests must have an 'Authorization: Bearer <token>' header.
+            Defaults to None.
+        max_upload: The maximum size of an uploaded deb in bytes. Defaults to 1 GiB.
+
+    Attributes:
+        repository (mothman.repo.Repository): See Args.
+        generation (Generation): The currently published generation
+            (None until start() is called).
+    """
+
+    def __init__(
+        self,
+        repository: repo.Repository,
+        compress_using: list = [tree.CAT, tree.GZIP],
+        token: Optional[str] = None,
+        max_upload: int = 1 << 30,
+    ):
+        self.repository = repository
+        self.generation: Optional[Generation] = None
+
+        self._compress_using = compress_using
+        self._token = token
+        self._max_upload = max_upload
+        # only one change (and rebuild) at a time.
+        # (created by start(), so it belongs to the running event loop)
+        self._lock: Optional[asyncio.Lock] = None
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    @property
+    def deb_path(self) -> pathlib.Path:
+        return self.repository.deb_path
+
+    def _publish(self, change: Optional[Callable] = None):
+        # runs in an executor: apply a change, rebuild and snapshot the indexes.
+        # if anything fails, the change is rolled back (and package files it removed are kept).
+        with self.repository.batch():
+            result = None if change is None else change()
+            self.repository.build(compress_using=self._compress_using)
+
+        names = [f"Packages{fmt}" for fmt in self._compress_using] + ["Release"]
+        files = {name: (self.repository.root / name).read_bytes() for name in names}
+
+        number = 1 if self.generation is None else self.generation.number + 1
+        packages = int(self.repository.metrics.get("mothman_packages"))
+        self.generation = Generation(number, files, packages)
+        _log.info("published generation %s", number)
+
+        return result
+
+    async def _change(self, change: Optional[Callable] = None):
+        loop = asyncio.get_event_loop()
+        async with self._lock:  # type: ignore
+            return await loop.run_in_executor(None, self._publish, change)
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8080):
+        """Build the repository and start serving it.
+
+        Args:
+            host: The address to bind to. Defaults to 127.0.0.1 (local only).
+            port: The port to listen on. Defaults to 8080.
+        """
+
+        self._lock = asyncio.Lock()
+        await self._change()
+        self._server = await asyncio.start_server(
+            self._handle, host, port, limit=HEADER_LIMIT
+        )
+        _log.info("serving %s at %s, port %s", self.repository.root, host, port)
+
+    async def serve_forever(self, host: str = "127.0.0.1", port: int = 8080):
+        """Start serving (see start()) until cancelled."""
+
+        await self.start(host, port)
+        async with self._server:  # type: ignore
+            await self._server.serve_forever()  # type: ignore
+
+    async def close(self):
+        """Stop serving."""
+
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        method = "GET"
+
+        try:
+            try:
+                method, path, headers = await self._read_request(reader)
+                status, response_headers, body = await self._route(
+                    method, path, headers, reader
+                )
+            except HTTPError as e:
+                status, response_headers = e.status, {"Content-Type": "application/json"}
+                body = json.dumps({"error": str(e)}).encode()
+            except Exception:
+                _log.exception("error handling request")
+                status, response_headers = 500, {"Content-Type": "application/json"}
+                body = json.dumps({"error": REASONS[500]}).encode()
+
+            response_headers.setdefault("Content-Length", str(len(body)))
+            response_headers["Connection"] = "close"
+            response_headers["Date"] = email.utils.formatdate(usegmt=True)
+
+            head = [f"HTTP/1.1 {status} {REASONS[status]}"]
+            head += [f"{k}: {v}" for k, v in response_headers.items()]
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+            if method != "HEAD" and status != 304:
+                writer.write(body)
+
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_request(
+        self, reader: asyncio.StreamReader
+    ) -> Tuple[str, str, Dict[str, str]]:
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HTTPError(400, "request headers too large")
+
+        request_line, *header_lines = head.decode("latin-1").split("\r\n")
+
+        try:
+            method, target, _ = request_line.split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "malformed request line")
+
+        headers = {}
+        for line in header_lines:
+            if line:
+                name, _, value = line.partition(":")
+                headers[name.strip().lower()] = value.strip()
+
+        path = urllib.parse.unquote(urllib.parse.urlsplit(target).path)
+        return method.upper(), path, headers
+
+    async def _route(
+        self,
+        method: str,
+        path: str,
+        headers: Dict[str, str],
+        reader: asyncio.StreamReader,
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        parts = [p for p in path.split("/") if p]
+
+        if parts[:1] == ["api"]:
+            if self._token is not None and headers.get("authorization") != f"Bearer {self._token}":
+                raise HTTPError(401)
+
+            if parts[1:2] == ["debs"] and len(parts) == 3 and method in ("PUT", "POST"):
+                result = await self._upload(parts[2], headers, reader)
+                return 201, {"Content-Type": "application/json"}, json.dumps(result).encode()
+
+            if parts[1:2] == ["packages"] and 3 <= len(parts) <= 5 and method == "DELETE":
+                result = await self._delete(*parts[2:])
+                return 200, {"Content-Type": "application/json"}, json.dumps(result).encode()
+
+            if parts[1:] == ["status"] and method in ("GET", "HEAD"):
+                # (from the published snapshot: the tree may be changing in another thread)
+                generation = self.generation
+                result = {
+                    "generation": generation.number,  # type: ignore
+                    "packages": generation.packages,  # type: ignore
+                }
+                return 200, {"Content-Type": "application/json"}, json.dumps(result).encode()
+
+            raise HTTPError(404)
+
+        if method not in ("GET", "HEAD"):
+            raise HTTPError(405)
+
+        return await self._serve(path, headers)
+
+    async def _serve(
+        self, path: str, headers: Dict[str, str]
+    ) -> Tuple[int, Dict[str, str], bytes]:
+        # grab the generation once, so the response is consistent.
+        generation = self.generation
+        name = path.lstrip("/")
+
+        if generation is not None and name in generation.files:
+            content, etag = generation.files[name]
+            response_headers = {
+                "ETag": etag,
+                "Content-Type": "application/octet-stream",
+                "Cache-Control": "no-cache",
+            }
+
+            if headers.get("if-none-match") == etag:
+                response_headers["Content-Length"] = str(len(content))
+                return 304, response_headers, b""
+
+            return 200, response_headers, content
+
+        # anything else is served from disk (debs, depictions, etc.), except hidden files
+        # (i.e .mothman/, .ingest.*.part), the repo config and metadata sources.
+        parts = name.split("/")
+        if any(p.startswith(".") for p in parts) or any(
+            fnmatch.fnmatch(name, pattern) for pattern in self.repository.private_patterns
+        ):
+            raise HTTPError(404)
+
+        root = self.repository.root
+        file = (root / name).resolve()
+
+        if root != file and root not in file.parents:
+            raise HTTPError(404)
+        if file.is_dir():
+            file = file / "index.html"
+        if not file.is_file():
+            raise HTTPError(404)
+
+        loop = asyncio.get_event_loop()
+        content = await loop.run_in_executor(None, file.read_bytes)
+        content_type = mimetypes.guess_type(file.name)[0] or "application/octet-stream"
+
+        return 200, {"Content-Type": content_type}, content
+
+    async def _upload(
+        self, filename: str, headers: Dict[str, str], reader: asyncio.StreamReader
+    ) -> dict:
+        filename = os.path.basename(filename)
+        if not filename.endswith(f".{self.repository._debtype}") or filename.startswith("."):
+            raise HTTPError(400, f"not a .{self.repository._debtype} file: {filename}")
+
+        try:
+            length = int(headers["content-length"])
+        except (KeyError, ValueError):
+            raise HTTPError(411)
+        if length < 0:
+            raise HTTPError(400, "invalid Content-Length")
+        if length > self._max_upload:
+            raise HTTPError(413)
+
+        _log.info("[%s] receiving upload (%s bytes)", filename, length)
+
+        # hashed and parsed while it is streamed to disk (in a worker thread),
+        # so the deb never has to be read again.
+        loop = asyncio.get_event_loop()
+        try:
+            received = await loop.run_in_executor(
+                None,
+                self.repository._receive,
+                _UploadStream(reader, length, loop),
+                self.deb_path,
+                filename,
+            )
+        except tree.DebError as e:
+            raise HTTPError(400, str(e)) from e
+
+        package_record, part_path, hexdigests = received
+        try:
+            replaced = await self._change(
+                lambda: self.repository._commit(package_record, part_path, hexdigests, delete=True)
+            )
+        except tree.DebError as e:
+            # (the filename belongs to another package)
+            raise HTTPError(409, str(e)) from e
+        finally:
+            if part_path.exists():
+                part_path.unlink()
+
+        return {
+            "generation": self.generation.number,  # type: ignore
+            "filename": filename,
+            "replaced": [r.debian_name for r in replaced],
+        }
+
+    async def _delete(
+        self, name: str, version: Optional[str] = None, arch: Optional[str] = None
+    ) -> dict:
+        def change() -> List:
+            removed = self.repository.remove_package(name, version, arch, delete=True)
+            if not removed:
+                raise HTTPError(404, f"no such package: {name}")
+            return removed
+
+        removed = await self._change(change)
+
+        return {
+            "generation": self.generation.number,  # type: ignore
+            "removed": [r.debian_name for r in removed],
+        }
@@ -0,0 +1,197 @@
+# coding: utf8
+"""Find package files with the same content, and replace the duplicates with
+reflinks (copy-on-write clones) or hardlinks of one copy, to reclaim disk space.
+"""
+
+import errno
+import logging
+import os
+import pathlib
+import shutil
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional
+
+from mothman import cache, utils
+from mothman.utils import Path
+
+__all__ = ["HARDLINK", "REFLINK", "AUTO", "dedupe", "find_duplicates"]
+
+_log = logging.getLogger("mothman")
+
+# how duplicates are replaced.
+REFLINK = "reflink"
+HARDLINK = "hardlink"
+# reflink if the filesystem supports it, otherwise hardlink.
+AUTO = "auto"
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+
+def _digest(file: pathlib.Path, stat: os.stat_result, scan_cache: Optional[cache.ScanCache]) -> str:
+    # the sha256 of a file, from the scan cache if possible.
+    if scan_cache is not None:
+        cached = scan_cache.get(file, stat)
+        if cached is not None and "sha256" in cached[1]:
+            return cached[1]["sha256"]
+
+    return utils.fileinfo(file, hashes=("sha256",))["sha256"]
+
+
+def find_duplicates(
+    files: Iterable[Path], scan_cache: Optional[cache.ScanCache] = None
+) -> List[List[pathlib.Path]]:
+    """Find files with the same content.
+    Files are grouped by size first, so only files with the same size are hashed.
+
+    Args:
+        files: The paths to the files.
+        scan_cache: If not None, digests are taken from here (if cached).
+            Defaults to None.
+
+    Returns:
+        A list of groups of files with the same content (each with at least two files).
+        The first file in each group is the one to keep
+        (the one with the most links, then by path).
+    """
+
+    by_size: Dict[int, List[pathlib.Path]] = defaultdict(list)
+    stats = {}
+
+    for file in files:
+        file = pathlib.Path(file)
+        stats[file] = file.stat()
+        by_size[stats[file].st_size].append(file)
+
+    groups = []
+
+    for same_size in by_size.values():
+        if len(same_size) < 2:
+            continue
+
+        by_digest: Dict[str, List[pathlib.Path]] = defaultdict(list)
+        for file in same_size:
+            by_digest[_digest(file, stats[file], scan_cache)].append(file)
+
+        for same in by_digest.values():
+            if len(same) > 1:
+                same.sort(key=lambda f: (-stats[f].st_nlink, str(f)))
+                groups.append(same)
+
+    return sorted(groups, key=lambda g: str(g[0]))
+
+
+def _reflink(src: pathlib.Path, dst: pathlib.Path):
+    import fcntl
+
+    with src.open("rb") as s, dst.open("wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def _replace(src: pathlib.Path, dup: pathlib.Path, mode: str) -> str:
+    # replace dup with a link to src. returns the kind of link made.
+    temp = dup.with_name(f".{dup.name}.{os.getpid()}.dedupe")
+
+    try:
+        if mode in (REFLINK, AUTO):
+            try:
+                _reflink(src, temp)
+                # keep the mtime, so the scan cache entry of dup stays valid.
+                shutil.copystat(dup, temp)
+                os.replace(temp, dup)
+                return REFLINK
+            except (OSError, ImportError) as e:
+                if mode == REFLINK:
+                    raise
+                if isinstance(e, OSError) and e.errno not in (
+                    errno.EOPNOTSUPP,
+                    errno.ENOTTY,
+                    errno.EXDEV,
+                    errno.EINVAL,
+                    errno.ENOSYS,
+                ):
+                    raise
+
+                if temp.exists():
+                    temp.unlink()
+
+        os.link(src, temp)
+        os.replace(temp, dup)
+        return HARDLINK
+
+    finally:
+        if temp.exists():
+            temp.unlink()
+
+
+def dedupe(
+    files: Iterable[Path],
+    mode: str = AUTO,
+    scan_cache: Optional[cache.ScanCache] = None,
+    dry_run: bool = False,
+) -> dict:
+    """Replace duplicate files with links to one copy.
+
+    Args:
+        files: The paths to the files.
+        mode: How to replace duplicates, one of REFLINK, HARDLINK or AUTO.
+            Defaults to AUTO.
+        scan_cache: If not None, digests are taken from here (if cached),
+            and entries of replaced files are kept up to date. Defaults to None.
+        dry_run: If True, only report what would be done. Defaults to False.
+
+    Returns:
+        A report as a dict (JSON-serialisable):
+        {
+            "groups": ...,  # number of groups of duplicates
+            "replaced": {"duplicate path": "path it now links to", ...},
+            "reclaimed": ...,  # bytes of disk space reclaimed
+            "failed": {"duplicate path": "reason", ...},
+        }
+    """
+
+    if mode not in (REFLINK, HARDLINK, AUTO):
+        raise ValueError(f"invalid mode {mode}")
+
+    groups = find_duplicates(files, scan_cache)
+    report: dict = {"groups": len(groups), "replaced": {}, "reclaimed": 0, "failed": {}}
+
+    for src, *dups in groups:
+        src_stat = src.stat()
+
+        for dup in dups:
+            stat = dup.stat()
+            if (stat.st_dev, stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+                # already a hardlink.
+                continue
+
+            cached = None if scan_cache is None else scan_cache.get(dup, stat)
+
+            if not dry_run:
+                try:
+                    kind = _replace(src, dup, mode)
+                except OSError as e:
+                    _log.warning("[%s] failed to dedupe: %s", dup.name, e)
+                    report["failed"][str(dup)] = str(e)
+                    continue
+
+                _log.info("[%s] replaced with a %s to %s", dup.name, kind, src.name)
+
+                if cached is not None:
+                    scan_cache.put(dup, dup.stat(), *cached)  # type: ignore
+
+            report["replaced"][str(dup)] = str(src)
+            if stat.st_nlink == 1:
+                # (otherwise the data is still linked from somewhere else)
+                report["reclaimed"] += stat.st_size
+
+    _log.info(
+        "%s %s file(s) in %s group(s), %s %.1f MiB",
+        "would dedupe" if dry_run else "deduped",
+        len(report["replaced"]),
+        len(groups),
+        "would reclaim" if dry_run else "reclaimed",
+        report["reclaimed"] / (1 << 20),
+    )
+
+    return report
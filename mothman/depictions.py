@@ -2,9 +2,10 @@
 """Generate Cydia/Sileo depictions (from deb packages) for Debian repos.
 """
 
+import copy
 import json
 import re
-from datetime import datetime
+from datetime import datetime, timezone
 from xml.etree import ElementTree as etree
 
 # regexes
@@ -59,21 +60,29 @@ class Generic:
                     "direct_url1",
                     "direct_url2",
                     ...
-                ]
+                ],
+                "released": 1600000000,  # when the package was released (Unix time)
+                "icon": "...",  # direct url to the package icon
             }
             where price is the price, header_image is the direct url to a image
-            to use as a banner, and screenshots is a list of URLs to images.
-            (Price and header_image is used only by Sileo.)
+            to use as a banner, screenshots is a list of URLs to images,
+            and released is the release date (today if not given).
+            (Price, header_image and released are used only by Sileo,
+            icon only by CydiaXML.)
             This is optional.
+        compact: Whether or not to output the depiction without any whitespace
+            (for static hosting). Defaults to False.
 
     Attributes:
         control: See Args.
         other_info: See Args.
+        compact: See Args.
     """
 
-    def __init__(self, control: dict, other_info: dict = {}):
+    def __init__(self, control: dict, other_info: dict = {}, compact: bool = False):
         self.control = control
         self.other_info = other_info
+        self.compact = compact
 
     def build(self) -> str:
         raise NotImplementedError
@@ -115,24 +124,29 @@ class CydiaXML(Generic):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
+        # copy the template, so depictions don't leak into each other.
+        self._xml = copy.deepcopy(self.XML_DICT)
+
         # add control info to xml
         for k, v in self.XML_ELEMENTS.items():
-            self.XML_DICT[k] = self.control[v]
+            self._xml[k] = self.control[v]
 
     def build(self) -> str:
         """Export the depiction as an XML representation (for use in Web depiction),
         i.e in Reposi3/repo.me repo templates.
 
+        The XML is always compact (there is no whitespace between elements).
+
         Returns:
             The XML tree.
         """
 
         description = self.control["Description"].splitlines()
-        self.XML_DICT["shortDescription"] = description[0]
-        self.XML_DICT["descriptionlist"]["description"] = description
+        self._xml["shortDescription"] = description[0]
+        self._xml["descriptionlist"]["description"] = description
 
         dependencies = self.control["Depends"].split(", ")
-        self.XML_DICT["dependencies"]["package"] = dependencies
+        self._xml["dependencies"]["package"] = dependencies
 
         for dep in dependencies:
 
@@ -151,17 +165,21 @@ class CydiaXML(Generic):
             elif operator == ">=" or operator == ">>":
                 firmware = {"miniOS": version}
 
-            self.XML_DICT["compatibility"]["firmware"] = firmware
+            self._xml["compatibility"]["firmware"] = firmware
+
+        icon = self.other_info.get("icon")
+        if icon is not None:
+            self._xml["icon"] = icon
 
         screenshots = self.other_info.get("screenshots")
         if screenshots is not None:
             for count, url in enumerate(screenshots, 1):
-                self.XML_DICT["screenshots"]["screenshot"].append(
+                self._xml["screenshots"]["screenshot"].append(
                     {"description": f"Screenshot {count}", "image": url}
                 )
 
         return etree.tostring(
-            dict_to_xml(self.XML_DICT, rootname="package"), encoding="unicode"
+            dict_to_xml(self._xml, rootname="package"), encoding="unicode"
         )
 
 
@@ -184,7 +202,17 @@ class Sileo(Generic):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self._views = []
+
+        # copy the template, so views don't leak into other depictions.
+        self._sileo = copy.deepcopy(self.SILEO_DICT)
+
+    def _released(self) -> datetime:
+        released = self.other_info.get("released")
+        if released is None:
+            return datetime.today()
+
+        # in UTC, so the date doesn't depend on where the repo is built.
+        return datetime.fromtimestamp(released, timezone.utc)
 
     def add_view(self, viewclass: str, properties: dict = {}):
         """Add a subview to the depiction root.
@@ -194,8 +222,8 @@ class Sileo(Generic):
             properties: The subview's properties.
         """
 
-        properties["class"] = viewclass
-        self.SILEO_DICT["tabs"][0]["views"].append(properties)
+        properties = {**properties, "class": viewclass}
+        self._sileo["tabs"][0]["views"].append(properties)
 
     def add_spacer(self):
         """Add a spacer view (to seperate depiction entries)."""
@@ -270,7 +298,7 @@ class Sileo(Generic):
         # date released
         self.add_view(
             "DepictionTableTextView",
-            {"title": "Released", "text": datetime.today().strftime("%m-%d-%Y")},
+            {"title": "Released", "text": self._released().strftime("%m-%d-%Y")},
         )
 
         # price (if any)
@@ -288,8 +316,12 @@ class Sileo(Generic):
         )
 
         # header image (if any)
-        header = self.other_info.get("header_info")
+        # ('header_info' is the old name of header_image)
+        header = self.other_info.get("header_image", self.other_info.get("header_info"))
         if header is not None:
-            self.SILEO_DICT["headerImage"] = header
+            self._sileo["headerImage"] = header
+
+        if self.compact:
+            return json.dumps(self._sileo, separators=(",", ":"))
 
-        return json.dumps(self.SILEO_DICT, indent=4)
+        return json.dumps(self._sileo, indent=4)
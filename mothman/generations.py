@@ -0,0 +1,295 @@
+# coding: utf8
+"""Staged publishing of a repo's index files (Packages*, Release) in generations.
+
+Each build is written into a new generation folder (.mothman/generations/<n>),
+then published by atomically swapping the .mothman/current symlink over to it.
+The index files in the repo root are symlinks into .mothman/current,
+so clients never see a half-written (or mismatched) set of index files.
+
+Files that did not change since the previous generation are hardlinked from it
+instead of being written again, and the last few generations are kept for rollback.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import pathlib
+import shutil
+from typing import Dict, Generator, List, Optional
+
+from mothman.utils import Path
+
+__all__ = ["GenerationError", "Generations", "Stage"]
+
+_log = logging.getLogger("mothman")
+
+# where generations are kept (relative to the root).
+GENERATIONS_PATH = ".mothman/generations"
+# the symlink to the published generation (relative to the root).
+CURRENT_PATH = ".mothman/current"
+# the record of the files in a generation (in the generation folder).
+MANIFEST_NAME = ".generation.json"
+# suffix of generations that are still being built.
+STAGING_SUFFIX = ".staging"
+
+
+class GenerationError(Exception):
+    pass
+
+
+def _swap(link: pathlib.Path, target: str):
+    # atomically point a symlink at target (replacing whatever was at link).
+    temp = link.with_name(f".{link.name}.{os.getpid()}.swap")
+    if os.path.lexists(temp):
+        temp.unlink()
+
+    os.symlink(target, temp)
+    os.replace(temp, link)
+
+
+def _load_manifest(folder: pathlib.Path) -> Dict[str, dict]:
+    try:
+        with (folder / MANIFEST_NAME).open() as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+class Stage:
+    """A generation being built.
+    Files are written into .path, and then recorded with add() (or reused with reuse()).
+
+    Args:
+        number: The number of the generation.
+        path: The folder to write files into.
+        previous: The folder of the previous (published) generation, if any.
+
+    Attributes:
+        number (int): See Args.
+        path (pathlib.Path): See Args.
+        files (dict): The files recorded so far, as a dict of names to
+            {"info": fileinfo, "key": key}.
+    """
+
+    def __init__(self, number: int, path: pathlib.Path, previous: Optional[pathlib.Path]):
+        self.number = number
+        self.path = path
+        self.files: Dict[str, dict] = {}
+
+        self._previous = previous
+        self._previous_files = {} if previous is None else _load_manifest(previous)
+
+    def _link(self, name: str) -> bool:
+        try:
+            os.link(self._previous / name, self.path / name)  # type: ignore
+        except OSError as e:
+            _log.debug("[%s] failed to link from the previous generation: %s", name, e)
+            return False
+
+        return True
+
+    def reuse(self, name: str, key: str) -> Optional[dict]:
+        """Hardlink a file from the previous generation, if it was made from the same key
+        (i.e a digest of the content before compression), so it doesn't have to be written.
+
+        Args:
+            name: The name of the file.
+            key: What the file is made from.
+
+        Returns:
+            The file info of the file, or None if it could not be reused
+            (the file has to be written and recorded with add()).
+        """
+
+        entry = self._previous_files.get(name)
+        if entry is None or entry.get("key") != key or not self._link(name):
+            return None
+
+        _log.debug("[%s] unchanged, linked from the previous generation", name)
+        self.files[name] = entry
+        return entry["info"]
+
+    def add(self, name: str, info: dict, key: Optional[str] = None):
+        """Record a file written into the stage.
+        If the file is the same as in the previous generation, it is replaced with
+        a hardlink to that file (so unchanged files only take up space once).
+
+        Args:
+            name: The name of the file.
+            info: The file info of the file (see mothman.utils.fileinfo).
+            key: What the file is made from (see reuse()). Defaults to None.
+        """
+
+        self.files[name] = {"info": info, "key": key}
+
+        entry = self._previous_files.get(name)
+        if entry is not None and entry["info"] == info:
+            (self.path / name).unlink()
+            if self._link(name):
+                _log.debug("[%s] same as in the previous generation, linked", name)
+            else:
+                raise GenerationError(f"failed to link {name} from the previous generation")
+
+    def _save(self):
+        with (self.path / MANIFEST_NAME).open("w") as f:
+            json.dump(self.files, f, sort_keys=True)
+
+
+class Generations:
+    """The generations of a repo's index files.
+
+    Args:
+        root: The root of the repo.
+        keep: How many generations to keep (including the published one).
+            Defaults to 3.
+
+    Attributes:
+        root (pathlib.Path): See Args.
+        keep (int): See Args.
+        path (pathlib.Path): The folder the generations are in.
+    """
+
+    def __init__(self, root: Path, keep: int = 3):
+        if keep < 1:
+            raise ValueError("must keep at least 1 generation")
+
+        self.root = pathlib.Path(root)
+        self.keep = keep
+        self.path = self.root / GENERATIONS_PATH
+
+    @property
+    def _current_path(self) -> pathlib.Path:
+        return self.root / CURRENT_PATH
+
+    def numbers(self) -> List[int]:
+        """The numbers of the (finished) generations, oldest first."""
+
+        if not self.path.is_dir():
+            return []
+
+        return sorted(int(p.name) for p in self.path.iterdir() if p.name.isdigit())
+
+    def current(self) -> Optional[int]:
+        """The number of the published generation, or None if there is none."""
+
+        try:
+            return int(os.path.basename(os.readlink(self._current_path)))
+        except (OSError, ValueError):
+            return None
+
+    @contextlib.contextmanager
+    def stage(self) -> Generator[Stage, None, None]:
+        """Build a new generation.
+        If an exception is raised, the generation is thrown away.
+        Otherwise it is finished, but it still has to be published with publish().
+
+        Usage:
+            with generations.stage() as stage:
+                ...  # write files into stage.path, and record them with stage.add()
+            generations.publish(stage.number)
+        """
+
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        # leftovers from builds that were interrupted.
+        for stale in self.path.glob(f"*{STAGING_SUFFIX}"):
+            _log.debug("[%s] removing unfinished generation", stale.name)
+            shutil.rmtree(stale, ignore_errors=True)
+
+        number = max(self.numbers(), default=0) + 1
+        current = self.current()
+
+        path = self.path / f"{number}{STAGING_SUFFIX}"
+        path.mkdir()
+
+        stage = Stage(number, path, None if current is None else self.path / str(current))
+        _log.debug("staging generation %s", number)
+
+        try:
+            yield stage
+        except BaseException:
+            shutil.rmtree(path, ignore_errors=True)
+            raise
+
+        stage._save()
+        stage.path = path.rename(self.path / str(number))
+
+    def publish(self, number: int):
+        """Atomically make a generation the published one,
+        and link the index files in the root to it.
+
+        Args:
+            number: The number of the generation.
+
+        Raises:
+            GenerationError, if the generation does not exist.
+        """
+
+        folder = self.path / str(number)
+        if not folder.is_dir():
+            raise GenerationError(f"generation {number} does not exist")
+
+        files = _load_manifest(folder)
+
+        _swap(self._current_path, os.path.relpath(folder, self._current_path.parent))
+        _log.info("published generation %s", number)
+
+        # the links only change if the set of index files does (i.e a new format).
+        for name in files:
+            link = self.root / name
+            target = os.path.join(CURRENT_PATH, name)
+
+            if not (link.is_symlink() and os.readlink(link) == target):
+                _log.debug("[%s] linking to %s", name, target)
+                _swap(link, target)
+
+        for link in self.root.iterdir():
+            if (
+                link.is_symlink()
+                and link.name not in files
+                and os.readlink(link).startswith(CURRENT_PATH + "/")
+            ):
+                _log.debug("[%s] removing link to a file that is no longer built", link.name)
+                link.unlink()
+
+    def prune(self) -> List[int]:
+        """Delete all but the newest generations (the published one is always kept).
+
+        Returns:
+            The numbers of the deleted generations.
+        """
+
+        numbers = self.numbers()
+        current = self.current()
+
+        pruned = [n for n in numbers[: -self.keep] if n != current]
+        for number in pruned:
+            _log.debug("deleting generation %s", number)
+            shutil.rmtree(self.path / str(number))
+
+        return pruned
+
+    def rollback(self, number: Optional[int] = None) -> int:
+        """Publish an older generation.
+
+        Args:
+            number: The number of the generation. If None, the generation before the
+                published one is used. Defaults to None.
+
+        Returns:
+            The number of the generation that was published.
+
+        Raises:
+            GenerationError, if there is no generation to roll back to.
+        """
+
+        if number is None:
+            current = self.current()
+            older = [n for n in self.numbers() if current is None or n < current]
+            if not older:
+                raise GenerationError("no older generation to roll back to")
+            number = older[-1]
+
+        self.publish(number)
+        return number
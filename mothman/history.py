@@ -0,0 +1,78 @@
+# coding: utf8
+"""A persistent record of when each version of a package was first seen,
+so depictions can show a release date that doesn't change between builds.
+"""
+
+import json
+import logging
+import pathlib
+from typing import Dict
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["History"]
+
+_log = logging.getLogger("mothman")
+
+# where the history is kept (relative to the repo root).
+HISTORY_PATH = ".mothman/history.json"
+
+
+class History:
+    """First-seen timestamps of package versions, stored as
+    {package: {version: timestamp}}.
+
+    Args:
+        path: The path to the history file. If it does not exist, the history starts out empty.
+
+    Attributes:
+        path (pathlib.Path): See Args.
+    """
+
+    def __init__(self, path: Path):
+        self.path = pathlib.Path(path)
+        self._entries: Dict[str, Dict[str, int]] = {}
+        self._dirty = False
+
+        try:
+            with self.path.open() as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            _log.warning("[%s] history is corrupt, ignoring", self.path)
+
+    def first_seen(self, package: str, version: str, mtime: float) -> int:
+        """Get when a package version was first seen, recording it if it wasn't seen before.
+
+        Args:
+            package: The name of the package.
+            version: The version of the package.
+            mtime: The mtime of the package file, used as the first-seen time
+                if the version is new.
+
+        Returns:
+            The first-seen time, as a Unix timestamp (in seconds).
+        """
+
+        versions = self._entries.setdefault(package, {})
+
+        if version not in versions:
+            _log.debug("[%s] first seen version %s", package, version)
+            versions[version] = int(mtime)
+            self._dirty = True
+
+        return versions[version]
+
+    def save(self):
+        """Write the history to disk (if it changed)."""
+
+        if not self._dirty:
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with utils.open_atomic(self.path) as f:
+            json.dump(self._entries, f, sort_keys=True, separators=(",", ":"))
+
+        self._dirty = False
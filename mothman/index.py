@@ -0,0 +1,191 @@
+# coding: utf8
+"""In-memory query indexes over package records
+(lookups by field, reverse dependencies and full-text search).
+"""
+
+import re
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from mothman.depictions import RE_DEPENDS
+from mothman.record import Key, PackageRecord
+
+__all__ = ["QueryIndex", "fold_name", "parse_relations"]
+
+# fields with a hash index (exact, case-insensitive lookups).
+HASHED_FIELDS = ("Package", "Author", "Section", "Architecture")
+# fields with package relations (for reverse dependencies).
+RELATION_FIELDS = ("Depends", "Pre-Depends")
+# fields in the full-text index.
+TEXT_FIELDS = ("Name", "Description")
+
+RE_TOKEN = re.compile(r"\w+")
+# (package names are case-insensitive, but versions are not)
+RE_RELATION = re.compile(RE_DEPENDS.pattern, re.IGNORECASE)
+
+# (name, operator, version); operator and version are empty if there is no constraint.
+Relation = Tuple[str, str, str]
+
+
+def fold_name(name: str) -> str:
+    """Fold a package name for comparisons (package names are case-insensitive)."""
+    return name.strip().lower()
+
+
+def parse_relations(value: Optional[str]) -> List[List[Relation]]:
+    """Parse a relation field (i.e Depends) into groups of alternatives.
+
+    Args:
+        value: The field's value, i.e 'firmware (>= 12.0), a | b'.
+
+    Returns:
+        A list of groups, where each group is a list of alternative relations
+        (any of which satisfies the group). Names are folded (see fold_name()),
+        versions are kept as written.
+    """
+
+    groups = []
+
+    for group in (value or "").split(","):
+        alternatives = []
+
+        for relation in group.split("|"):
+            relation = " ".join(relation.split())
+            if not relation:
+                continue
+
+            match = RE_RELATION.match(relation)
+            if match is not None:
+                name, operator, version = match.groups()
+                alternatives.append((fold_name(name), operator or "", (version or "").strip()))
+            else:
+                # arch qualifiers, etc. just keep the name.
+                name = re.split(r"[\s(:\[]", relation, 1)[0]
+                alternatives.append((fold_name(name), "", ""))
+
+        if alternatives:
+            groups.append(alternatives)
+
+    return groups
+
+
+def _tokens(text: str) -> Set[str]:
+    return set(RE_TOKEN.findall(text.casefold()))
+
+
+class QueryIndex:
+    """Indexes over a set of package records, updated incrementally as records are
+    added or removed:
+
+    - a hash index on each field in HASHED_FIELDS,
+    - a reverse dependency map (from RELATION_FIELDS, plus virtual packages from Provides),
+    - an inverted index of the words in TEXT_FIELDS.
+
+    Args:
+        records: Records to index initially.
+    """
+
+    def __init__(self, records: Iterable[PackageRecord] = ()):
+        self._records: Dict[Key, PackageRecord] = {}
+        self._fields: Dict[str, Dict[str, Set[Key]]] = {
+            field: defaultdict(set) for field in HASHED_FIELDS
+        }
+        self._rdepends: Dict[str, Set[Key]] = defaultdict(set)
+        self._provides: Dict[str, Set[Key]] = defaultdict(set)
+        self._tokens: Dict[str, Set[Key]] = defaultdict(set)
+
+        for package_record in records:
+            self.add(package_record)
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def _entries(self, package_record: PackageRecord):
+        # all (index, index key) pairs a record is stored under.
+        for field in HASHED_FIELDS:
+            value = package_record.get(field)
+            if value is not None:
+                yield self._fields[field], value.strip().casefold()
+
+        for field in RELATION_FIELDS:
+            for group in parse_relations(package_record.get(field)):
+                for name, _, _ in group:
+                    yield self._rdepends, name
+
+        for group in parse_relations(package_record.get("Provides")):
+            for name, _, _ in group:
+                yield self._provides, name
+
+        for field in TEXT_FIELDS:
+            for token in _tokens(package_record.get(field) or ""):
+                yield self._tokens, token
+
+    def add(self, package_record: PackageRecord):
+        """Add a record to the index (replacing any record with the same key)."""
+
+        old = self._records.get(package_record.key)
+        if old is not None:
+            self.remove(old)
+
+        self._records[package_record.key] = package_record
+
+        for index, key in self._entries(package_record):
+            index[key].add(package_record.key)
+
+    def remove(self, package_record: PackageRecord):
+        """Remove a record from the index (if it is in the index)."""
+
+        if self._records.get(package_record.key) is not package_record:
+            return
+
+        del self._records[package_record.key]
+
+        for index, key in self._entries(package_record):
+            keys = index.get(key)
+            if keys is None:
+                continue
+
+            keys.discard(package_record.key)
+            if not keys:
+                del index[key]
+
+    def _get(self, keys: Iterable[Key]) -> List[PackageRecord]:
+        return [self._records[k] for k in sorted(keys)]
+
+    def by_field(self, field: str, value: str) -> List[PackageRecord]:
+        """Get records by the value of a field (case-insensitive).
+
+        Args:
+            field: The field, one of HASHED_FIELDS.
+            value: The value of the field.
+
+        Raises:
+            KeyError, if the field is not indexed.
+        """
+
+        field = next((f for f in HASHED_FIELDS if f.lower() == field.lower()), field)
+        return self._get(self._fields[field].get(value.strip().casefold(), ()))
+
+    def rdepends(self, name: str) -> List[PackageRecord]:
+        """Get records that depend on a package (or a virtual package)."""
+        return self._get(self._rdepends.get(fold_name(name), ()))
+
+    def providers(self, name: str) -> List[PackageRecord]:
+        """Get records that provide a virtual package
+        (not including records of the package itself)."""
+        return self._get(self._provides.get(fold_name(name), ()))
+
+    def search(self, text: str) -> List[PackageRecord]:
+        """Search for records that contain all words of text in their Name/Description.
+
+        Args:
+            text: The words to search for (case-insensitive).
+        """
+
+        tokens = _tokens(text)
+        if not tokens:
+            return []
+
+        # intersect the smallest sets first.
+        sets = sorted((self._tokens.get(t, set()) for t in tokens), key=len)
+        return self._get(set.intersection(*sets))
@@ -0,0 +1,216 @@
+# coding: utf8
+"""Read a Debian package file from a stream (i.e a pipe or a socket) in one pass:
+the bytes are copied to disk and hashed, and the ar archive is parsed as they go by,
+so the control fields are known as soon as the stream ends.
+"""
+
+import email
+import io
+import logging
+import os
+import tarfile
+from typing import IO, Callable, Dict, Iterable, List, Optional, Tuple
+
+from mothman import pydpkg, utils
+
+__all__ = ["ArParser", "IngestError", "copy_deb", "parse_control"]
+
+_log = logging.getLogger("mothman")
+
+CHUNKSIZE = 1 << 16
+
+AR_MAGIC = b"!<arch>\n"
+AR_HEADER_SIZE = 60
+AR_HEADER_END = b"`\n"
+
+CONTROL_PREFIX = "control.tar"
+
+# control fields, as (name, value) pairs.
+Fields = Tuple[Tuple[str, str], ...]
+
+
+class IngestError(Exception):
+    pass
+
+
+class ArParser:
+    """An incremental parser of ar archives: bytes are fed in as they are read,
+    and the members that are wanted are kept in memory (the rest are skipped).
+
+    Args:
+        keep: Called with the name of each member,
+            returns whether or not to keep its content.
+
+    Attributes:
+        names (list): The names of the members seen so far.
+        members (dict): The content of the (complete) members that were kept.
+    """
+
+    def __init__(self, keep: Callable[[str], bool]):
+        self.names: List[str] = []
+        self.members: Dict[str, bytes] = {}
+
+        self._keep = keep
+        self._magic = False
+        self._header = bytearray()
+        # the current member: its size, the bytes left of it (and its padding),
+        # and its content so far (None if it isn't kept).
+        self._size = 0
+        self._remaining = 0
+        self._data: Optional[bytearray] = None
+
+    def _end_member(self):
+        if self._data is not None:
+            self.members[self.names[-1]] = bytes(self._data)
+            self._data = None
+
+    def _start_member(self, header: bytes):
+        if header[58:60] != AR_HEADER_END:
+            raise IngestError("invalid ar member header")
+
+        try:
+            name = header[:16].decode("ascii").strip()
+            size = int(header[48:58])
+        except ValueError:
+            raise IngestError("invalid ar member header")
+
+        # GNU ar ends names with a slash.
+        name = name.rstrip("/")
+        self.names.append(name)
+
+        self._size = size
+        # members are padded to an even size.
+        self._remaining = size + size % 2
+        self._data = bytearray() if self._keep(name) else None
+
+        if not size:
+            self._end_member()
+
+    def feed(self, data: bytes):
+        """Parse the next bytes of the archive.
+
+        Raises:
+            IngestError, if the archive is invalid.
+        """
+
+        view = memoryview(data)
+
+        while view:
+            if self._remaining:
+                n = min(self._remaining, len(view))
+                if self._data is not None:
+                    self._data += view[: max(0, min(n, self._size - len(self._data)))]
+
+                self._remaining -= n
+                view = view[n:]
+
+                if len(self._data or ()) == self._size:
+                    self._end_member()
+                continue
+
+            expected = AR_HEADER_SIZE if self._magic else len(AR_MAGIC)
+            take = view[: expected - len(self._header)]
+            self._header += take
+            view = view[len(take) :]
+
+            if len(self._header) < expected:
+                break
+
+            header, self._header = bytes(self._header), bytearray()
+
+            if not self._magic:
+                if header != AR_MAGIC:
+                    raise IngestError("not an ar archive")
+                self._magic = True
+            else:
+                self._start_member(header)
+
+    def close(self):
+        """Check that the archive ended after a complete member.
+
+        Raises:
+            IngestError, if the archive was cut off.
+        """
+
+        # (the padding of the last member may be left out)
+        if not self._magic or self._header or self._remaining > self._size % 2:
+            raise IngestError("archive ended early")
+        self._end_member()
+
+
+def parse_control(name: str, data: bytes) -> Fields:
+    """Get the control fields from a control archive (control.tar.{gz,xz,bz2}).
+
+    Args:
+        name: The name of the archive member.
+        data: The content of the archive member.
+
+    Returns:
+        The control fields.
+
+    Raises:
+        IngestError, if the archive is invalid or has no (valid) control file.
+    """
+
+    try:
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:*") as tar:
+            member = next(
+                (m for m in tar.getmembers() if os.path.basename(m.name) == "control"), None
+            )
+            if member is None:
+                raise IngestError(f"no control file in {name}")
+
+            control = tar.extractfile(member).read()  # type: ignore
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise IngestError(f"can't read {name}: {e}") from e
+
+    try:
+        text = control.decode("utf8")
+    except UnicodeDecodeError as e:
+        raise IngestError(f"control file in {name} is not UTF-8: {e}") from e
+
+    message = email.message_from_string(text)
+
+    missing = [h for h in pydpkg.REQUIRED_HEADERS if h not in map(str.lower, message.keys())]
+    if missing:
+        raise IngestError(f"missing control fields: {', '.join(missing)}")
+
+    return tuple(message.items())
+
+
+def copy_deb(
+    stream: IO[bytes], out: IO[bytes], hashes: Iterable[str] = utils.FILEINFO_HASHES
+) -> Tuple[Fields, dict]:
+    """Copy a Debian package file from a stream to a file,
+    hashing it and parsing its control fields on the way.
+
+    Args:
+        stream: The binary stream to read from (until EOF).
+        out: The binary file to write to.
+        hashes: The names of the hashes to compute. Defaults to FILEINFO_HASHES.
+
+    Returns:
+        A tuple of (control fields, file info of the package file).
+
+    Raises:
+        IngestError, if the stream is not a valid package file.
+    """
+
+    sink = utils.HashingWriter(out, hashes)
+    parser = ArParser(lambda name: name.startswith(CONTROL_PREFIX))
+
+    while True:
+        chunk = stream.read(CHUNKSIZE)
+        if not chunk:
+            break
+
+        parser.feed(chunk)
+        sink.write(chunk)
+
+    parser.close()
+
+    control = next((n for n in parser.names if n.startswith(CONTROL_PREFIX)), None)
+    if control is None:
+        raise IngestError("no control archive in the package file")
+
+    return parse_control(control, parser.members[control]), sink.fileinfo()
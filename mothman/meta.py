@@ -0,0 +1,118 @@
+# coding: utf8
+"""Sidecar metadata of packages (price, header image, screenshots, etc.),
+passed to depictions as other_info (see mothman.depictions.Generic).
+
+Metadata is read from a folder (by default 'meta' in the repo root):
+
+    meta/packages.json  # (optional) a map of package names to their metadata
+    meta/<package>.json  # (optional) the metadata of a single package
+
+If both exist for a package, the keys in <package>.json take precedence.
+"""
+
+import json
+import logging
+import os
+import pathlib
+from typing import Dict, Optional, Tuple
+
+from mothman.utils import Path
+
+__all__ = ["MetaError", "MetaStore"]
+
+_log = logging.getLogger("mothman")
+
+# the name of the combined metadata map (in the metadata folder).
+MAP_NAME = "packages.json"
+
+# (mtime, size) of a metadata file, or None if it does not exist.
+Stamp = Optional[Tuple[int, int]]
+
+
+class MetaError(Exception):
+    pass
+
+
+class MetaStore:
+    """A lazy loader for sidecar metadata.
+    Files are only read when they are first needed, and read again only if their
+    mtime/size changed.
+
+    Args:
+        folder: The folder with the metadata files.
+
+    Attributes:
+        folder (pathlib.Path): See Args.
+    """
+
+    def __init__(self, folder: Path):
+        self.folder = pathlib.Path(folder)
+        # path -> (stamp, data)
+        self._files: Dict[str, Tuple[Stamp, dict]] = {}
+
+    @staticmethod
+    def _stamp(path: pathlib.Path) -> Stamp:
+        try:
+            stat = path.stat()
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+
+        return stat.st_mtime_ns, stat.st_size
+
+    def _load(self, path: pathlib.Path) -> Tuple[Stamp, dict]:
+        stamp = self._stamp(path)
+        cached = self._files.get(str(path))
+
+        if cached is not None and cached[0] == stamp:
+            return cached
+
+        if stamp is None:
+            data: dict = {}
+        else:
+            _log.debug("[%s] loading metadata", path.name)
+            try:
+                with path.open(encoding="utf8") as f:
+                    data = json.load(f)
+            except ValueError as e:
+                raise MetaError(f"invalid metadata file {path}: {e}") from e
+
+            if not isinstance(data, dict):
+                raise MetaError(f"invalid metadata file {path}: must be a JSON object")
+
+        self._files[str(path)] = (stamp, data)
+        return stamp, data
+
+    def _paths(self, package: str) -> Tuple[pathlib.Path, pathlib.Path]:
+        # a package name can't have a path seperator, but be careful anyway.
+        return self.folder / MAP_NAME, self.folder / f"{os.path.basename(package)}.json"
+
+    def stamp(self, package: str) -> Tuple[Stamp, Stamp]:
+        """Get the stamps of a package's metadata files (without reading them).
+        If the stamps change, the metadata may have changed.
+
+        Args:
+            package: The name of the package.
+        """
+
+        map_path, path = self._paths(package)
+        return self._stamp(map_path), self._stamp(path)
+
+    def get(self, package: str) -> dict:
+        """Get the metadata of a package.
+
+        Args:
+            package: The name of the package.
+
+        Returns:
+            The metadata as a dict (empty if there is no metadata for the package).
+
+        Raises:
+            MetaError, if a metadata file is not valid.
+        """
+
+        map_path, path = self._paths(package)
+
+        metadata = dict(self._load(map_path)[1].get(package) or {})
+        metadata.update(self._load(path)[1])
+
+        return metadata
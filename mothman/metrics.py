@@ -0,0 +1,249 @@
+# coding: utf8
+"""Progress and metrics of long-running operations (scanning and building repos).
+
+Progress is reported as throttled events (with rates and an ETA) instead of a log
+message per package, and metrics of the last build can be written in the
+Prometheus textfile format (i.e for node_exporter's textfile collector).
+"""
+
+import contextlib
+import logging
+import threading
+import time
+from typing import Callable, Dict, Generator, NamedTuple, Optional, Tuple
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["Event", "Metrics", "log_event"]
+
+_log = logging.getLogger("mothman")
+
+# the minimum seconds between progress events of the same stage.
+PROGRESS_INTERVAL = 0.5
+
+# metric names to their (type, help).
+METRICS = {
+    "mothman_build_duration_seconds": ("gauge", "How long the last build took."),
+    "mothman_build_timestamp_seconds": ("gauge", "When the last build finished (Unix time)."),
+    "mothman_packages": ("gauge", "Unique packages in Packages."),
+    "mothman_package_files": ("gauge", "Package files in Packages."),
+    "mothman_package_bytes": ("gauge", "Total size of the package files in Packages."),
+    "mothman_stanzas_rebuilt": ("gauge", "Packages serialised again in the last build."),
+    # (of the last scan of a folder, not since the process started: these are not counters)
+    "mothman_scan_cache_hits": ("gauge", "Package files in the scan cache (last scan)."),
+    "mothman_scan_cache_misses": ("gauge", "Package files not in the scan cache (last scan)."),
+    "mothman_scan_hashed_bytes": ("gauge", "Bytes of package files hashed (last scan)."),
+    "mothman_depictions_rendered": ("gauge", "Depictions rendered in the last build."),
+    "mothman_index_bytes": ("gauge", "Size of each index file."),
+    "mothman_compression_ratio": ("gauge", "Uncompressed size / compressed size of Packages."),
+    "mothman_stage_duration_seconds": ("gauge", "How long each stage of the last build took."),
+    "mothman_stage_items": ("gauge", "Items processed by each stage of the last build."),
+    "mothman_stage_bytes": ("gauge", "Bytes processed by each stage of the last build."),
+}
+
+# (metric name, sorted (label, value) pairs)
+_Key = Tuple[str, Tuple[Tuple[str, str], ...]]
+
+
+def _escape(value: str) -> str:
+    # escape a label value for the text format.
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Event(NamedTuple):
+    """The progress of a stage.
+
+    Attributes:
+        stage (str): The name of the stage, i.e 'scan' or 'stanzas'.
+        done (int): Items done so far.
+        total (int): Total items.
+        size (int): Bytes processed so far.
+        elapsed (float): Seconds since the stage started.
+    """
+
+    stage: str
+    done: int
+    total: int
+    size: int
+    elapsed: float
+
+    @property
+    def rate(self) -> float:
+        """Items per second."""
+        return self.done / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def byte_rate(self) -> float:
+        """Bytes per second."""
+        return self.size / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Estimated seconds until the stage is done (None if unknown)."""
+        if not self.rate:
+            return None
+        return (self.total - self.done) / self.rate
+
+    def __str__(self) -> str:
+        eta = self.eta
+        return "[{}] {}/{} ({:.0%}), {:.0f} items/s, {:.2f} MiB/s, ETA {}".format(
+            self.stage,
+            self.done,
+            self.total,
+            self.done / self.total if self.total else 1,
+            self.rate,
+            self.byte_rate / (1 << 20),
+            "?" if eta is None else f"{eta:.1f}s",
+        )
+
+
+Listener = Callable[[Event], None]
+
+
+def log_event(event: Event):
+    """A listener that logs progress events (at info level)."""
+    _log.info("%s", event)
+
+
+class Metrics:
+    """Progress of the stages of an operation, and metrics about it.
+    This is thread-safe.
+
+    Args:
+        listener: If not None, called with progress events (see Event),
+            from the thread doing the work.
+            Each stage is reported at most once per interval, and when it is done.
+            Defaults to None.
+        interval: The minimum seconds between events of the same stage.
+            Defaults to PROGRESS_INTERVAL.
+
+    Attributes:
+        listener: See Args.
+        interval: See Args.
+    """
+
+    def __init__(self, listener: Optional[Listener] = None, interval: float = PROGRESS_INTERVAL):
+        self.listener = listener
+        self.interval = interval
+
+        self._lock = threading.Lock()
+        # stage -> [start, last event, done, size]
+        self._stages: Dict[str, list] = {}
+        self._values: Dict[_Key, float] = {}
+
+    def progress(self, stage: str, done: int, total: int, size: int = 0):
+        """Record the progress of a stage.
+        A stage starts over if done is not more than the last time.
+
+        Args:
+            stage: The name of the stage.
+            done: Items done so far.
+            total: Total items.
+            size: Bytes processed since the last call. Defaults to 0.
+        """
+
+        now = time.monotonic()
+
+        with self._lock:
+            state = self._stages.get(stage)
+            if state is None or done <= state[2]:
+                # (the first event is after an interval too, so it has a rate)
+                state = self._stages[stage] = [now, now, 0, 0]
+
+            state[2] = done
+            state[3] += size
+
+            if self.listener is None:
+                return
+            if done < total and now - state[1] < self.interval:
+                return
+
+            state[1] = now
+            event = Event(stage, done, total, state[3], now - state[0])
+
+        self.listener(event)
+
+    @contextlib.contextmanager
+    def listening(self, listener: Optional[Listener]) -> Generator[None, None, None]:
+        """Send progress events to another listener for a while.
+
+        Args:
+            listener: The listener. If None, the listener is not changed.
+        """
+
+        if listener is None:
+            yield
+            return
+
+        old, self.listener = self.listener, listener
+        try:
+            yield
+        finally:
+            self.listener = old
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, str]) -> _Key:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def set(self, name: str, value: float, **labels: str):
+        """Set a metric.
+
+        Args:
+            name: The name of the metric (see METRICS).
+            value: The value.
+            **labels: The labels of the metric, if any.
+        """
+
+        with self._lock:
+            self._values[self._key(name, labels)] = value
+
+    def inc(self, name: str, value: float = 1, **labels: str):
+        """Add to a metric (see set())."""
+
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, name: str, **labels: str) -> float:
+        """Get a metric (0 if it was never set)."""
+
+        with self._lock:
+            return self._values.get(self._key(name, labels), 0)
+
+    def textfile(self) -> str:
+        """Get the metrics in the Prometheus text format."""
+
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = []
+        last_name = None
+
+        for (name, labels), value in values:
+            if name != last_name:
+                metric_type, help_text = METRICS.get(name, ("untyped", ""))
+                lines.append(f"# HELP {name} {help_text}")
+                lines.append(f"# TYPE {name} {metric_type}")
+                last_name = name
+
+            label_text = ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels)
+            if label_text:
+                label_text = "{" + label_text + "}"
+
+            if float(value).is_integer():
+                value = int(value)
+            lines.append(f"{name}{label_text} {value}")
+
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path: Path):
+        """Write the metrics in the Prometheus text format (atomically,
+        so the textfile collector never reads a half-written file).
+
+        Args:
+            path: The path to the file (should end with '.prom').
+        """
+
+        with utils.open_atomic(path) as f:
+            f.write(self.textfile())
@@ -0,0 +1,367 @@
+# coding: utf8
+"""Mirror (import) an existing Cydia/Debian flat repository.
+"""
+
+import concurrent.futures
+import email
+import email.message
+import hashlib
+import io
+import logging
+import os
+import pathlib
+import posixpath
+import shutil
+import tempfile
+from typing import Dict, Generator, List, Optional
+
+import requests
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["Mirror", "MirrorError"]
+
+_log = logging.getLogger("mothman")
+
+# Packages formats to try, most compressed first.
+PACKAGES_FORMATS = (utils.XZ, utils.BZIP2, utils.GZIP, utils.CAT)
+
+CHUNKSIZE = 65536
+
+# results of downloading a package file.
+SKIPPED = "skipped"
+DOWNLOADED = "downloaded"
+RESUMED = "resumed"
+
+
+class MirrorError(Exception):
+    pass
+
+
+class Mirror:
+    """A mirror of a remote repository.
+
+    Args:
+        url: The base URL of the remote repository (where Release/Packages are).
+        root: The path to mirror into.
+        deb_path: The folder (relative to root) to download package files to.
+            If None, the remote layout (the Filename field) is kept.
+            Defaults to None.
+        workers: How many package files to download at once. Defaults to 8.
+        session: The session to make requests with. If None, a new session is created
+            with a connection pool big enough for all workers. Defaults to None.
+
+    Attributes:
+        url (str): See Args.
+        root (pathlib.Path): See Args.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        root: Path,
+        deb_path: Optional[str] = None,
+        workers: int = 8,
+        session: Optional[requests.Session] = None,
+    ):
+        self.url = url.rstrip("/") + "/"
+        self.root = pathlib.Path(root).resolve()
+        self._deb_path = deb_path
+        self._workers = workers
+
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=workers, pool_maxsize=workers
+            )
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+
+        self._session = session
+        self._release: Optional[email.message.Message] = None
+
+    def _get(self, path: str, **kwargs) -> requests.Response:
+        return self._session.get(self.url + path, stream=True, timeout=30, **kwargs)
+
+    def fetch_release(self) -> Optional[email.message.Message]:
+        """Fetch the remote Release file.
+
+        Returns:
+            The Release file as a Message object, or None if the remote repo has no Release.
+        """
+
+        _log.info("[Release] fetching from %s", self.url)
+
+        with self._get("Release") as response:
+            if response.status_code == 404:
+                _log.warning("[Release] not found, Packages will not be verified")
+                return None
+            response.raise_for_status()
+            self._release = email.message_from_string(response.text)
+
+        return self._release
+
+    def _release_digest(self, filename: str, name: str = "sha256") -> Optional[str]:
+        # look up the digest of an index file in Release.
+        if self._release is None:
+            return None
+
+        field = self._release.get(utils.RELEASE_FIELDS[name])
+        if field is None:
+            return None
+
+        for line in field.splitlines():
+            parts = line.split()
+            if len(parts) == 3 and parts[2] == filename:
+                return parts[0]
+
+        return None
+
+    def fetch_packages(self) -> Generator[email.message.Message, None, None]:
+        """Fetch and parse the remote Packages file, one stanza at a time.
+        The most compressed format available is used.
+        If the remote repo has a Release file, the Packages file is verified against it
+        before any stanzas are yielded (it is downloaded to a temporary file first).
+
+        Yields:
+            Each stanza as a Message object.
+
+        Raises:
+            MirrorError, if no Packages file was found or it does not match Release.
+        """
+
+        # (if Release has hashes, Packages files it doesn't list can't be verified)
+        listed = self._release is not None and utils.RELEASE_FIELDS["sha256"] in self._release
+
+        for fmt in PACKAGES_FORMATS:
+            filename = f"Packages{fmt}"
+
+            expected = self._release_digest(filename)
+            if listed and expected is None:
+                _log.warning("[%s] not listed in Release, not using it", filename)
+                continue
+
+            with tempfile.TemporaryFile() as temp:
+                with self._get(filename) as response:
+                    if response.status_code == 404:
+                        continue
+                    response.raise_for_status()
+
+                    _log.info("[%s] fetching", filename)
+
+                    # don't let requests decode a Content-Encoding (we want the raw file).
+                    response.raw.decode_content = False
+                    reader = utils.HashingReader(response.raw, ["sha256"])  # type: ignore
+                    shutil.copyfileobj(reader, temp, CHUNKSIZE)
+
+                # nothing in the Packages file is used (or downloaded) until it matches Release.
+                if expected is None:
+                    _log.warning("[%s] no hash in Release, can't verify it", filename)
+                actual = reader.fileinfo()["sha256"]
+                if expected is not None and expected != actual:
+                    raise MirrorError(
+                        f"{filename} does not match Release (expected {expected}, got {actual})"
+                    )
+
+                temp.seek(0)
+                with io.TextIOWrapper(
+                    utils._decompressor(fmt, temp), encoding="utf8"  # type: ignore
+                ) as f:
+                    yield from utils.iter_paragraphs(f)
+
+            return
+
+        raise MirrorError(f"no Packages file found at {self.url}")
+
+    def _destination(self, filename: str) -> pathlib.Path:
+        filename = posixpath.normpath(filename)
+        if filename.startswith("/") or ".." in filename.split("/"):
+            raise MirrorError(f"refusing to download {filename} outside of the mirror")
+
+        if self._deb_path is not None:
+            return self.root / self._deb_path / posixpath.basename(filename)
+
+        return self.root / filename
+
+    def download(self, stanza: email.message.Message) -> str:
+        """Download the package file of a stanza, verifying its size and SHA256 (if given).
+        If the file already exists with the same digest, it is skipped.
+        If a partial download exists, it is resumed.
+
+        Args:
+            stanza: The package's stanza in the remote Packages file.
+
+        Returns:
+            One of the module-level constants SKIPPED, DOWNLOADED or RESUMED.
+
+        Raises:
+            MirrorError, if the downloaded file does not match the stanza.
+        """
+
+        filename = stanza["Filename"]
+        size = int(stanza["Size"]) if stanza["Size"] else None
+        expected = stanza["SHA256"]
+
+        path = self._destination(filename)
+
+        if (
+            path.is_file()
+            and (size is None or path.stat().st_size == size)
+            and (
+                expected is None
+                or utils.fileinfo(path, hashes=["sha256"])["sha256"] == expected
+            )
+        ):
+            _log.debug("[%s] already mirrored", path.name)
+            return SKIPPED
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        part_path = path.with_name(path.name + ".part")
+
+        sha256 = hashlib.sha256()
+        offset = part_path.stat().st_size if part_path.is_file() else 0
+
+        if size is not None and offset > size:
+            # can't be the same file.
+            offset = 0
+
+        if offset and offset == size:
+            # the download finished, but the file wasn't verified (asking for the rest
+            # would be out of range).
+            _log.debug("[%s] already downloaded, verifying", path.name)
+            self._hash_part(part_path, sha256)
+            result = RESUMED
+        else:
+            result = self._fetch(filename, path, part_path, offset, sha256)
+
+        actual_size = part_path.stat().st_size
+        actual = sha256.hexdigest()
+
+        if (size is not None and actual_size != size) or (
+            expected is not None and actual != expected
+        ):
+            part_path.unlink()
+            raise MirrorError(
+                f"{filename} does not match Packages "
+                f"(expected {expected} ({size} bytes), got {actual} ({actual_size} bytes))"
+            )
+
+        os.replace(part_path, path)
+        return result
+
+    @staticmethod
+    def _hash_part(part_path: pathlib.Path, sha256):
+        with part_path.open("rb") as f:
+            for chunk in iter(lambda: f.read(CHUNKSIZE), b""):
+                sha256.update(chunk)
+
+    def _fetch(
+        self, filename: str, path: pathlib.Path, part_path: pathlib.Path, offset: int, sha256
+    ) -> str:
+        # download a package file to part_path (resuming from offset), hashing it.
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        with self._get(filename, headers=headers) as response:
+            if offset and response.status_code == 416:
+                # nothing left to download (the size wasn't known).
+                self._hash_part(part_path, sha256)
+                return RESUMED
+
+            response.raise_for_status()
+
+            if offset and response.status_code == 206:
+                # hash what we already have first.
+                self._hash_part(part_path, sha256)
+                mode = "ab"
+                result = RESUMED
+            else:
+                # server ignored the range, start over.
+                mode = "wb"
+                result = DOWNLOADED
+
+            _log.info("[%s] downloading", path.name)
+            with part_path.open(mode) as f:
+                for chunk in response.iter_content(CHUNKSIZE):
+                    sha256.update(chunk)
+                    f.write(chunk)
+
+        return result
+
+    def run(self) -> Dict[str, List[str]]:
+        """Mirror the remote repository: fetch Release and Packages,
+        then download all package files concurrently.
+        If there is no local Release file, the remote one is copied (without hashes).
+
+        Returns:
+            A dict of results (SKIPPED, DOWNLOADED, RESUMED or 'failed')
+            to the filenames with that result.
+        """
+
+        self.root.mkdir(parents=True, exist_ok=True)
+        release = self.fetch_release()
+
+        release_path = self.root / "Release"
+        if release is not None and not release_path.exists():
+            # (a copy, as the hashes are still needed to verify Packages)
+            release = email.message_from_string(str(release))
+            for field in set(utils.RELEASE_FIELDS.values()):
+                del release[field]
+
+            with release_path.open("w") as f:
+                f.write(str(release))
+
+        results: Dict[str, List[str]] = {
+            SKIPPED: [],
+            DOWNLOADED: [],
+            RESUMED: [],
+            "failed": [],
+        }
+
+        # one download per destination, so two threads never write the same file.
+        stanzas: Dict[pathlib.Path, email.message.Message] = {}
+        for stanza in self.fetch_packages():
+            filename = stanza["Filename"]
+            if not filename:
+                continue
+
+            try:
+                path = self._destination(filename)
+            except MirrorError as e:
+                _log.error("[%s] failed to mirror: %s", filename, e)
+                results["failed"].append(filename)
+                continue
+
+            first = stanzas.setdefault(path, stanza)
+            if first is not stanza and first["SHA256"] != stanza["SHA256"]:
+                # (i.e two folders with a file of the same name, and deb_path is set)
+                _log.error(
+                    "[%s] failed to mirror: %s is also the destination of %s",
+                    filename,
+                    path,
+                    first["Filename"],
+                )
+                results["failed"].append(filename)
+
+        with concurrent.futures.ThreadPoolExecutor(self._workers) as pool:
+            futures = {
+                pool.submit(self.download, stanza): stanza["Filename"]
+                for stanza in stanzas.values()
+            }
+
+            for future in concurrent.futures.as_completed(futures):
+                filename = futures[future]
+                try:
+                    results[future.result()].append(filename)
+                except (MirrorError, requests.RequestException, OSError) as e:
+                    _log.error("[%s] failed to mirror: %s", filename, e)
+                    results["failed"].append(filename)
+
+        _log.info(
+            "mirrored %s package file(s) (%s skipped, %s failed)",
+            len(results[DOWNLOADED]) + len(results[RESUMED]),
+            len(results[SKIPPED]),
+            len(results["failed"]),
+        )
+
+        return results
@@ -0,0 +1,274 @@
+# coding: utf8
+"""Publish a built repo to another folder (i.e a web root on a mounted volume),
+copying only the files that changed since it was last published there.
+
+A manifest of the published files and their SHA256 digests is kept at the destination,
+so the destination never has to be read back to find out what changed.
+Package files and depictions are copied first (in parallel), then the index files,
+so the published indexes never refer to files that are not there yet.
+Files that are no longer in the repo are deleted last.
+"""
+
+import concurrent.futures
+import fnmatch
+import json
+import logging
+import os
+import pathlib
+import shutil
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["PublishError", "digests", "publish"]
+
+_log = logging.getLogger("mothman")
+
+# digests of the repo's files, keyed by (size, mtime) (relative to the root).
+DIGESTS_PATH = ".mothman/digests.json"
+# the manifest of published files (relative to the destination).
+MANIFEST_PATH = ".mothman/published.json"
+
+# index files, in the order they are published (Release last).
+INDEX_PATTERNS = ("Packages*", "Release", "Release.gpg", "InRelease")
+
+CHUNKSIZE = 1 << 20
+
+
+class PublishError(Exception):
+    pass
+
+
+def _load_json(path: pathlib.Path) -> dict:
+    try:
+        with path.open() as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def _save_json(path: pathlib.Path, data: dict):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with utils.open_atomic(path) as f:
+        json.dump(data, f, sort_keys=True)
+
+
+def _index_order(name: str) -> Optional[int]:
+    # the position of a file in INDEX_PATTERNS, or None if it is not an index file.
+    return next(
+        (i for i, pattern in enumerate(INDEX_PATTERNS) if fnmatch.fnmatch(name, pattern)),
+        None,
+    )
+
+
+def _walk(root: pathlib.Path, exclude: Iterable[str]) -> List[str]:
+    # all files in the repo (as posix paths relative to the root),
+    # skipping hidden files/folders (i.e .mothman, .git) and excluded files.
+    files = []
+
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+        folder = pathlib.Path(dirpath).relative_to(root)
+
+        for filename in sorted(filenames):
+            relpath = (folder / filename).as_posix()
+            if filename.startswith(".") or any(fnmatch.fnmatch(relpath, p) for p in exclude):
+                continue
+            files.append(relpath)
+
+    return files
+
+
+def digests(
+    root: Path,
+    pool: concurrent.futures.Executor,
+    exclude: Iterable[str] = (),
+) -> Dict[str, str]:
+    """Get the SHA256 digests of all files in a repo.
+    Digests are cached (in .mothman/digests.json) by file size and mtime,
+    so only new/changed files are hashed.
+
+    Args:
+        root: The root of the repo.
+        pool: The executor to hash files in.
+        exclude: Glob patterns of files (relative to the root) to leave out.
+            Defaults to ().
+
+    Returns:
+        A dict of paths (relative to the root) to their hex digests.
+    """
+
+    root = pathlib.Path(root)
+    cache_path = root / DIGESTS_PATH
+    cached = _load_json(cache_path)
+
+    # path -> [size, mtime, digest]
+    entries: Dict[str, list] = {}
+    missing: List[str] = []
+
+    for relpath in _walk(root, exclude):
+        # (index files may be symlinks into a generation, the target is what counts)
+        try:
+            stat = (root / relpath).stat()
+        except FileNotFoundError:
+            # i.e a stale Packages.* link to a pruned generation.
+            _log.warning("[%s] broken symlink, skipping", relpath)
+            continue
+        entry = cached.get(relpath)
+
+        if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+            entries[relpath] = entry
+        else:
+            entries[relpath] = [stat.st_size, stat.st_mtime_ns, None]
+            missing.append(relpath)
+
+    if missing:
+        _log.info("hashing %s new/changed file(s)", len(missing))
+
+        hashed = pool.map(
+            lambda relpath: utils.fileinfo(root / relpath, CHUNKSIZE, ("sha256",))["sha256"],
+            missing,
+        )
+        for relpath, digest in zip(missing, hashed):
+            entries[relpath][2] = digest
+
+    if missing or len(entries) != len(cached):
+        _save_json(cache_path, entries)
+
+    return {relpath: entry[2] for relpath, entry in entries.items()}
+
+
+def _copy(src: pathlib.Path, dst: pathlib.Path):
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    with src.open("rb") as s, utils.open_atomic(dst, "wb") as d:
+        shutil.copyfileobj(s, d, CHUNKSIZE)
+
+
+def _delete(dst: pathlib.Path, dest: pathlib.Path):
+    try:
+        dst.unlink()
+    except FileNotFoundError:
+        return
+
+    # remove folders left empty (i.e the depictions of a removed package).
+    folder = dst.parent
+    while folder != dest:
+        try:
+            folder.rmdir()
+        except OSError:
+            break
+        folder = folder.parent
+
+
+def publish(
+    root: Path,
+    dest: Path,
+    workers: Optional[int] = None,
+    exclude: Iterable[str] = (),
+    dry_run: bool = False,
+) -> dict:
+    """Copy the files of a repo that changed since it was last published to dest.
+
+    Args:
+        root: The root of the repo.
+        dest: The folder to publish the repo to.
+        workers: The number of threads to hash/copy files with.
+            If None, the default of concurrent.futures.ThreadPoolExecutor is used.
+            Defaults to None.
+        exclude: Glob patterns of files (relative to the root) to not publish.
+            Hidden files/folders (i.e .mothman), the repo config and metadata sources
+            (see mothman.repo.private_patterns) are never published. Defaults to ().
+        dry_run: If True, only report what would be done. Defaults to False.
+
+    Returns:
+        A report as a dict (JSON-serialisable):
+        {
+            "copied": ["debs/example.deb", ...],  # new/changed files
+            "deleted": ["debs/old.deb", ...],  # files that are no longer in the repo
+            "unchanged": ...,  # number of unchanged files
+        }
+
+    Raises:
+        PublishError, if any file could not be copied
+            (the index files are then not published).
+    """
+
+    root = pathlib.Path(root).resolve()
+    dest = pathlib.Path(dest).resolve()
+
+    if dest == root or root in dest.parents:
+        raise PublishError(f"can't publish {root} into itself")
+
+    from mothman import repo
+
+    # (like 'serve', don't make the repo config and metadata sources public)
+    exclude = (*repo.private_patterns(_load_json(root / repo.CONFIG_NAME)), *exclude)
+
+    manifest_path = dest / MANIFEST_PATH
+    published = _load_json(manifest_path)
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        current = digests(root, pool, exclude)
+
+        changed = [p for p, digest in current.items() if published.get(p) != digest]
+        removed = [p for p in published if p not in current]
+
+        report: dict = {
+            "copied": changed,
+            "deleted": removed,
+            "unchanged": len(current) - len(changed),
+        }
+
+        _log.info(
+            "%s %s changed file(s), %s %s removed file(s) (%s unchanged)",
+            "would copy" if dry_run else "copying",
+            len(changed),
+            "would delete" if dry_run else "deleting",
+            len(removed),
+            report["unchanged"],
+        )
+
+        if dry_run:
+            return report
+
+        files = [p for p in changed if _index_order(p) is None]
+        indexes = sorted(
+            (p for p in changed if _index_order(p) is not None),
+            key=lambda p: (_index_order(p), p),
+        )
+
+        failed: List[Tuple[str, Exception]] = []
+        futures = {p: pool.submit(_copy, root / p, dest / p) for p in files}
+
+        for relpath, future in futures.items():
+            try:
+                future.result()
+            except OSError as e:
+                _log.error("[%s] failed to copy: %s", relpath, e)
+                failed.append((relpath, e))
+            else:
+                _log.debug("[%s] copied", relpath)
+                published[relpath] = current[relpath]
+
+        if failed:
+            # record what was copied, so it isn't copied again next time.
+            _save_json(manifest_path, published)
+            raise PublishError(
+                f"failed to copy {len(failed)} file(s), not publishing the index files"
+            )
+
+        # in order, so Release is only replaced once the files it lists are in place.
+        for relpath in indexes:
+            _log.info("[%s] publishing", relpath)
+            _copy(root / relpath, dest / relpath)
+            published[relpath] = current[relpath]
+
+        for relpath in removed:
+            _log.debug("[%s] deleting", relpath)
+            _delete(dest / relpath, dest)
+            del published[relpath]
+
+        _save_json(manifest_path, published)
+
+    return report
@@ -6,6 +6,8 @@ Modifications:
 - made pgpy import optional
 - (mypy) ignore imports for untyped modules imported
 - abstracted filesize property to util function
+- added version_key() for sorting without cmp_to_key
+- made pgpy/arpy/archive imports lazy (only needed when parsing), for faster startup
 """
 
 from __future__ import absolute_import
@@ -14,25 +16,15 @@ from __future__ import absolute_import
 import hashlib
 import io
 import logging
-import lzma
 import os
-import tarfile
 
 from collections import defaultdict
-from gzip import GzipFile
 from email import message_from_string, message_from_file
 from functools import cmp_to_key
 
 # pypi imports
 import six
 
-try:
-    import pgpy  # type: ignore
-except ImportError:
-    pgpy = None
-
-from arpy import Archive  # type: ignore
-
 from mothman.utils import fileinfo
 
 REQUIRED_HEADERS = ("package", "version", "architecture")
@@ -306,6 +298,12 @@ class Dpkg:
         return message
 
     def _process_dpkg_file(self, filename):
+        import lzma
+        import tarfile
+        from gzip import GzipFile
+
+        from arpy import Archive  # type: ignore
+
         dpkg_archive = Archive(filename)
         dpkg_archive.read_all_headers()
         if b"control.tar.gz" in dpkg_archive.archived_files:
@@ -573,6 +571,46 @@ class Dpkg:
         as a key."""
         return cmp_to_key(Dpkg.compare_versions)(x)
 
+    @staticmethod
+    def _order_key(part):
+        """Return a tuple of character weights for a non-digit part of a
+        version string, ordered like dstringcmp(): a tilde sorts before
+        anything (even the end of the part), then letters, then non-letters.
+        """
+        weights = []
+        for char in part:
+            if char == "~":
+                weights.append(-1)
+            elif char.isalpha():
+                weights.append(ord(char))
+            else:
+                weights.append(ord(char) + 256)
+        # the end of the part sorts after a tilde but before anything else.
+        weights.append(0)
+        return tuple(weights)
+
+    @staticmethod
+    def _revision_key(revision_str):
+        """Return a tuple key for a revision string, ordered like
+        compare_revision_strings()."""
+        key = [
+            Dpkg._order_key(item) if i % 2 == 0 else item
+            for i, item in enumerate(Dpkg.listify(revision_str))
+        ]
+        # pad with an empty part, so shorter revisions compare correctly
+        # against longer ones (including trailing tildes).
+        key.append((0,))
+        return tuple(key)
+
+    @staticmethod
+    def version_key(version_str):
+        """Return a plain tuple key for a Debian version string.
+        Comparing two keys gives the same result as compare_versions(), but
+        the key only has to be computed once per version, so sorting (or
+        heapq selection) is much cheaper than with compare_versions_key()."""
+        epoch, upstream, debian = Dpkg.split_full_version(str(version_str))
+        return epoch, Dpkg._revision_key(upstream), Dpkg._revision_key(debian)
+
     @staticmethod
     def dstringcmp_key(x):
         """Uses functools.cmp_to_key to convert the dstringcmp()
@@ -799,6 +837,8 @@ class Dsc:
         and return an email.Message object.  Attempt to extract the
         RFC822 message from an OpenPGP message if necessary."""
         self._log.debug("process_dsc_file()")
+        import pgpy  # type: ignore
+
         if not self.filename.endswith(".dsc"):
             self._log.debug(
                 "File %s does not appear to be a dsc file; pressing "
@@ -0,0 +1,273 @@
+# coding: utf8
+"""Compact, immutable package records and a flat sorted index of them.
+These replace keeping whole pydpkg.Dpkg objects around once a package has been scanned.
+"""
+
+import bisect
+import email.message
+import functools
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from mothman import pydpkg
+
+__all__ = ["PackageRecord", "PackageIndex", "version_key"]
+
+# version strings repeat a lot across packages, so only compute each key once.
+version_key = functools.lru_cache(maxsize=None)(pydpkg.Dpkg.version_key)
+
+Key = Tuple[str, str, str]
+
+
+class PackageRecord:
+    """The scanned info of a single Debian package file.
+
+    Args:
+        filename: The path to the package file.
+        fields: The control fields as a tuple of (name, value) pairs, in order.
+        digests: The digests of the package file as a tuple of (hash name, digest) pairs,
+            where digest is the raw digest (bytes).
+        size: The size of the package file in bytes.
+
+    Attributes:
+        filename (str): See Args.
+        fields (tuple): See Args.
+        digests (tuple): See Args.
+        size (int): See Args.
+    """
+
+    __slots__ = ("filename", "fields", "digests", "size")
+
+    def __init__(
+        self,
+        filename: str,
+        fields: Tuple[Tuple[str, str], ...],
+        digests: Tuple[Tuple[str, bytes], ...],
+        size: int,
+    ):
+        # field/hash names are shared by every record, so intern them.
+        fields = tuple((sys.intern(k), v) for k, v in fields)
+        digests = tuple((sys.intern(k), v) for k, v in digests)
+
+        for name, value in zip(self.__slots__, (filename, fields, digests, size)):
+            object.__setattr__(self, name, value)
+
+    @classmethod
+    def from_dpkg(cls, debinfo: pydpkg.Dpkg) -> "PackageRecord":
+        """Create a record from a Dpkg object (this parses and hashes the package file)."""
+
+        fileinfo = dict(debinfo.fileinfo)
+        size = fileinfo.pop("filesize")
+
+        return cls(
+            debinfo.filename,
+            tuple(debinfo.message.items()),
+            tuple((name, bytes.fromhex(digest)) for name, digest in fileinfo.items()),
+            size,
+        )
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"'{type(self).__name__}' object is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError(f"'{type(self).__name__}' object is immutable")
+
+    def __reduce__(self):
+        return (type(self), (self.filename, self.fields, self.digests, self.size))
+
+    def __repr__(self):
+        return f"<PackageRecord {self.debian_name}>"
+
+    def __eq__(self, other):
+        if not isinstance(other, PackageRecord):
+            return NotImplemented
+        return self.__reduce__() == other.__reduce__()
+
+    def __hash__(self):
+        return hash((self.filename, self.fields, self.digests, self.size))
+
+    def __contains__(self, field: str) -> bool:
+        return self.get(field) is not None
+
+    def __getitem__(self, field: str) -> str:
+        # control fields are case-insensitive (like email.message.Message).
+        field = field.lower()
+        for name, value in self.fields:
+            if name.lower() == field:
+                return value
+        raise KeyError(field)
+
+    def get(self, field: str, default: Optional[str] = None) -> Optional[str]:
+        """Get a control field, or default if it does not exist."""
+        try:
+            return self[field]
+        except KeyError:
+            return default
+
+    @property
+    def name(self) -> str:
+        return self["Package"]
+
+    @property
+    def version(self) -> str:
+        return self["Version"]
+
+    @property
+    def arch(self) -> str:
+        return self["Architecture"]
+
+    @property
+    def key(self) -> Key:
+        """The (name, version, arch) of this package."""
+        return self.name, self.version, self.arch
+
+    @property
+    def debian_name(self) -> str:
+        return "_".join(self.key)
+
+    @property
+    def hexdigests(self) -> Dict[str, str]:
+        """The digests of the package file as hex strings."""
+        return {name: digest.hex() for name, digest in self.digests}
+
+    @property
+    def message(self) -> email.message.Message:
+        """A new Message object with the control fields."""
+        msg = email.message.Message()
+        for name, value in self.fields:
+            msg[name] = value
+        return msg
+
+
+class PackageIndex:
+    """A flat index of package records, keyed by (name, version, arch).
+    Iterating over the index yields records by name (alphabetically),
+    then by version (latest first, and equal versions by their version string), then by arch.
+
+    The sort order is computed lazily, so adding many records at once is cheap.
+    """
+
+    def __init__(self):
+        self._records: Dict[Key, PackageRecord] = {}
+        # sorted keys, and a parallel list of their names (for bisecting).
+        self._order: Optional[List[Key]] = None
+        self._order_names: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self._records)
+
+    def __bool__(self) -> bool:
+        return bool(self._records)
+
+    def __contains__(self, name: str) -> bool:
+        start, end = self._range(name)
+        return start != end
+
+    def __iter__(self) -> Iterator[PackageRecord]:
+        for key in self._sorted():
+            yield self._records[key]
+
+    def _sorted(self) -> List[Key]:
+        if self._order is None:
+            # versions that compare equal but are spelled differently (i.e '1.0' and '0:1.0')
+            # are kept apart by the version string, so each version's records stay together.
+            order = sorted(self._records, key=lambda k: (k[1], k[2]))
+            order.sort(key=lambda k: version_key(k[1]), reverse=True)
+            order.sort(key=lambda k: k[0])
+            self._order = order
+            self._order_names = [k[0] for k in order]
+        return self._order
+
+    def _range(self, name: str) -> Tuple[int, int]:
+        self._sorted()
+        return (
+            bisect.bisect_left(self._order_names, name),
+            bisect.bisect_right(self._order_names, name),
+        )
+
+    def add(self, record: PackageRecord) -> Optional[PackageRecord]:
+        """Add a record to the index.
+
+        Args:
+            record: The record to add.
+
+        Returns:
+            The record with the same (name, version, arch) that was replaced, if any.
+        """
+
+        key = record.key
+        old = self._records.get(key)
+        self._records[key] = record
+
+        if old is None:
+            self._order = None
+
+        return old
+
+    def get(self, name: str, version: str, arch: str) -> Optional[PackageRecord]:
+        """Get the record for a package, or None if it is not in the index."""
+        return self._records.get((name, version, arch))
+
+    def remove(
+        self, name: str, version: Optional[str] = None, arch: Optional[str] = None
+    ) -> List[PackageRecord]:
+        """Remove records from the index.
+
+        Args:
+            name: The name of the package.
+            version: If not None, only records of this version are removed.
+            arch: If not None, only records of this arch are removed.
+
+        Returns:
+            The removed records.
+        """
+
+        # removing keys keeps the rest of the order sorted, so do it in place.
+        start, end = self._range(name)
+        kept: List[Key] = []
+        removed = []
+
+        for key in self._order[start:end]:  # type: ignore
+            if (version is None or key[1] == version) and (arch is None or key[2] == arch):
+                removed.append(self._records.pop(key))
+            else:
+                kept.append(key)
+
+        self._order[start:end] = kept  # type: ignore
+        self._order_names[start:end] = [k[0] for k in kept]
+
+        return removed
+
+    def names(self) -> List[str]:
+        """The unique package names in the index, sorted alphabetically."""
+        self._sorted()
+        names: List[str] = []
+        for name in self._order_names:
+            if not names or names[-1] != name:
+                names.append(name)
+        return names
+
+    def versions(self, name: str) -> List[str]:
+        """The versions of a package in the index, latest first."""
+        start, end = self._range(name)
+        versions: List[str] = []
+        seen = set()
+        for _, version, _ in self._order[start:end]:  # type: ignore
+            if version not in seen:
+                seen.add(version)
+                versions.append(version)
+        return versions
+
+    def records(self, name: str, version: Optional[str] = None) -> List[PackageRecord]:
+        """The records of a package (latest version first).
+
+        Args:
+            name: The name of the package.
+            version: If not None, only records of this version are returned.
+        """
+        start, end = self._range(name)
+        return [
+            self._records[k]
+            for k in self._order[start:end]  # type: ignore
+            if version is None or k[1] == version
+        ]
@@ -3,20 +3,38 @@
 If you want a 'classical' Debian repository, see mothman.tree.DebianTree.
 """
 
+import contextlib
 import email
 import email.message
+import filecmp
+import hashlib
 import json
 import logging
+import pathlib
 import re
-from typing import Generator, Optional
+import shutil
+import time
+from typing import TYPE_CHECKING, Dict, Generator, List, Optional, Set, Tuple, Type
 
-from mothman import depictions, tree
+from mothman import depictions, history, meta, tree, utils
 
-__all__ = ["Repository"]
+# (only imported when building, see benchmarks/importtime.py)
+if TYPE_CHECKING:
+    import concurrent.futures
+
+__all__ = ["Repository", "private_patterns"]
 
 _log = logging.getLogger("mothman")
 
 CONFIG_NAME = "mothman.json"
+# where the combined depictions manifest is written by default (relative to the root).
+MANIFEST_PATH = "depictions/manifest.json"
+# where package metadata is read from by default (see mothman.meta).
+META_PATH = "meta"
+# where files extracted from packages (icons, screenshots) are written (relative to the root).
+ASSETS_PATH = "depictions/assets"
+# fingerprints of the inputs of rendered depictions (so unchanged ones are skipped).
+RENDERED_PATH = ".mothman/depictions.json"
 # config for repo templates (paths to depictions, etc.)
 # all urls are relative to the root.
 TEMPLATES = {
@@ -34,6 +52,18 @@ TEMPLATES = {
         },
         # where the debian packages are
         "deb_path": "debians",
+        # hashes of packages to add to the Packages file
+        # (optional, see mothman.utils.PACKAGES_FIELDS for supported hashes)
+        # "digests": ["sha256", "sha512"],
+        # write compact depictions with .gz siblings, and a combined manifest
+        # of all packages (optional, for static hosting)
+        # "compact": true,
+        # "manifest": "depictions/manifest.json",
+        # folder with package metadata for depictions (optional, see mothman.meta)
+        # "meta": "meta",
+        # extract icons/screenshots referenced as file:// URLs from the packages,
+        # for use in depictions (optional, see mothman.assets)
+        # "assets": true,
         # apt config (if any)
         "apt.conf": "assets/repo/repo.conf",
         # files/folders that are not needed
@@ -70,6 +100,22 @@ TEMPLATES = {
 RE_DECL = re.compile(r"^\s*([a-zA-Z]+) (\".+\"|.+);$", re.MULTILINE)
 
 
+def private_patterns(template: Optional[dict] = None) -> Tuple[str, ...]:
+    """Get glob patterns of the files in a repo that only builds read
+    (the config and the metadata sources), so they are never published or served.
+
+    Args:
+        template: The config of the repo. If None, the default paths are used.
+            Defaults to None.
+
+    Returns:
+        The patterns (relative to the root).
+    """
+
+    meta_path = (template or {}).get("meta", META_PATH).strip("/")
+    return (CONFIG_NAME, f"{meta_path}/*")
+
+
 class Repository(tree.DebianTree):
     """A Cydia/Sileo repository.
 
@@ -79,10 +125,32 @@ class Repository(tree.DebianTree):
         template: The repo template as a dict (see TEMPLATES for an example).
             If None, template will be loaded from mothman.json
             (in the repo root).
+        compact: Whether or not to write compact depictions (with gzipped copies),
+            and a combined manifest of all depictions.
+            If None, the template's 'compact' is used (if any). Defaults to None.
+        workers: The number of threads used to render depictions.
+            If None, the default of concurrent.futures.ThreadPoolExecutor is used.
+            Defaults to None.
+        executor: If not None, depictions are rendered in this executor
+            (i.e shared with other repos) instead, and workers is ignored. Defaults to None.
+        assets: Whether or not to extract the files packages refer to with file:// URLs
+            (the icon, and screenshots/header image in the metadata) for depictions.
+            If None, the template's 'assets' is used (if any). Defaults to None.
         **kwargs: Passed to super().__init__
+            If digests is not given, the template's 'digests' are used (if any).
     """
 
-    def __init__(self, host: str, *args, template: Optional[dict] = None, **kwargs):
+    def __init__(
+        self,
+        host: str,
+        *args,
+        template: Optional[dict] = None,
+        compact: Optional[bool] = None,
+        workers: Optional[int] = None,
+        executor: Optional["concurrent.futures.Executor"] = None,
+        assets: Optional[bool] = None,
+        **kwargs,
+    ):
         super().__init__(*args, **kwargs)
         if template is None:
             with (self.root / CONFIG_NAME).open() as f:
@@ -90,8 +158,11 @@ class Repository(tree.DebianTree):
         else:
             self._template = template
 
-        deb_path = self.root / self._template["deb_path"]
-        self.add_debs(deb_path)
+        if "digests" not in kwargs and "digests" in self._template:
+            self.digests = self._template["digests"]
+
+        self.deb_path = self.root / self._template["deb_path"]
+        self.add_debs(self.deb_path)
 
         self._host = host
         self._depictions = {
@@ -100,6 +171,64 @@ class Repository(tree.DebianTree):
             if k in self._template
         }
 
+        self._compact = self._template.get("compact", False) if compact is None else compact
+        # package -> manifest entry (of the latest version)
+        self._manifest: Dict[str, dict] = {}
+
+        self._meta = meta.MetaStore(self.root / self._template.get("meta", META_PATH))
+        # package -> metadata stamps when it was last built
+        self._meta_stamps: Dict[str, tuple] = {}
+        self._assets = self._template.get("assets", False) if assets is None else assets
+        # package -> paths of files in the package -> urls of the extracted files
+        self._asset_urls: Dict[str, Dict[str, str]] = {}
+
+        # when each package version was first seen (for the depiction release dates)
+        self._history = history.History(self.root / history.HISTORY_PATH)
+        # package -> fingerprint of its last rendered depictions (loaded lazily)
+        self._rendered: Optional[Dict[str, str]] = None
+
+        # depictions render in a thread pool during builds.
+        self._workers = workers
+        self._executor = executor
+        self._pool: Optional["concurrent.futures.Executor"] = None
+        self._renders: List[Tuple[str, str, "concurrent.futures.Future"]] = []
+        self._made_dirs: Set[pathlib.Path] = set()
+
+    @property
+    def private_patterns(self) -> Tuple[str, ...]:
+        """See private_patterns()."""
+        return private_patterns(self._template)
+
+    @property
+    def _rendered_path(self) -> pathlib.Path:
+        return self.root / RENDERED_PATH
+
+    def _load_rendered(self) -> Dict[str, str]:
+        if self._rendered is None:
+            try:
+                with self._rendered_path.open() as f:
+                    self._rendered = json.load(f)
+            except (FileNotFoundError, ValueError):
+                self._rendered = {}
+
+        return self._rendered  # type: ignore
+
+    def _save_rendered(self):
+        self._rendered_path.parent.mkdir(parents=True, exist_ok=True)
+        with utils.open_atomic(self._rendered_path) as f:
+            json.dump(self._load_rendered(), f, sort_keys=True)
+
+    def _fingerprint(self, debinfo: email.message.Message, other_info: dict) -> str:
+        # everything a package's depictions are rendered from.
+        inputs = [
+            list(debinfo.items()),
+            other_info,
+            self._host,
+            self._compact,
+            {dep: self._template[dep] for dep in self._depictions},
+        ]
+        return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
     def _build(self, package: str) -> Generator[email.message.Message, None, None]:
         versions = super()._build(package)
         latest = next(versions)
@@ -112,23 +241,249 @@ class Repository(tree.DebianTree):
             yield version
 
     def _build_depiction(self, debinfo: email.message.Message):
-        for dep, _dep_class in self._depictions.items():
-            _log.debug("[%s] making %s depiction", debinfo["Package"], dep)
+        package = debinfo["Package"]
+        rendered = self._load_rendered()
 
-            dep_class = getattr(depictions, _dep_class)
+        self._meta_stamps[package] = self._meta.stamp(package)
+        other_info = self._meta.get(package)
 
-            dep_path = self.root / self._template[dep]["path"].format(
-                package=debinfo["Package"]
+        if "released" not in other_info:
+            other_info["released"] = self._history.first_seen(
+                package,
+                debinfo["Version"],
+                (self.root / debinfo["Filename"]).stat().st_mtime,
             )
 
-            # make parent directories, if it does not exist yet
-            (dep_path.parent).mkdir(parents=True, exist_ok=True)
+        if package in self._asset_urls:
+            from mothman import assets
+
+            other_info = assets.rewrite(debinfo, other_info, self._asset_urls[package])
+
+        fingerprint = self._fingerprint(debinfo, other_info)
+        changed = rendered.get(package) != fingerprint
+
+        # depictions are rendered from a copy of the control fields
+        # (debinfo is still being built while they render).
+        control = email.message.Message()
+        for field, value in debinfo.items():
+            control[field] = value
+
+        jobs = []
+
+        for dep, _dep_class in self._depictions.items():
+            dep_path = self.root / self._template[dep]["path"].format(package=package)
+
+            if changed or not dep_path.is_file():
+                # make parent directories once per build (not per depiction).
+                if dep_path.parent not in self._made_dirs:
+                    dep_path.parent.mkdir(parents=True, exist_ok=True)
+                    self._made_dirs.add(dep_path.parent)
 
-            # write actual depiction
-            with dep_path.open("w") as f:
-                f.write(dep_class(debinfo).build())
+                jobs.append((dep, getattr(depictions, _dep_class), dep_path))
+            else:
+                _log.debug("[%s] %s depiction is up to date", package, dep)
 
             # add depiction field to debinfo
             debinfo[dep] = self._template[dep]["url"].format(
                 host=self._host, package=debinfo["Package"]
             )
+
+        self._manifest[debinfo["Package"]] = {
+            "name": debinfo.get("Name", debinfo["Package"]),
+            "version": debinfo["Version"],
+            "section": debinfo.get("Section"),
+            "author": debinfo.get("Author"),
+            "description": (debinfo.get("Description") or "").partition("\n")[0],
+            "depictions": {dep: debinfo[dep] for dep in self._depictions},
+        }
+
+        if not jobs:
+            rendered[package] = fingerprint
+        elif self._pool is None:
+            self._render(package, control, other_info, jobs)
+            rendered[package] = fingerprint
+        else:
+            future = self._pool.submit(self._render, package, control, other_info, jobs)
+            self._renders.append((package, fingerprint, future))
+
+    def _render(
+        self,
+        package: str,
+        control: email.message.Message,
+        other_info: dict,
+        jobs: List[Tuple[str, Type[depictions.Generic], pathlib.Path]],
+    ) -> int:
+        # render and write depictions (may run in a worker thread).
+        # returns the number of bytes written.
+        size = 0
+
+        for dep, dep_class, dep_path in jobs:
+            _log.debug("[%s] making %s depiction", package, dep)
+
+            text = dep_class(control, other_info, compact=self._compact).build()
+            self._write_depiction(dep_path, text)
+            size += len(text)
+
+        return size
+
+    def _write_depiction(self, path: pathlib.Path, text: str):
+        gz_path = path.with_name(path.name + utils.GZIP)
+
+        with utils.open_atomic(path, encoding="utf8") as f:
+            f.write(text)
+
+        if self._compact:
+            # gzip has a zero mtime, so unchanged depictions stay byte-for-byte the same.
+            with utils.open_hashed(gz_path, utils.GZIP, ()) as (f, _):
+                f.write(text)
+        elif gz_path.exists():
+            # stale copy from a previous compact build.
+            gz_path.unlink()
+
+    def build(self, *args, **kwargs) -> Optional[str]:
+        """Build the Packages/Release file and depictions for this repo.
+        If the repo is compact, the depictions manifest is written too.
+
+        Only depictions whose inputs (control fields, metadata, etc.) changed since
+        they were last rendered are written again.
+
+        Args:
+            *args: Passed to super().build.
+            **kwargs: Passed to super().build.
+
+        Returns:
+            The Packages file content as a string (None if it was streamed).
+        """
+
+        # rebuild packages whose metadata changed since the last build.
+        for package in self._tree.names():
+            if self._meta_stamps.get(package) != self._meta.stamp(package):
+                self._dirty.add(package)
+
+        self._made_dirs = set()
+        self._renders = []
+
+        import concurrent.futures
+
+        # depictions render in the pool while the Packages files are built and compressed.
+        start = time.perf_counter()
+        with contextlib.ExitStack() as stack:
+            if self._executor is not None:
+                pool = self._executor
+            else:
+                pool = stack.enter_context(
+                    concurrent.futures.ThreadPoolExecutor(self._workers)
+                )
+
+            assets_stage = None
+            if self._assets:
+                assets_start = time.perf_counter()
+                count, assets_size = self._extract_assets(pool)
+                assets_stage = (time.perf_counter() - assets_start, count, assets_size)
+
+            self._pool = pool
+            rendered = self._load_rendered()
+            size = 0
+
+            try:
+                packages_text = super().build(*args, **kwargs)
+
+                for done, (package, fingerprint, future) in enumerate(self._renders, 1):
+                    # if rendering failed, the exception is raised here.
+                    rendered_size = future.result()
+                    size += rendered_size
+                    rendered[package] = fingerprint
+                    self._report("depictions", done, len(self._renders), rendered_size)
+            except BaseException:
+                # renders that haven't started are dropped, and the rest are waited for
+                # (the pool may outlive this build, so it can't be left writing depictions).
+                futures = [future for *_, future in self._renders]
+                for future in futures:
+                    future.cancel()
+                concurrent.futures.wait(futures)
+                raise
+            finally:
+                self._pool = None
+
+        if assets_stage is not None:
+            # (logged here, as profiling is only switched on by super().build)
+            self._log_stage("assets", *assets_stage)
+        self._log_stage("depictions", time.perf_counter() - start, len(self._renders), size)
+        self.metrics.set("mothman_depictions_rendered", len(self._renders))
+        # (including the depictions)
+        self.metrics.set("mothman_build_duration_seconds", time.perf_counter() - start)
+        self.metrics.set("mothman_build_timestamp_seconds", time.time())
+
+        # drop packages that were removed.
+        names = set(self._tree.names())
+        rendered = self._load_rendered()
+
+        for entries in (self._manifest, self._meta_stamps, rendered):
+            for package in [p for p in entries if p not in names]:
+                del entries[package]
+
+        self._save_rendered()
+        self._history.save()
+
+        if self._compact:
+            self._write_manifest()
+
+        return packages_text
+
+    def _extract_assets(self, pool: "concurrent.futures.Executor") -> Tuple[int, int]:
+        # extract the files the latest version of each package refers to,
+        # and copy them into the repo.
+        # returns the number of packages with files, and the bytes of the files.
+        # (imported here, as tarfile is slow to import and assets are opt-in)
+        from mothman import assets
+
+        jobs = []
+
+        for package in self._tree.names():
+            latest = self._tree.records(package)[0]
+            paths = assets.referenced(dict(latest.fields), self._meta.get(package))
+            if paths:
+                jobs.append((package, latest, paths))
+
+        extracted = assets.extract_all(
+            ((r.filename, r.hexdigests.get("sha256"), paths) for _, r, paths in jobs), pool
+        )
+
+        self._asset_urls = {}
+        size = 0
+
+        for package, latest, _ in jobs:
+            for path, cached in extracted[latest.filename].items():
+                if cached is None:
+                    _log.warning("[%s] %s is not in the package", package, path)
+                    continue
+
+                relpath = f"{ASSETS_PATH}/{package}/{cached.name}"
+                asset_path = self.root / relpath
+
+                if not asset_path.is_file() or not filecmp.cmp(cached, asset_path, shallow=False):
+                    _log.debug("[%s] copying %s", package, path)
+                    asset_path.parent.mkdir(parents=True, exist_ok=True)
+                    with cached.open("rb") as src, utils.open_atomic(asset_path, "wb") as dst:
+                        shutil.copyfileobj(src, dst)
+
+                size += asset_path.stat().st_size
+                self._asset_urls.setdefault(package, {})[path] = f"{self._host}/{relpath}"
+
+        return len(jobs), size
+
+    def _write_manifest(self):
+        manifest_path = self.root / self._template.get("manifest", MANIFEST_PATH)
+        manifest_path.parent.mkdir(parents=True, exist_ok=True)
+
+        text = json.dumps(
+            {p: self._manifest[p] for p in sorted(self._manifest)},
+            separators=(",", ":"),
+        )
+
+        _log.info("[%s] writing manifest (%s packages)", manifest_path.name, len(self._manifest))
+        for fmt in (utils.CAT, utils.GZIP):
+            with utils.open_hashed(
+                manifest_path.with_name(manifest_path.name + fmt), fmt, ()
+            ) as (f, _):
+                f.write(text)
@@ -0,0 +1,154 @@
+# coding: utf8
+"""Download (with caching) and extract repo templates (see mothman.repo.TEMPLATES).
+"""
+
+import fnmatch
+import logging
+import pathlib
+import posixpath
+import shutil
+import zipfile
+from typing import Iterable, Optional
+
+import requests
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["TemplateError", "fetch", "extract"]
+
+_log = logging.getLogger("mothman")
+
+CHUNKSIZE = 65536
+
+
+class TemplateError(Exception):
+    pass
+
+
+def _cache_dir() -> pathlib.Path:
+    return utils.user_cache_dir() / "templates"
+
+
+def fetch(name: str, template: dict, offline: bool = False) -> Optional[pathlib.Path]:
+    """Get the zip archive of a template, downloading it only if it changed since
+    it was last cached (by ETag).
+
+    Args:
+        name: The name of the template.
+        template: The template (see mothman.repo.TEMPLATES).
+        offline: If True, only the cached archive is used (nothing is downloaded).
+            Defaults to False.
+
+    Returns:
+        The path to the cached archive, or None if offline and it is not cached.
+
+    Raises:
+        TemplateError, if the template could not be downloaded (and it is not cached).
+    """
+
+    cache_dir = _cache_dir()
+    zip_path = cache_dir / f"{name}.zip"
+    etag_path = cache_dir / f"{name}.etag"
+
+    if offline:
+        if zip_path.is_file():
+            _log.info("using cached template %s", name)
+            return zip_path
+        return None
+
+    username, reponame = template["github"].split("/")
+    url = f"https://github.com/{username}/{reponame}/archive/master.zip"
+
+    headers = {}
+    if zip_path.is_file() and etag_path.is_file():
+        headers["If-None-Match"] = etag_path.read_text()
+
+    _log.info("downloading template %s/%s", username, reponame)
+
+    try:
+        with requests.get(
+            url, headers=headers, allow_redirects=True, stream=True, timeout=30
+        ) as response:
+            if response.status_code == 304:
+                _log.info("cached template %s is up to date", name)
+                return zip_path
+
+            response.raise_for_status()
+
+            cache_dir.mkdir(parents=True, exist_ok=True)
+
+            # (atomically, so concurrent downloads of the same template don't mix)
+            with utils.open_atomic(zip_path, "wb") as f:
+                for chunk in response.iter_content(CHUNKSIZE):
+                    f.write(chunk)
+
+            etag = response.headers.get("ETag")
+            if etag is not None:
+                with utils.open_atomic(etag_path) as f:
+                    f.write(etag)
+            elif etag_path.is_file():
+                etag_path.unlink()
+
+    except requests.RequestException as e:
+        if zip_path.is_file():
+            _log.warning("failed to download template (%s), using cached template", e)
+            return zip_path
+        raise TemplateError(f"failed to download template {name}: {e}") from e
+
+    return zip_path
+
+
+def _excluded(path: str, exclude: Iterable[str]) -> bool:
+    # a path is excluded if it (or any of its parent folders) matches a pattern.
+    parts = path.split("/")
+    prefixes = ["/".join(parts[:i]) for i in range(1, len(parts) + 1)]
+
+    return any(
+        fnmatch.fnmatchcase(prefix, pattern)
+        for pattern in exclude
+        for prefix in prefixes
+    )
+
+
+def extract(zip_path: Path, dest: Path, exclude: Iterable[str] = ()):
+    """Extract a template archive, skipping excluded files
+    (so they are never written in the first place).
+
+    Args:
+        zip_path: The path to the archive. Everything is extracted relative to
+            the archive's top-level folder.
+        dest: The folder to extract to.
+        exclude: Glob patterns (relative to dest) of files/folders to skip.
+    """
+
+    dest = pathlib.Path(dest)
+    exclude = list(exclude)
+
+    _log.info("extracting zip file")
+
+    with zipfile.ZipFile(zip_path) as zf:
+        for zinfo in zf.infolist():
+            # strip the top-level folder (i.e 'repo.me-master/').
+            _, _, filename = zinfo.filename.partition("/")
+            filename = filename.rstrip("/")
+            if not filename:
+                continue
+
+            if filename.startswith("/") or ".." in posixpath.normpath(filename).split("/"):
+                raise TemplateError(f"refusing to extract {zinfo.filename}")
+
+            if _excluded(filename, exclude):
+                _log.debug("skipping excluded file %s", filename)
+                continue
+
+            path = dest / filename
+            _log.debug("extracting %s", filename)
+
+            if zinfo.is_dir():
+                path.mkdir(parents=True, exist_ok=True)
+                continue
+
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with zf.open(zinfo) as src, path.open("wb") as dst:
+                shutil.copyfileobj(src, dst, CHUNKSIZE)
@@ -3,29 +3,56 @@
 Forked from 'https://github.com/supermamon/dpkg-scanpackages.py'.
 """
 
+import contextlib
+import datetime
 import email
 import email.message
+import functools
+import hashlib
 import logging
+import os
 import pathlib
-from collections import defaultdict
-from typing import Dict, Generator, Optional
+import shutil
+import time
+from typing import (
+    IO,
+    TYPE_CHECKING,
+    Dict,
+    Generator,
+    Iterable,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
-from mothman import pydpkg, utils
+from mothman import cache, metrics, pydpkg, record, utils
 from mothman.utils import BZIP2, CAT, GZIP, XZ, Path
 
-__all__ = ["CAT", "GZIP", "BZIP2", "XZ", "DebianTree"]
+# asyncio, generations, ingest, etc. are only imported when they are used,
+# so importing the tree (i.e to start the CLI) stays fast.
+if TYPE_CHECKING:
+    import concurrent.futures
+    import threading
+
+    from mothman import index
+    from mothman.generations import Stage
+
+__all__ = ["CAT", "GZIP", "BZIP2", "XZ", "DebianTree", "Progress"]
 
 _log = logging.getLogger("mothman")
 
+# how many package files add_debs_async() scans at once by default.
+ASYNC_LIMIT = 2 * (os.cpu_count() or 1)
+# called with progress events (see mothman.metrics.Event) as a long operation progresses.
+Progress = metrics.Listener
+
 
 class DebError(Exception):
     pass
 
 
-def _sort(versions):
-    return sorted(list(versions), key=pydpkg.Dpkg.compare_versions_key)
-
-
 class DebianTree:
     """A tree representing a Debian repo as a Packages file.
 
@@ -36,10 +63,38 @@ class DebianTree:
             package architectures will be allowed. Defaults to None.
         allow_multiversion: Whether or not to allow multiple versions of
             the same package to be scanned for. Defaults to True.
+        keep_versions: If not None, only the newest N versions of each package
+            are kept (allow_multiversion=False is the same as keep_versions=1).
+            Defaults to None.
+        max_age: If not None, versions whose package files are older than this
+            are pruned (the newest version is always kept). Defaults to None.
+        archive_path: If not None, pruned package files are moved here
+            (relative to the root) instead of just being left out of Packages.
+            Defaults to None.
+        digests: The hashes of package files to add to Packages (and of the Packages
+            files to add to Release). Must be keys of utils.PACKAGES_FIELDS.
+            Defaults to utils.FILEINFO_HASHES.
+        scan_cache: Whether or not to cache the control fields and digests of
+            scanned packages (in .mothman/scan.json), so unchanged packages
+            are not parsed and hashed again. Defaults to True.
+            This can also be a cache.ScanCache shared with other trees; it is then
+            up to the caller to prune and save it.
+        dedupe: If not None, package files with the same content are replaced with
+            links to one copy when they are added by add_debs()
+            (one of the modes in mothman.dedupe). Defaults to None.
+        generations: If not None, builds are staged in a new generation and published
+            atomically, and this many generations are kept for rollback
+            (see mothman.generations). Defaults to None.
+        progress: If not None, called with progress events while packages are scanned
+            and built (see mothman.metrics.Event). Defaults to None.
 
     Attributes:
         root (pathlib.Path): See Args.
         root_str (str): .path, as a string.
+        deb_path (pathlib.Path): The folder ingest() puts package files in
+            (the root by default).
+        metrics (mothman.metrics.Metrics): Progress and metrics of scans/builds
+            (i.e to write a Prometheus textfile after a build).
     """
 
     def __init__(
@@ -48,34 +103,247 @@ class DebianTree:
         debtype: str = "deb",
         arch: str = None,
         allow_multiversion: bool = True,
+        keep_versions: Optional[int] = None,
+        max_age: Optional[datetime.timedelta] = None,
+        archive_path: Optional[Path] = None,
+        digests: Iterable[str] = utils.FILEINFO_HASHES,
+        scan_cache: Union[bool, cache.ScanCache] = True,
+        dedupe: Optional[str] = None,
+        generations: Optional[int] = None,
+        progress: Optional[Progress] = None,
     ) :
         _log.debug("initalising repo %s", root)
         self.root = pathlib.Path(root).resolve().expanduser()
         self.release_path = self.root / "Release"
+        self.deb_path = self.root
 
         with self.release_path.open() as f:
             _log.debug("parsing Release")
             self._release = email.message_from_file(f)
 
         # remove any hashes
-        for hash_field in ("MD5Sum", "SHA1", "SHA256", "SHA512"):
+        # (including the lowercase hash names written by older versions of mothman)
+        for hash_field in {*utils.RELEASE_FIELDS, *utils.RELEASE_FIELDS.values()}:
             if hash_field in self._release:
                 # erase existing hashes of Packages file, will be added back in on build
                 del self._release[hash_field]
 
-        # remove any Packages files
-        for file in self.root.glob("Packages"):
-            file.unlink()
-
         self._debtype = debtype
         self._arch = arch
         self._multiversion = allow_multiversion
-        self._tree: Dict[str, Dict[str, dict]] = defaultdict(lambda: defaultdict(dict))
+
+        if not allow_multiversion:
+            keep_versions = 1
+        if keep_versions is not None and keep_versions < 1:
+            raise ValueError("keep_versions must be at least 1")
+        self._keep_versions = keep_versions
+        self._max_age = max_age
+        self._dedupe = dedupe
+        self._archive_path = None if archive_path is None else self.root / archive_path
+        self._generations = None
+        if generations is not None:
+            from mothman.generations import Generations
+
+            self._generations = Generations(self.root, generations)
+
+        # serialised stanzas of each package (from the last build),
+        # and the packages that changed since then.
+        self._stanzas: Dict[str, str] = {}
+        self._dirty: Set[str] = set()
+
+        self.digests = digests
+        if isinstance(scan_cache, cache.ScanCache):
+            self._cache: Optional[cache.ScanCache] = scan_cache
+            self._owns_cache = False
+        else:
+            self._cache = cache.ScanCache(self.root / cache.CACHE_PATH) if scan_cache else None
+            self._owns_cache = True
+
+        self._tree = record.PackageIndex()
+        self._index: Optional["index.QueryIndex"] = None
+
+        # changes made in the current batch (if any), so they can be rolled back,
+        # and files to delete once the batch is done.
+        self._journal: Optional[list] = None
+        self._pending_deletes: List[str] = []
+
+        # whether or not to log the throughput of each build stage at info level.
+        self._profile = False
+        self.metrics = metrics.Metrics(progress)
+        # (so they are exported even if nothing is scanned)
+        self._reset_scan_metrics()
+        # set by build_async(): whether to stop.
+        self._cancelled: Optional["threading.Event"] = None
 
     @property
     def root_str(self):
         return str(self.root)
 
+    @property
+    def index(self) -> "index.QueryIndex":
+        """Query indexes over the packages in the tree (see mothman.index.QueryIndex).
+        These are built on first access, and kept up to date as packages are added/removed.
+        """
+
+        if self._index is None:
+            _log.debug("building query index")
+            from mothman import index
+
+            self._index = index.QueryIndex(self._tree)
+        return self._index
+
+    @property
+    def digests(self) -> Tuple[str, ...]:
+        """The hashes of package files added to Packages."""
+        return self._digests
+
+    @digests.setter
+    def digests(self, digests: Iterable[str]):
+        self._digests = utils.check_hashes(digests)
+        # every stanza has the digests, so they all have to be serialised again.
+        self._stanzas.clear()
+
+    def _insert(self, package_record: record.PackageRecord):
+        old = self._tree.add(package_record)
+
+        if self._index is not None:
+            if old is not None:
+                self._index.remove(old)
+            self._index.add(package_record)
+
+        self._dirty.add(package_record.name)
+        if self._journal is not None:
+            self._journal.append(("insert", package_record, old))
+
+    def _delete(
+        self, name: str, version: Optional[str] = None, arch: Optional[str] = None
+    ) -> List[record.PackageRecord]:
+        removed = self._tree.remove(name, version, arch)
+
+        for package_record in removed:
+            if self._index is not None:
+                self._index.remove(package_record)
+            if self._journal is not None:
+                self._journal.append(("delete", package_record, None))
+
+        if removed:
+            self._dirty.add(name)
+
+        return removed
+
+    def _rollback(self, journal: list):
+        for action, package_record, old in reversed(journal):
+            if action == "insert":
+                self._delete(*package_record.key)
+                if old is not None:
+                    self._insert(old)
+            elif action == "file":
+                # (package_record is the path of a file that was moved into place,
+                # and old the path of the file it overwrote, if any)
+                _log.debug("[%s] restoring", package_record.name)
+                package_record.unlink()
+                if old.exists():
+                    os.replace(old, package_record)
+            else:
+                self._insert(package_record)
+
+    def _unlink(self, filename: str):
+        # delete a package file (once the current batch is done, if any).
+        if self._journal is not None:
+            self._pending_deletes.append(filename)
+        else:
+            _log.info("[%s] deleting", os.path.basename(filename))
+            os.unlink(filename)
+
+    @contextlib.contextmanager
+    def batch(self) -> Generator["DebianTree", None, None]:
+        """A transaction of changes to the tree (adding, removing or replacing packages).
+        If an exception is raised in the batch, all changes are rolled back.
+        Package files are only deleted once the batch succeeds.
+        Nested batches are part of the outermost batch.
+
+        Usage:
+            with tree.batch():
+                tree.remove_package("com.example.package", "1.0")
+                tree.replace_deb("debs/com.example.package_1.1.deb")
+        """
+
+        if self._journal is not None:
+            yield self
+            return
+
+        self._journal = []
+        self._pending_deletes = []
+
+        try:
+            yield self
+        except BaseException:
+            journal, self._journal = self._journal, None
+            _log.warning("rolling back %s change(s)", len(journal))
+            self._rollback(journal)
+            raise
+        finally:
+            self._journal = None
+
+        for filename in self._pending_deletes:
+            self._unlink(filename)
+        self._pending_deletes = []
+
+    def _scan(
+        self, file: pathlib.Path, known: Optional[Dict[str, str]] = None
+    ) -> record.PackageRecord:
+        # get the control fields and digests of a package file,
+        # from the scan cache if possible.
+        # known digests (i.e computed while the file was written) are not computed again.
+        stat = file.stat()
+        cached = None if self._cache is None else self._cache.get(file, stat)
+        self.metrics.inc(
+            "mothman_scan_cache_misses" if cached is None else "mothman_scan_cache_hits"
+        )
+
+        if cached is None and self._cache is not None and self._cache.content_addressed:
+            # a copy of the file may have been scanned already (i.e in another repo),
+            # so hash it first (all digests at once, they are needed anyway).
+            hashes = {*self._digests, "sha256"}.difference(known or ())
+            _log.debug("[%s] hashing (%s)", file.name, ", ".join(sorted(hashes)))
+
+            info = utils.fileinfo(file, hashes=hashes)
+            del info["filesize"]
+            known = {**info, **(known or {})}
+            self.metrics.inc("mothman_scan_hashed_bytes", stat.st_size)
+
+            cached = self._cache.get_content(known["sha256"])
+            if cached is not None:
+                _log.debug("[%s] same content as a scanned file", file.name)
+
+        if cached is None:
+            _log.debug("[%s] parsing", file.name)
+            fields = tuple(pydpkg.Dpkg(file).message.items())
+            hexdigests: Dict[str, str] = {}
+        else:
+            fields, hexdigests = cached
+
+        if known:
+            hexdigests.update(known)
+
+        missing = [d for d in self._digests if d not in hexdigests]
+        if missing:
+            _log.debug("[%s] hashing (%s)", file.name, ", ".join(missing))
+            info = utils.fileinfo(file, hashes=missing)
+            del info["filesize"]
+            hexdigests.update(info)
+            self.metrics.inc("mothman_scan_hashed_bytes", stat.st_size)
+
+        if self._cache is not None and (cached is None or missing or known):
+            self._cache.put(file, stat, fields, hexdigests)
+
+        return record.PackageRecord(
+            str(file),
+            fields,
+            tuple((d, bytes.fromhex(hexdigests[d])) for d in self._digests),
+            stat.st_size,
+        )
+
     def add_deb(self, file: pathlib.Path):
         """Add a Debian package file to the tree.
 
@@ -83,64 +351,513 @@ class DebianTree:
             file: The path to the package file.
         """
 
-        debinfo = pydpkg.Dpkg(file)
+        self._add_record(self._scan(pathlib.Path(file)))
 
+    def _add_record(self, package_record: record.PackageRecord):
         # arch check (i use arch btw).
         if self._arch is not None:
-            if debinfo["Architecture"] != self._arch:
+            if package_record.arch != self._arch:
                 return
 
-        _log.debug("[%s] adding deb", debinfo.Package)
-        name, version, arch = [debinfo[f] for f in pydpkg.REQUIRED_HEADERS]
+        existing = self._tree.get(*package_record.key)
+        if existing is not None and existing.filename != package_record.filename:
+            if existing.digests == package_record.digests:
+                # same content: only one stanza, for the first file (by path).
+                _log.warning(
+                    "[%s] %s is a duplicate of %s, only one is added to Packages",
+                    package_record.debian_name,
+                    os.path.basename(max(existing.filename, package_record.filename)),
+                    os.path.basename(min(existing.filename, package_record.filename)),
+                )
+                if existing.filename < package_record.filename:
+                    return
+            else:
+                _log.warning(
+                    "[%s] %s and %s are different files of the same package/version/arch, "
+                    "using %s",
+                    package_record.debian_name,
+                    os.path.basename(existing.filename),
+                    os.path.basename(package_record.filename),
+                    os.path.basename(package_record.filename),
+                )
+
+        _log.debug("[%s] adding deb", package_record.name)
 
-        self._tree[name][version][arch] = debinfo
+        self._insert(package_record)
 
-    def add_debs(self, folder: Optional[pathlib.Path] = None) :
+    def add_debs(self, folder: Optional[pathlib.Path] = None, dedupe: Optional[str] = None):
         """Find any Debian package files and add them to the tree.
 
         Args:
             folder: The path to search for packages.
                 No recursive searching is done.
+            dedupe: If not None, files with the same content are replaced with links to
+                one copy (see mothman.dedupe.dedupe). If None, the tree's dedupe is used.
+                Defaults to None.
         """
         _log.info("[%s] finding debs", folder)
 
-        for debfile in folder.glob(f"*.{self._debtype}"):
+        debfiles = sorted(folder.glob(f"*.{self._debtype}"))
+
+        self._reset_scan_metrics()
+        hashed = 0.0
+
+        for done, debfile in enumerate(debfiles, 1):
             self.add_deb(debfile)
+            hashed = self._report_scan(done, len(debfiles), hashed)
+
+        self._added_debs(debfiles, dedupe)
+
+    def _reset_scan_metrics(self):
+        # the scan metrics are of the last scan of a folder.
+        for name in (
+            "mothman_scan_cache_hits",
+            "mothman_scan_cache_misses",
+            "mothman_scan_hashed_bytes",
+        ):
+            self.metrics.set(name, 0)
+
+    def _report_scan(self, done: int, total: int, hashed: float) -> float:
+        # report scan progress, with the bytes hashed since the last report.
+        # returns the bytes hashed so far.
+        now_hashed = self.metrics.get("mothman_scan_hashed_bytes")
+        self.metrics.progress("scan", done, total, int(now_hashed - hashed))
+        return now_hashed
+
+    def _added_debs(self, debfiles: List[pathlib.Path], dedupe: Optional[str]):
+        dedupe = self._dedupe if dedupe is None else dedupe
+        if dedupe is not None:
+            from mothman import dedupe as _dedupe
+
+            # the files were just scanned, so their digests are cached (if there is a cache).
+            _dedupe.dedupe(debfiles, mode=dedupe, scan_cache=self._cache)
+
+        if self._cache is not None and self._owns_cache:
+            self._cache.prune()
+            self._cache.save()
+
+    async def add_debs_async(
+        self,
+        folder: pathlib.Path,
+        dedupe: Optional[str] = None,
+        executor: Optional["concurrent.futures.Executor"] = None,
+        limit: Optional[int] = None,
+        progress: Optional[Progress] = None,
+    ):
+        """Like add_debs(), but package files are scanned (parsed/hashed) in an executor,
+        so the event loop is not blocked.
+
+        If the task is cancelled, no packages are added.
+
+        Args:
+            folder: The path to search for packages.
+            dedupe: See add_debs().
+            executor: The executor to scan package files in.
+                If None, the event loop's default executor is used. Defaults to None.
+            limit: How many package files to scan at once.
+                If None, ASYNC_LIMIT is used. Defaults to None.
+            progress: If not None, called with progress events (on the event loop) instead of
+                the tree's listener (see Progress). Defaults to None.
+        """
+
+        with self.metrics.listening(progress):
+            await self._add_debs_async(folder, dedupe, executor, limit)
+
+    async def _add_debs_async(
+        self,
+        folder: pathlib.Path,
+        dedupe: Optional[str],
+        executor: Optional["concurrent.futures.Executor"],
+        limit: Optional[int],
+    ):
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        folder = pathlib.Path(folder)
+
+        _log.info("[%s] finding debs", folder)
+        debfiles = await loop.run_in_executor(
+            executor, lambda: sorted(folder.glob(f"*.{self._debtype}"))
+        )
+
+        semaphore = asyncio.Semaphore(limit or ASYNC_LIMIT)
+        done = 0
+        self._reset_scan_metrics()
+        hashed = 0.0
+
+        async def scan(file: pathlib.Path) -> record.PackageRecord:
+            nonlocal done, hashed
+
+            async with semaphore:
+                package_record = await loop.run_in_executor(executor, self._scan, file)
+
+            done += 1
+            hashed = self._report_scan(done, len(debfiles), hashed)
+
+            return package_record
+
+        # (if cancelled, gather() cancels the scans that haven't finished yet)
+        package_records = await asyncio.gather(*(scan(file) for file in debfiles))
+
+        # added in order (like add_debs), so duplicates are resolved the same way.
+        with self.batch():
+            for package_record in package_records:
+                self._add_record(package_record)
+
+        await loop.run_in_executor(executor, self._added_debs, debfiles, dedupe)
+
+    def remove_package(
+        self,
+        name: str,
+        version: Optional[str] = None,
+        arch: Optional[str] = None,
+        delete: bool = False,
+    ) -> List[record.PackageRecord]:
+        """Remove a package from the tree.
+
+        Args:
+            name: The name of the package.
+            version: If not None, only this version is removed. Defaults to None.
+            arch: If not None, only this arch is removed. Defaults to None.
+            delete: Whether or not to delete the package files too. Defaults to False.
+
+        Returns:
+            The records of the removed packages.
+        """
+
+        removed = self._delete(name, version, arch)
+        _log.info("[%s] removed %s package(s)", name, len(removed))
+
+        if delete:
+            for package_record in removed:
+                self._unlink(package_record.filename)
+
+        return removed
+
+    def replace_deb(
+        self,
+        file: pathlib.Path,
+        all_versions: bool = False,
+        delete: bool = False,
+        hexdigests: Optional[Dict[str, str]] = None,
+    ) -> List[record.PackageRecord]:
+        """Add a Debian package file to the tree, replacing the package with the same
+        name/version/arch (i.e a rebuild).
+
+        Args:
+            file: The path to the package file.
+            all_versions: Whether or not to replace all other versions of the package too.
+                Defaults to False.
+            delete: Whether or not to delete the replaced package files
+                (if they are not file itself). Defaults to False.
+            hexdigests: Digests of the file that are already known
+                (i.e computed while it was written), as a dict of hash names to hex digests.
+                These are not computed again. Defaults to None.
+
+        Returns:
+            The records of the replaced packages.
+        """
+
+        package_record = self._scan(pathlib.Path(file).resolve(), hexdigests)
+        return self._replace(package_record, all_versions, delete)
+
+    def _replace(
+        self, package_record: record.PackageRecord, all_versions: bool, delete: bool
+    ) -> List[record.PackageRecord]:
+        file = pathlib.Path(package_record.filename).resolve()
+        name, version, arch = package_record.key
+
+        with self.batch():
+            replaced = self._delete(name, None if all_versions else version, arch)
+            self._insert(package_record)
+
+            if delete:
+                for old in replaced:
+                    if pathlib.Path(old.filename).resolve() != file:
+                        self._unlink(old.filename)
+
+        _log.info("[%s] replaced %s package(s)", name, len(replaced))
+        return replaced
+
+    def ingest(
+        self,
+        stream: IO[bytes],
+        name: Optional[str] = None,
+        folder: Optional[Path] = None,
+        delete: bool = False,
+    ) -> List[record.PackageRecord]:
+        """Add a Debian package file from a stream (i.e stdin or a socket),
+        replacing the package with the same name/version/arch (see replace_deb()).
+
+        The stream is copied into the folder while it is hashed and its control fields
+        are parsed, so the package file is only read once.
+
+        Args:
+            stream: The binary stream to read the package file from (until EOF).
+            name: The filename of the package file.
+                If None, it is named after the package ('<name>_<version>_<arch>.deb').
+                Defaults to None.
+            folder: The folder to put the package file in. If None, .deb_path is used.
+                Defaults to None.
+            delete: Whether or not to delete the replaced package files. Defaults to False.
+
+        Returns:
+            The records of the replaced packages.
+
+        Raises:
+            DebError, if the stream is not a valid package file
+                (or the package is not of the tree's arch).
+        """
+
+        folder = self.deb_path if folder is None else pathlib.Path(folder)
+        return self._commit(*self._receive(stream, folder, name), delete=delete)
+
+    def _receive(
+        self, stream: IO[bytes], folder: pathlib.Path, name: Optional[str] = None
+    ) -> Tuple[record.PackageRecord, pathlib.Path, Dict[str, str]]:
+        # copy a package file from a stream into a temporary file in folder.
+        # returns its record (with the path it will have once it is committed),
+        # the path of the temporary file, and the hex digests of the file.
+        # this does not change the tree, so it can run in parallel with builds.
+        import tempfile
+
+        from mothman import ingest
+
+        folder.mkdir(parents=True, exist_ok=True)
+
+        hashes = set(self._digests)
+        if self._cache is not None and self._cache.content_addressed:
+            hashes.add("sha256")
+
+        fd, temp = tempfile.mkstemp(suffix=".part", prefix=".ingest.", dir=folder)
+        part_path = pathlib.Path(temp)
+
+        try:
+            with os.fdopen(fd, "wb") as f:
+                fields, hexdigests = ingest.copy_deb(stream, f, sorted(hashes))
+
+            size = hexdigests.pop("filesize")
+            digests = tuple((d, bytes.fromhex(hexdigests[d])) for d in self._digests)
+            package_record = record.PackageRecord(str(part_path), fields, digests, size)
+
+            if self._arch is not None and package_record.arch != self._arch:
+                raise DebError(
+                    f"{package_record.debian_name} is not for the {self._arch} architecture"
+                )
+
+            if name is None:
+                name = f"{package_record.debian_name.replace(':', '%3a')}.{self._debtype}"
+
+            name = os.path.basename(name)
+            if not name or name.startswith("."):
+                raise DebError(f"invalid package file name: {name!r}")
+
+        except BaseException as e:
+            part_path.unlink()
+            if isinstance(e, ingest.IngestError):
+                raise DebError(f"invalid package file: {e}") from e
+            raise
+
+        _log.debug("[%s] received %s bytes", name, size)
+        package_record = record.PackageRecord(str(folder.resolve() / name), fields, digests, size)
+
+        return package_record, part_path, hexdigests
+
+    def _commit(
+        self,
+        package_record: record.PackageRecord,
+        part_path: pathlib.Path,
+        hexdigests: Dict[str, str],
+        delete: bool = False,
+    ) -> List[record.PackageRecord]:
+        # move a received package file into place, and replace its package in the tree.
+        path = pathlib.Path(package_record.filename)
+        old_path = path.with_name(f".{path.name}.old")
+
+        owner = self._owner(path)
+        if owner is not None and owner != package_record.key:
+            part_path.unlink()
+            raise DebError(
+                f"{path.name} is the package file of {'_'.join(owner)}, not overwriting it"
+            )
+
+        with self.batch():
+            # keep the file being overwritten (if any) until the batch is done,
+            # so it can be put back if the batch is rolled back.
+            moved = path.exists()
+            if moved:
+                os.replace(path, old_path)
+            try:
+                os.replace(part_path, path)
+            except BaseException:
+                # (not in the journal yet, so put the old file back here)
+                if moved:
+                    os.replace(old_path, path)
+                raise
+            self._journal.append(("file", path, old_path))  # type: ignore
+
+            if self._cache is not None:
+                # so the file is never read again when the tree is scanned.
+                self._cache.put(path, path.stat(), package_record.fields, hexdigests)
+
+            replaced = self._replace(package_record, False, delete)
+
+            if old_path.exists():
+                self._unlink(str(old_path))
+
+        if self._cache is not None and self._owns_cache:
+            self._cache.save()
+
+        return replaced
+
+    def _owner(self, path: pathlib.Path) -> Optional[record.Key]:
+        # the (name, version, arch) of the package that a file belongs to, if any:
+        # its record in the tree, or the control fields of the file (if it isn't in the tree).
+        for package_record in self._tree:
+            if package_record.filename == str(path):
+                return package_record.key
+
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return None
+
+        cached = None if self._cache is None else self._cache.get(path, stat)
+        try:
+            fields = cached[0] if cached is not None else pydpkg.Dpkg(path).message.items()
+        except Exception as e:
+            # (not a readable package file, so it isn't any package's)
+            _log.debug("[%s] can't read: %s", path.name, e)
+            return None
+
+        return record.PackageRecord(str(path), tuple(fields), (), 0).key
+
+    def _select(self, package: str) -> List[str]:
+        # versions to keep for a package, latest first.
+        # (the index is already sorted, so there is no need to sort here.)
+        version_names = self._tree.versions(package)
+
+        if self._keep_versions is not None:
+            version_names = version_names[: self._keep_versions]
+
+        if self._max_age is not None:
+            cutoff = datetime.datetime.now().timestamp() - self._max_age.total_seconds()
+            # the latest version is always kept, no matter how old it is.
+            version_names = version_names[:1] + [
+                v
+                for v in version_names[1:]
+                if any(
+                    os.path.getmtime(r.filename) >= cutoff
+                    for r in self._tree.records(package, v)
+                )
+            ]
+
+        return version_names
+
+    def check(self, external: Optional[Iterable[str]] = None) -> dict:
+        """Check that all packages in the tree can be installed, and find dependency cycles.
+
+        Args:
+            external: Glob patterns of package names provided outside of the repo
+                (always satisfied). If None, mothman.check.EXTERNAL is used.
+                Defaults to None.
+
+        Returns:
+            The report, see mothman.check.Checker.check.
+        """
+
+        from mothman import check
+
+        if external is None:
+            external = check.EXTERNAL
+
+        return check.Checker(self._tree, external=external).check()
+
+    def prune(self) -> List[pathlib.Path]:
+        """Remove versions not covered by the retention policy
+        (keep_versions/max_age) from the tree.
+        If archive_path was given, the pruned package files are moved there.
+
+        Returns:
+            The paths of the pruned package files (after moving, if any).
+        """
+
+        pruned = []
+
+        for package in self._tree.names():
+            kept = set(self._select(package))
+
+            for version in [v for v in self._tree.versions(package) if v not in kept]:
+                for pruned_record in self._delete(package, version):
+                    path = pathlib.Path(pruned_record.filename)
+
+                    if self._archive_path is not None:
+                        self._archive_path.mkdir(parents=True, exist_ok=True)
+                        _log.info("[%s] archiving to %s", path.name, self._archive_path)
+                        path = pathlib.Path(
+                            shutil.move(str(path), str(self._archive_path / path.name))
+                        )
+                    else:
+                        _log.debug("[%s] pruning", path.name)
+
+                    pruned.append(path)
+
+        return pruned
 
     def _build(self, package: str) -> Generator[email.message.Message, None, None]:
-        # need to reverse, so latest versions come first
-        # simpler than changing the quicksort function itself
-        _log.debug("[%s] sorting versions", package)
-        versions = self._tree[package]
-        version_names = _sort(versions)
-        version_names.reverse()
-
-        if not self._multiversion:
-            latest_version = version_names[0].partition("/")[0]
-            # because version name has the format 'actual_ver/arch',
-            # there may be multiple archs for each version.
-            # (Hence the .startswith().)
-            version_names = [v for v in version_names if v.startswith(latest_version)]
-
-        for v in version_names:
-            for _, debinfo in versions[v].items():
-                debname = debinfo.debian_name
-                fileinfo = debinfo.fileinfo
-                msg = debinfo.message
-
-                _log.info("[%s] adding to Packages", debname)
+        for v in self._select(package):
+            for package_record in self._tree.records(package, v):
+                debname = package_record.debian_name
+                msg = package_record.message
+
+                _log.debug("[%s] adding to Packages", debname)
 
                 msg["Filename"] = str(
-                    pathlib.Path(debinfo.filename).relative_to(self.root)
+                    pathlib.Path(package_record.filename).relative_to(self.root)
                 )
-                msg["Size"] = str(fileinfo.pop("filesize"))
-                for name, digest in fileinfo.items():
+                msg["Size"] = str(package_record.size)
+                for name, digest in package_record.hexdigests.items():
                     _log.debug("[%s] adding %s hash to Packages", debname, name)
-                    msg[name] = digest
+                    msg[utils.PACKAGES_FIELDS[name]] = digest
 
                 yield msg
 
-    def build(self, compress_using: list = [CAT, GZIP]) -> str:
+    def _log_stage(self, stage: str, seconds: float, items: int, size: int):
+        # log how long a build stage took (and its throughput), and record it in the metrics.
+        self.metrics.set("mothman_stage_duration_seconds", seconds, stage=stage)
+        self.metrics.set("mothman_stage_items", items, stage=stage)
+        self.metrics.set("mothman_stage_bytes", size, stage=stage)
+
+        _log.log(
+            logging.INFO if self._profile else logging.DEBUG,
+            "[%s] %s item(s), %.1f KiB in %.3fs (%.0f items/s, %.2f MiB/s)",
+            stage,
+            items,
+            size / 1024,
+            seconds,
+            items / seconds if seconds else 0,
+            size / (1 << 20) / seconds if seconds else 0,
+        )
+
+    def _report(
+        self, stage: str, done: int, total: int, size: int = 0, cancellable: bool = True
+    ):
+        # report the progress of a build stage,
+        # and stop the build if it was cancelled (see build_async()) and still can be.
+        if cancellable and self._cancelled is not None and self._cancelled.is_set():
+            import concurrent.futures
+
+            raise concurrent.futures.CancelledError()
+
+        self.metrics.progress(stage, done, total, size)
+
+    def build(
+        self,
+        compress_using: list = [CAT, GZIP],
+        release_hashes: Optional[Iterable[str]] = None,
+        profile: bool = False,
+        max_memory: Optional[int] = None,
+    ) -> Optional[str]:
         """Build the Packages/Release file for this repo.
 
         Args:
@@ -148,65 +865,347 @@ class DebianTree:
                 Format must be one of the module-level constants CAT, GZIP,
                 BZIP2, or XZ.
                 Defaults to [CAT, GZIP] (plaintext and .gz compression).
+            release_hashes: The hashes of the Packages files to add to Release.
+                Must be keys of utils.RELEASE_FIELDS.
+                If None, the tree's digests are used. Defaults to None.
+            profile: Whether or not to log the throughput of each stage of the build.
+                Defaults to False.
+            max_memory: If not None, the Packages files are streamed: each stanza is
+                written to all of them as soon as it is serialised, instead of building
+                the whole Packages file in memory first. Stanzas are only cached
+                (for the next build) while they take up at most max_memory bytes.
+                Defaults to None.
+
+        Returns:
+            The Packages file content as a string (None if it was streamed).
+            If there are no packages, the Packages files are empty.
+        """
+
+        self._profile = profile
+        build_start = time.perf_counter()
+        release_hashes = (
+            self._digests if release_hashes is None else utils.check_hashes(release_hashes)
+        )
+
+        if not self._tree:
+            # (i.e the last package was removed)
+            _log.warning("[Packages] building without any packages")
+
+        if self._keep_versions is not None or self._max_age is not None:
+            pruned = self.prune()
+            _log.info("[Packages] pruned %s package file(s)", len(pruned))
+
+        names = self._tree.names()
+
+        with contextlib.ExitStack() as stack:
+            # with generations, everything is written into a new generation first,
+            # and published only once it is complete.
+            stage: Optional["Stage"] = None
+            if self._generations is not None:
+                stage = stack.enter_context(self._generations.stage())
+
+            if max_memory is not None:
+                packages_text = None
+                indexes = self._stream_packages(
+                    names, compress_using, release_hashes, max_memory, stage
+                )
+            else:
+                packages_text = self._serialise(names)
+                indexes = self._write_packages(
+                    packages_text, len(names), compress_using, release_hashes, stage
+                )
+
+            self._write_release(indexes, release_hashes, stage)
+
+        if stage is None:
+            # (a plaintext Packages file from an earlier build would be stale)
+            if "Packages" not in indexes and (self.root / "Packages").exists():
+                (self.root / "Packages").unlink()
+        else:
+            self._generations.publish(stage.number)  # type: ignore
+            self._generations.prune()  # type: ignore
+
+        self._build_metrics(names, indexes, time.perf_counter() - build_start)
+
+        return packages_text
+
+    def _build_metrics(
+        self,
+        names: List[str],
+        indexes: Dict[str, dict],
+        seconds: float,
+    ):
+        records = [
+            package_record
+            for package in names
+            for v in self._select(package)
+            for package_record in self._tree.records(package, v)
+        ]
+
+        self.metrics.set("mothman_build_duration_seconds", seconds)
+        self.metrics.set("mothman_build_timestamp_seconds", time.time())
+        self.metrics.set("mothman_packages", len(names))
+        self.metrics.set("mothman_package_files", len(records))
+        self.metrics.set("mothman_package_bytes", sum(r.size for r in records))
+
+        # the uncompressed size (the plaintext Packages file may not be built).
+        plain = indexes.get("Packages")
+        if plain is not None:
+            plain_size = plain["filesize"]
+        else:
+            plain_size = self.metrics.get("mothman_stage_bytes", stage="stanzas")
+
+        for name, info in indexes.items():
+            self.metrics.set("mothman_index_bytes", info["filesize"], file=name)
+            if plain_size and info["filesize"]:
+                self.metrics.set(
+                    "mothman_compression_ratio",
+                    plain_size / info["filesize"],
+                    format=name[len("Packages") :].lstrip(".") or "none",
+                )
+
+    async def build_async(
+        self,
+        *args,
+        executor: Optional["concurrent.futures.Executor"] = None,
+        progress: Optional[Progress] = None,
+        **kwargs,
+    ) -> Optional[str]:
+        """Like build(), but the build runs in an executor, so the event loop is not blocked.
+
+        If the task is cancelled, the build stops at the next package (or file),
+        and the task only finishes once it has stopped.
+        With generations, nothing is published; otherwise, the build can only be stopped
+        before it starts replacing the Packages files (after that, it finishes),
+        so the Packages files and Release always match.
+
+        Args:
+            *args: Passed to build().
+            executor: The executor to build in.
+                If None, the event loop's default executor is used. Defaults to None.
+            progress: If not None, called with progress events (on the event loop) instead of
+                the tree's listener (see Progress). Defaults to None.
+            **kwargs: Passed to build().
 
         Returns:
-            The Packages file content as a string.
+            See build().
 
         Raises:
-            DebError, if there are no packages added to this repo.
+            RuntimeError, if the tree is already being built by build_async().
         """
 
+        import asyncio
+        import threading
+
+        if self._cancelled is not None:
+            raise RuntimeError("the tree is already being built")
+
+        loop = asyncio.get_running_loop()
+
+        listener = None
+        if progress is not None:
+            listener = functools.partial(loop.call_soon_threadsafe, progress)
+
+        self._cancelled = threading.Event()
+        try:
+            with self.metrics.listening(listener):
+                return await self._build_async(executor, *args, **kwargs)
+        finally:
+            self._cancelled = None
+
+    async def _build_async(self, executor, *args, **kwargs) -> Optional[str]:
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(executor, functools.partial(self.build, *args, **kwargs))
+
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            _log.warning("cancelling build")
+            self._cancelled.set()
+            # the tree can't be used until the build has stopped.
+            await asyncio.wait([future])
+            if not future.cancelled():
+                # (so it isn't logged as never retrieved)
+                future.exception()
+            raise
+
+    def _serialise(self, names: List[str]) -> str:
+        # only serialise packages that changed since the last build,
+        # and splice them in with the rest (alphabetically).
         paragraphs = []
-        hashes: Dict[str, list] = {}
+        stanzas = {}
+        start = time.perf_counter()
+        rebuilt = 0
 
-        if not self._tree:
-            raise DebError(
-                "refusing to build without any packages; "
-                "did you forget to add any packages using .add_debs()?"
-            )
+        for done, package in enumerate(names, 1):
+            if package in self._dirty or package not in self._stanzas:
+                stanzas[package] = "".join(str(msg) for msg in self._build(package))
+                rebuilt += 1
+            else:
+                stanzas[package] = self._stanzas[package]
+
+            paragraphs.append(stanzas[package])
+            self._report("stanzas", done, len(names), len(stanzas[package]))
+
+        self._stanzas = stanzas
+        self._dirty.clear()
 
-        # iterate alphabetically
-        for package in sorted(self._tree):
-            for msg in self._build(package):
-                paragraphs.append(str(msg))
+        if self._cache is not None and self._owns_cache:
+            self._cache.save()
 
         _log.info(
             "[Packages] sucessfully built (total %s unique packages)",
-            str(len(self._tree)),
+            str(len(names)),
         )
         packages_text = "".join(paragraphs)
-        packages_path = self.root / "Packages"
+        self.metrics.set("mothman_stanzas_rebuilt", rebuilt)
+        self._log_stage("stanzas", time.perf_counter() - start, rebuilt, len(packages_text))
+
+        return packages_text
+
+    def _write_packages(
+        self,
+        packages_text: str,
+        count: int,
+        compress_using: list,
+        release_hashes: Tuple[str, ...],
+        stage: Optional["Stage"] = None,
+    ) -> Dict[str, dict]:
+        out = self.root if stage is None else stage.path
+        # every Packages file is the same if the text (and the hashes) are the same,
+        # so unchanged files can be reused from the previous generation.
+        key = None
+        if stage is not None:
+            key = hashlib.sha256(packages_text.encode("utf8")).hexdigest()
+            key = f"{key}:{','.join(release_hashes)}"
 
-        for fmt in compress_using:
-            compression = utils._lazy_import_compression(fmt)
-            packages_path = packages_path.with_suffix(fmt)
+        indexes = {}
+        for done, fmt in enumerate(compress_using, 1):
+            packages_path = out / f"Packages{fmt}"
+            start = time.perf_counter()
 
-            _log.info(
-                "[%s] compressing using %s", packages_path.name, compression.__name__
+            info = None if stage is None else stage.reuse(packages_path.name, key)  # type: ignore
+            if info is None:
+                _log.info("[%s] writing", packages_path.name)
+                with utils.open_hashed(packages_path, fmt, release_hashes) as (f, sink):
+                    f.write(packages_text)
+
+                info = sink.fileinfo()
+                if stage is not None:
+                    stage.add(packages_path.name, info, key)
+
+            indexes[packages_path.name] = info
+            self._log_stage(
+                packages_path.name,
+                time.perf_counter() - start,
+                count,
+                info["filesize"],
+            )
+            # without generations, each file replaces the one in the repo as soon as it
+            # is written, so the build can't stop until Release has been written too.
+            self._report(
+                "compress", done, len(compress_using), info["filesize"], stage is not None
             )
-            with compression.open(packages_path, mode="wt") as f:  # type: ignore
-                f.write(packages_text)
 
-            packages_hashes = utils.fileinfo(packages_path)
-            packages_size = packages_hashes.pop("filesize")
+        return indexes
 
-            # add hash of Packages file to Release
-            for name, digest in packages_hashes.items():
+    def _stream_packages(
+        self,
+        names: List[str],
+        compress_using: list,
+        release_hashes: Tuple[str, ...],
+        max_memory: int,
+        stage: Optional["Stage"] = None,
+    ) -> Dict[str, dict]:
+        # write each stanza to all Packages files as soon as it is serialised
+        # (the index is already in order, so nothing has to be sorted or joined).
+        # stanzas are only cached for the next build while they fit in max_memory.
+        stanzas: Optional[Dict[str, str]] = {}
+        cached_size = 0
+        size = 0
+        rebuilt = 0
+        start = time.perf_counter()
 
-                if name not in hashes:
-                    hashes[name] = []
+        with contextlib.ExitStack() as stack:
+            files = []
+            for fmt in compress_using:
+                packages_path = (self.root if stage is None else stage.path) / f"Packages{fmt}"
+                _log.info("[%s] writing", packages_path.name)
 
-                _log.debug("[%s] adding %s hash to Release", packages_path.name, name)
-                hashes[name].append(f" {digest} {packages_size} {packages_path.name}")
+                f, sink = stack.enter_context(
+                    utils.open_hashed(packages_path, fmt, release_hashes)
+                )
+                files.append((packages_path.name, f, sink))
 
-        for name, digests in hashes.items():
-            self._release[name] = "\n".join(digests)
+            for done, package in enumerate(names, 1):
+                stanza = None if package in self._dirty else self._stanzas.get(package)
+                if stanza is None:
+                    stanza = "".join(str(msg) for msg in self._build(package))
+                    rebuilt += 1
 
-        _log.info("[Release] building file")
-        with self.release_path.open(mode="w") as f:
-            f.write(str(self._release))
+                for _, f, _ in files:
+                    f.write(stanza)
+                size += len(stanza)
 
-        return packages_text
+                if stanzas is not None:
+                    stanzas[package] = stanza
+                    cached_size += len(stanza)
+
+                    if cached_size > max_memory:
+                        _log.debug(
+                            "[Packages] stanzas are over %s bytes, not caching them", max_memory
+                        )
+                        # the old cache can go too.
+                        stanzas = None
+                        self._stanzas = {}
+
+                self._report("stanzas", done, len(names), len(stanza))
+
+        self._stanzas = stanzas or {}
+        self._dirty.clear()
+
+        if self._cache is not None and self._owns_cache:
+            self._cache.save()
+
+        _log.info(
+            "[Packages] sucessfully built (total %s unique packages)",
+            str(len(names)),
+        )
+        self.metrics.set("mothman_stanzas_rebuilt", rebuilt)
+        self._log_stage("stanzas", time.perf_counter() - start, rebuilt, size)
+
+        indexes = {name: sink.fileinfo() for name, _, sink in files}
+        if stage is not None:
+            for name, info in indexes.items():
+                stage.add(name, info)
+
+        return indexes
+
+    def _write_release(
+        self, indexes: Dict[str, dict], hashes: Iterable[str], stage: Optional["Stage"] = None
+    ):
+        # indexes maps filenames (relative to the root) to their file info.
+        for name in hashes:
+            field = utils.RELEASE_FIELDS[name]
+            _log.debug("[Release] adding %s hashes", field)
+
+            # (setting a field adds another one, so the hashes from the last build go first)
+            del self._release[field]
+            self._release[field] = "\n".join(
+                f" {info[name]} {info['filesize']} {filename}"
+                for filename, info in indexes.items()
+            )
+
+        _log.info("[Release] building file")
+        if stage is None:
+            with utils.open_atomic(self.release_path) as f:
+                f.write(str(self._release))
+        else:
+            with utils.open_hashed(stage.path / "Release", CAT, self._digests) as (f, sink):
+                f.write(str(self._release))
+            stage.add("Release", sink.fileinfo())
 
 
 if __name__ == "__main__":
@@ -1,16 +1,19 @@
 # coding: utf8
 """Utils."""
 
+import contextlib
 import email
+import email.message
 import hashlib
 import importlib
+import io
 import logging
 import os
 import pathlib
 import re
 import sys
 
-from typing import Any, Dict, Union
+from typing import IO, Any, Dict, Generator, Iterable, List, Tuple, Union
 
 # Type hints
 Path = Union[str, pathlib.Path]
@@ -27,7 +30,49 @@ GZIP = ".gz"
 BZIP2 = ".bz2"
 XZ = ".xz"
 
+# Default hashes for package files (and the Packages files in Release).
 FILEINFO_HASHES = ("md5", "sha1", "sha256")
+# Only hashes modern clients need.
+FAST_HASHES = ("sha256",)
+
+# Packages file fields for each supported hash.
+# (BLAKE2 fields are not part of the Debian spec, but are ignored by clients that don't know them.)
+PACKAGES_FIELDS = {
+    "md5": "MD5sum",
+    "sha1": "SHA1",
+    "sha256": "SHA256",
+    "sha512": "SHA512",
+    "blake2b": "BLAKE2b",
+    "blake2s": "BLAKE2s",
+}
+
+# Release file fields for each supported hash.
+RELEASE_FIELDS = {
+    "md5": "MD5Sum",
+    "sha1": "SHA1",
+    "sha256": "SHA256",
+    "sha512": "SHA512",
+    "blake2b": "BLAKE2b",
+    "blake2s": "BLAKE2s",
+}
+
+# Constructors for compressed file objects (wrapping another file object).
+_COMPRESSORS = {
+    "io": lambda m, f: io.BufferedWriter(f),
+    # mtime=0, so the same content always compresses to the same bytes.
+    "gzip": lambda m, f: m.GzipFile(fileobj=f, mode="wb", mtime=0),
+    "bz2": lambda m, f: m.BZ2File(f, mode="wb"),
+    "lzma": lambda m, f: m.LZMAFile(f, mode="wb"),
+}
+
+
+# Constructors for decompressing file objects (wrapping another file object).
+_DECOMPRESSORS = {
+    "io": lambda m, f: io.BufferedReader(f),
+    "gzip": lambda m, f: m.GzipFile(fileobj=f, mode="rb"),
+    "bz2": lambda m, f: m.BZ2File(f, mode="rb"),
+    "lzma": lambda m, f: m.LZMAFile(f, mode="rb"),
+}
 
 
 def _lazy_import(module_name):
@@ -46,6 +91,29 @@ def _lazy_import_compression(fmt):
     return _lazy_import(PACKAGES_COMPRESSION[fmt])
 
 
+def _compressor(fmt: str, fileobj: IO[bytes]) -> IO[bytes]:
+    module_name = PACKAGES_COMPRESSION[fmt]
+    return _COMPRESSORS[module_name](_lazy_import(module_name), fileobj)
+
+
+def _decompressor(fmt: str, fileobj: IO[bytes]) -> IO[bytes]:
+    module_name = PACKAGES_COMPRESSION[fmt]
+    return _DECOMPRESSORS[module_name](_lazy_import(module_name), fileobj)
+
+
+def user_cache_dir() -> pathlib.Path:
+    """Get the user-level cache directory for mothman
+    ($MOTHMAN_CACHE_DIR, or mothman/ under $XDG_CACHE_HOME or ~/.cache).
+    """
+
+    path = os.environ.get("MOTHMAN_CACHE_DIR")
+    if path:
+        return pathlib.Path(path)
+
+    cache_home = os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache"
+    return pathlib.Path(cache_home) / "mothman"
+
+
 def _filename(response):
     return re.findall(r"filename=(.+)", response.headers["content-disposition"])[0]
 
@@ -87,7 +155,36 @@ def extract_packages(dir: Path) -> Union[email.message.Message, None]:
     return None
 
 
-def fileinfo(path: Path, chunksize: int = 1024) -> Dict[str, Any]:
+def check_hashes(hashes: Iterable[str]) -> Tuple[str, ...]:
+    """Check that all hashes are supported (keys of PACKAGES_FIELDS).
+
+    Args:
+        hashes: The names of the hashes.
+
+    Returns:
+        The hashes as a tuple, without duplicates.
+
+    Raises:
+        ValueError, if any hash is not supported or no hashes were given.
+    """
+
+    hashes = tuple(dict.fromkeys(h.lower() for h in hashes))
+
+    unsupported = [h for h in hashes if h not in PACKAGES_FIELDS]
+    if unsupported:
+        raise ValueError(
+            f"unsupported hash(es) {', '.join(unsupported)} "
+            f"(must be one of {', '.join(PACKAGES_FIELDS)})"
+        )
+    if not hashes:
+        raise ValueError("at least one hash is required")
+
+    return hashes
+
+
+def fileinfo(
+    path: Path, chunksize: int = 65536, hashes: Iterable[str] = FILEINFO_HASHES
+) -> Dict[str, Any]:
     """Get info for a file in a dictionary format:
     {
         "md5": ... # hashes
@@ -99,13 +196,14 @@ def fileinfo(path: Path, chunksize: int = 1024) -> Dict[str, Any]:
     Args:
         path: The path to the file.
         chunksize: How many bytes to update the hashes with.
-            Defaults to 1024 (1kB).
+            Defaults to 65536 (64kB).
+        hashes: The names of the hashes to compute. Defaults to FILEINFO_HASHES.
 
     Returns:
         The file info.
     """
 
-    hashes = [getattr(hashlib, h)() for h in FILEINFO_HASHES]
+    hashes = [hashlib.new(h) for h in hashes]
 
     with open(path, "rb") as f:
         while True:
@@ -120,3 +218,164 @@ def fileinfo(path: Path, chunksize: int = 1024) -> Dict[str, Any]:
     fileinfo["filesize"] = os.path.getsize(path)
 
     return fileinfo
+
+
+def iter_paragraphs(lines: Iterable[str]) -> Generator[email.message.Message, None, None]:
+    """Parse paragraphs (stanzas) from the lines of a Packages-like file one at a time,
+    so the whole file never has to be in memory.
+
+    Args:
+        lines: The lines of the file (i.e a text file object).
+
+    Yields:
+        Each paragraph as a Message object.
+    """
+
+    paragraph: List[str] = []
+
+    for line in lines:
+        if line.strip():
+            paragraph.append(line)
+        elif paragraph:
+            yield email.message_from_string("".join(paragraph))
+            paragraph = []
+
+    if paragraph:
+        yield email.message_from_string("".join(paragraph))
+
+
+class HashingReader(io.RawIOBase):
+    """A read-only binary file that hashes and counts bytes as they are read
+    from another file object (the counterpart to HashingWriter).
+
+    Args:
+        fileobj: The file object to read from.
+        hashes: The names of the hashes to compute (see hashlib).
+            Defaults to FILEINFO_HASHES.
+    """
+
+    def __init__(self, fileobj: IO[bytes], hashes: Iterable[str] = FILEINFO_HASHES):
+        super().__init__()
+        self._fileobj = fileobj
+        self._hashes = [hashlib.new(h) for h in hashes]
+        self._size = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._fileobj.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+
+        for hash_object in self._hashes:
+            hash_object.update(data)
+
+        self._size += size
+        return size
+
+    def fileinfo(self) -> Dict[str, Any]:
+        """Get info for the bytes read so far, in the same format as fileinfo()."""
+
+        info: Dict[str, Any] = {h.name: h.hexdigest() for h in self._hashes}
+        info["filesize"] = self._size
+
+        return info
+
+
+class HashingWriter(io.RawIOBase):
+    """A write-only binary file that hashes and counts bytes as they are written
+    through to another file object, so the file never has to be read back
+    to get its file info.
+
+    Args:
+        fileobj: The file object to write to.
+        hashes: The names of the hashes to compute (see hashlib).
+            Defaults to FILEINFO_HASHES.
+    """
+
+    def __init__(self, fileobj: IO[bytes], hashes: Iterable[str] = FILEINFO_HASHES):
+        super().__init__()
+        self._fileobj = fileobj
+        self._hashes = [hashlib.new(h) for h in hashes]
+        self._size = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._fileobj.write(data)
+
+        for hash_object in self._hashes:
+            hash_object.update(data)
+
+        size = len(memoryview(data).cast("B"))
+        self._size += size
+        return size
+
+    def flush(self):
+        super().flush()
+        self._fileobj.flush()
+
+    def fileinfo(self) -> Dict[str, Any]:
+        """Get info for the bytes written so far, in the same format as fileinfo()."""
+
+        info: Dict[str, Any] = {h.name: h.hexdigest() for h in self._hashes}
+        info["filesize"] = self._size
+
+        return info
+
+
+@contextlib.contextmanager
+def open_atomic(path: Path, mode: str = "w", **kwargs) -> Generator[IO, None, None]:
+    """Open a file for writing atomically: everything is written to a temporary file
+    next to it, which replaces the file only once it is closed without errors
+    (so readers never see a half-written file).
+
+    Args:
+        path: The path to the file.
+        mode: The mode to open the file in (must be a write mode). Defaults to 'w'.
+        **kwargs: Passed to open().
+
+    Yields:
+        The (temporary) file object.
+    """
+
+    path = pathlib.Path(path)
+    # (unique to this writer, so concurrent writers in other threads/processes don't mix)
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.{os.urandom(4).hex()}.tmp")
+
+    try:
+        with open(temp_path, mode, **kwargs) as f:
+            yield f
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+
+@contextlib.contextmanager
+def open_hashed(
+    path: Path,
+    fmt: str = CAT,
+    hashes: Iterable[str] = FILEINFO_HASHES,
+) -> Generator[Tuple[IO[str], HashingWriter], None, None]:
+    """Open a (compressed) text file for writing, hashing the bytes written to disk.
+
+    Args:
+        path: The path to the file.
+        fmt: The compression format (one of CAT, GZIP, BZIP2, or XZ).
+            Defaults to CAT (no compression).
+        hashes: The names of the hashes to compute. Defaults to FILEINFO_HASHES.
+
+    Yields:
+        A tuple of (text file, sink). After the file is closed,
+        sink.fileinfo() returns the file info of the file written.
+    """
+
+    with open_atomic(path, "wb") as raw:
+        sink = HashingWriter(raw, hashes)
+        with io.TextIOWrapper(
+            _compressor(fmt, sink), encoding="utf8", newline="\n"  # type: ignore
+        ) as f:
+            yield f, sink
@@ -0,0 +1,258 @@
+# coding: utf8
+"""Verify a published repo: every index listed in Release and every package file
+listed in Packages must match its recorded size and digests.
+"""
+
+import collections
+import concurrent.futures
+import email
+import email.message
+import hashlib
+import io
+import logging
+import mmap
+import os
+import pathlib
+import posixpath
+from typing import Deque, Dict, Optional, Tuple
+
+from mothman import utils
+from mothman.utils import Path
+
+__all__ = ["VerifyError", "check_file", "release_entries", "verify"]
+
+_log = logging.getLogger("mothman")
+
+CHUNKSIZE = 1 << 20
+
+# Packages files to verify packages from, in order of preference
+# (uncompressed is the fastest to read).
+PACKAGES_FORMATS = (utils.CAT, utils.GZIP, utils.XZ, utils.BZIP2)
+
+# (size, {hash name: hex digest})
+Entry = Tuple[Optional[int], Dict[str, str]]
+
+
+class VerifyError(Exception):
+    pass
+
+
+def check_file(path: Path, size: Optional[int], digests: Dict[str, str]) -> Optional[str]:
+    """Check that a file has the given size and digests.
+    The file is memory-mapped and hashed for all digests in one pass,
+    but only if its size matches.
+
+    Args:
+        path: The path to the file.
+        size: The expected size, or None to not check the size.
+        digests: A dict of hash names to the expected hex digests.
+
+    Returns:
+        None if the file matches, otherwise the reason it doesn't (as a string).
+    """
+
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return "missing"
+
+    if size is not None and stat.st_size != size:
+        return f"size mismatch (expected {size}, got {stat.st_size})"
+
+    hashers = {name: hashlib.new(name) for name in digests}
+
+    if stat.st_size and hashers:
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            with memoryview(m) as view:
+                for offset in range(0, len(view), CHUNKSIZE):
+                    chunk = view[offset : offset + CHUNKSIZE]
+                    for hasher in hashers.values():
+                        hasher.update(chunk)
+                    chunk.release()
+
+    mismatched = [
+        name for name, hasher in hashers.items() if hasher.hexdigest() != digests[name].lower()
+    ]
+    if mismatched:
+        return f"{', '.join(mismatched)} mismatch"
+
+    return None
+
+
+def release_entries(
+    release: email.message.Message,
+) -> Tuple[Dict[str, Entry], Dict[str, str]]:
+    """Get the index files listed in a Release file.
+
+    Args:
+        release: The parsed Release file.
+
+    Returns:
+        A tuple of (a dict of filenames to their (size, digests),
+        a dict of malformed lines (or their filenames) to the reason they are malformed).
+    """
+
+    entries: Dict[str, Entry] = {}
+    malformed: Dict[str, str] = {}
+
+    for name, field in utils.RELEASE_FIELDS.items():
+        value = release.get(field)
+        if value is None:
+            continue
+
+        for line in value.splitlines():
+            parts = line.split()
+            if not parts:
+                continue
+            if len(parts) != 3:
+                malformed[line.strip()] = f"malformed {field} line"
+                continue
+
+            digest, size, filename = parts
+            if not size.isdigit():
+                malformed[filename] = f"malformed {field} line (invalid size {size!r})"
+                continue
+
+            entries.setdefault(filename, (int(size), {}))[1][name] = digest
+
+    return entries, malformed
+
+
+def _stanza_entry(stanza: email.message.Message) -> Entry:
+    # raises ValueError if the size is invalid.
+    size = stanza.get("Size")
+    if size is not None and not size.strip().isdigit():
+        raise ValueError(f"invalid size {size!r}")
+
+    digests = {
+        name: stanza[field]
+        for name, field in utils.PACKAGES_FIELDS.items()
+        if stanza.get(field) is not None
+    }
+    return (int(size) if size is not None else None), digests
+
+
+def _resolve(root: pathlib.Path, filename: str) -> Optional[pathlib.Path]:
+    path = pathlib.PurePosixPath(posixpath.normpath(filename))
+    # (not a prefix check: '..foo.deb' is a valid name)
+    if path.is_absolute() or ".." in path.parts:
+        return None
+    return root / path
+
+
+def verify(root: Path, workers: Optional[int] = None) -> dict:
+    """Verify a repo (i.e after it was copied to a web host).
+
+    All index files listed in Release are checked, then the package files in the
+    (first available) Packages file are checked as the file is read, on a process pool.
+
+    Args:
+        root: The root of the repo.
+        workers: The number of worker processes.
+            If None, the default of concurrent.futures.ProcessPoolExecutor is used.
+            Defaults to None.
+
+    Returns:
+        A report as a dict (JSON-serialisable):
+        {
+            "ok": ...,  # True if everything matched
+            "indexes": {"Packages.gz": None or "reason", ...},
+            "packages": ...,  # number of package files checked
+            "failed": {"debs/example.deb": "reason", ...},
+        }
+
+    Raises:
+        VerifyError, if there is no Release or Packages file.
+    """
+
+    root = pathlib.Path(root)
+
+    try:
+        with (root / "Release").open(encoding="utf8") as f:
+            release = email.message_from_file(f)
+    except FileNotFoundError:
+        raise VerifyError(f"no Release file in {root}")
+
+    report: dict = {"ok": True, "indexes": {}, "packages": 0, "failed": {}}
+
+    entries, malformed = release_entries(release)
+    report["indexes"].update(malformed)
+
+    with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+        futures = {}
+        for filename, (size, digests) in entries.items():
+            if filename in malformed:
+                continue
+
+            path = _resolve(root, filename)
+            if path is None:
+                report["indexes"][filename] = "outside of the repo"
+            else:
+                futures[filename] = pool.submit(check_file, path, size, digests)
+
+        for filename, future in futures.items():
+            report["indexes"][filename] = future.result()
+
+        for filename, reason in report["indexes"].items():
+            if reason is not None:
+                _log.error("[%s] %s", filename, reason)
+
+        packages_path = next(
+            (root / f"Packages{fmt}" for fmt in PACKAGES_FORMATS if (root / f"Packages{fmt}").is_file()),
+            None,
+        )
+        if packages_path is None:
+            raise VerifyError(f"no Packages file in {root}")
+
+        _log.info("[%s] verifying package files", packages_path.name)
+
+        # only keep so many checks in flight, so a huge Packages file isn't read all at once.
+        pending: Deque[Tuple[str, concurrent.futures.Future]] = collections.deque()
+        limit = (workers or os.cpu_count() or 1) * 4
+
+        def collect(filename, future):
+            report["packages"] += 1
+            reason = future.result()
+            if reason is not None:
+                _log.error("[%s] %s", filename, reason)
+                report["failed"][filename] = reason
+
+        fmt = packages_path.name[len("Packages") :]
+        with packages_path.open("rb") as raw, io.TextIOWrapper(
+            utils._decompressor(fmt, raw), encoding="utf8"  # type: ignore
+        ) as f:
+            for stanza in utils.iter_paragraphs(f):
+                filename = stanza.get("Filename")
+                if filename is None:
+                    continue
+
+                path = _resolve(root, filename)
+                if path is None:
+                    report["packages"] += 1
+                    report["failed"][filename] = "outside of the repo"
+                    continue
+
+                try:
+                    entry = _stanza_entry(stanza)
+                except ValueError as e:
+                    report["packages"] += 1
+                    report["failed"][filename] = f"malformed stanza ({e})"
+                    continue
+
+                pending.append((filename, pool.submit(check_file, path, *entry)))
+                if len(pending) >= limit:
+                    collect(*pending.popleft())
+
+        while pending:
+            collect(*pending.popleft())
+
+    report["ok"] = not report["failed"] and all(r is None for r in report["indexes"].values())
+
+    _log.info(
+        "verified %s index(es) and %s package file(s): %s failed",
+        len(report["indexes"]),
+        report["packages"],
+        len(report["failed"]) + sum(r is not None for r in report["indexes"].values()),
+    )
+
+    return report
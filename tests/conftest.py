@@ -0,0 +1,106 @@
+# coding: utf8
+
+import io
+import pathlib
+import tarfile
+
+import pytest
+
+from mothman import tree
+
+RELEASE = """\
+Origin: Test
+Label: Test
+Suite: stable
+Version: 1.0
+Codename: tangelo
+Architectures: iphoneos-arm
+Components: main
+Description: A test repo
+"""
+
+
+def tarball(files: dict) -> bytes:
+    """A .tar.gz of files (name -> content) as bytes."""
+
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, data in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def ar_archive(members) -> bytes:
+    """An ar archive of (name, content) pairs as bytes."""
+
+    out = b"!<arch>\n"
+    for name, data in members:
+        header = f"{name:<16}{0:<12}{0:<6}{0:<6}{'100644':<8}{len(data):<10}`\n"
+        out += header.encode("ascii") + data
+        if len(data) % 2:
+            out += b"\n"
+    return out
+
+
+def deb_bytes(package, version, arch="iphoneos-arm", depends=None, fields=None, data=None):
+    """A Debian package file as bytes."""
+
+    control = {
+        "Package": package,
+        "Version": version,
+        "Architecture": arch,
+        "Maintainer": "Someone <someone@example.com>",
+        "Description": f"The {package} package",
+    }
+    if depends is not None:
+        control["Depends"] = depends
+    control.update(fields or {})
+
+    control_text = "".join(f"{k}: {v}\n" for k, v in control.items()).encode("utf8")
+    data = data or {"./usr/share/doc/readme": f"{package} {version}".encode("utf8")}
+
+    return ar_archive(
+        [
+            ("debian-binary", b"2.0\n"),
+            ("control.tar.gz", tarball({"./control": control_text})),
+            ("data.tar.gz", tarball(data)),
+        ]
+    )
+
+
+@pytest.fixture
+def make_deb():
+    """Write a Debian package file: make_deb(path, package, version, **kwargs)."""
+
+    def _make_deb(path, package, version, **kwargs) -> pathlib.Path:
+        path = pathlib.Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(deb_bytes(package, version, **kwargs))
+        return path
+
+    return _make_deb
+
+
+@pytest.fixture
+def repo_root(tmp_path):
+    """An empty repo (only a Release file)."""
+
+    root = tmp_path / "repo"
+    root.mkdir()
+    (root / "Release").write_text(RELEASE)
+    return root
+
+
+@pytest.fixture
+def built_repo(repo_root, make_deb):
+    """A built repo with a few packages (in debs/)."""
+
+    for name, version in [("com.ex.a", "1.0"), ("com.ex.a", "1.1"), ("com.ex.b", "2.0")]:
+        make_deb(repo_root / "debs" / f"{name}_{version}.deb", name, version)
+
+    debian_tree = tree.DebianTree(repo_root, scan_cache=False)
+    debian_tree.add_debs(repo_root / "debs")
+    debian_tree.build()
+    return repo_root
@@ -0,0 +1,59 @@
+# coding: utf8
+
+from mothman import assets
+
+
+def test_referenced():
+    control = {"Icon": "file:///Library/MyTweak/icon.png"}
+    other_info = {
+        "header_image": "https://example.com/header.png",
+        "screenshots": ["file:///Library/MyTweak/shot1.png", "file://Library/MyTweak/icon.png"],
+    }
+
+    assert assets.referenced(control, other_info) == [
+        "/Library/MyTweak/icon.png",
+        "/Library/MyTweak/shot1.png",
+    ]
+
+
+def test_extract(make_deb, tmp_path):
+    deb = make_deb(
+        tmp_path / "a.deb",
+        "com.ex.a",
+        "1.0",
+        data={
+            "./Library/icon.png": b"icon",
+            "./.hidden/x.png": b"hidden",
+            "./hidden/x.png": b"not hidden",
+        },
+    )
+
+    found = assets.extract(deb, ["/Library/icon.png", "/.hidden/x.png", "/missing.png"])
+
+    assert found == {"/Library/icon.png": b"icon", "/.hidden/x.png": b"hidden"}
+
+
+def test_cache(make_deb, tmp_path):
+    deb = make_deb(tmp_path / "a.deb", "com.ex.a", "1.0", data={"./icon.png": b"icon"})
+    cache = assets.AssetCache(tmp_path / "cache")
+
+    assert cache.get("ab" * 32, ["/icon.png"]) is None
+
+    cache.put("ab" * 32, ["/icon.png", "/missing.png"], assets.extract(deb, ["/icon.png"]))
+    cached = cache.get("ab" * 32, ["/icon.png", "/missing.png"])
+
+    assert cached["/icon.png"].read_bytes() == b"icon"
+    assert cached["/missing.png"] is None
+
+
+def test_rewrite():
+    other_info = {"screenshots": ["file:///a.png", "https://example.com/b.png"]}
+    urls = {"/a.png": "https://repo/assets/a.png", "/icon.png": "https://repo/assets/icon.png"}
+
+    rewritten = assets.rewrite({"Icon": "file:///icon.png"}, other_info, urls)
+
+    assert rewritten == {
+        "screenshots": ["https://repo/assets/a.png", "https://example.com/b.png"],
+        "icon": "https://repo/assets/icon.png",
+    }
+    assert other_info["screenshots"][0] == "file:///a.png"
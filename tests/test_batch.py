@@ -0,0 +1,83 @@
+# coding: utf8
+
+import concurrent.futures
+import json
+import os
+
+import pytest
+
+from mothman import batch, cache, pydpkg, repo
+
+from conftest import RELEASE
+
+
+@pytest.fixture
+def repos(tmp_path, make_deb, monkeypatch):
+    # two repos with the same deb (hardlinked in one, copied in the other).
+    monkeypatch.setenv("MOTHMAN_CACHE_DIR", str(tmp_path / "cache"))
+    shared = make_deb(tmp_path / "shared.deb", "com.ex.a", "1.0", depends="firmware (>= 12.0)")
+
+    roots = {}
+    for name in ("one", "two"):
+        root = tmp_path / name
+        (root / "debians").mkdir(parents=True)
+        (root / repo.CONFIG_NAME).write_text(json.dumps(repo.TEMPLATES["repo.me"]))
+        (root / "Release").write_text(RELEASE)
+        roots[root] = f"{name}.example.com"
+
+    os.link(shared, tmp_path / "one" / "debians" / "com.ex.a_1.0.deb")
+    (tmp_path / "two" / "debians" / "com.ex.a_1.0.deb").write_bytes(shared.read_bytes())
+
+    return roots
+
+
+@pytest.fixture
+def parsed(monkeypatch):
+    # the package files parsed (by any module).
+    files = []
+
+    class CountingDpkg(pydpkg.Dpkg):
+        def __init__(self, filename, *args, **kwargs):
+            files.append(filename)
+            super().__init__(filename, *args, **kwargs)
+
+    monkeypatch.setattr(pydpkg, "Dpkg", CountingDpkg)
+    return files
+
+
+def test_build_all_parses_shared_deb_once(repos, parsed, tmp_path):
+    scan_cache = cache.SharedScanCache(tmp_path / "scan.json")
+
+    results = batch.build_all(repos, workers=2, scan_cache=scan_cache)
+
+    assert results == {str(root): None for root in repos}
+    assert len(parsed) == 1
+    for root in repos:
+        assert "Package: com.ex.a" in (root / "Packages").read_text()
+
+    # nothing is parsed (or hashed) again.
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        assert batch.prescan(repos, scan_cache, pool) == 0
+    assert len(parsed) == 1
+
+
+def test_build_all_reports_failures(repos, tmp_path):
+    # (a repo without a Release file can't be built, but the others still are)
+    (tmp_path / "one" / "Release").unlink()
+
+    results = batch.build_all(repos, scan_cache=cache.SharedScanCache(tmp_path / "scan.json"))
+
+    assert isinstance(results[str(tmp_path / "one")], FileNotFoundError)
+    assert results[str(tmp_path / "two")] is None
+    assert (tmp_path / "two" / "Packages").is_file()
+
+
+def test_prescan_debtype(repos, tmp_path):
+    for root in repos:
+        for deb in (root / "debians").iterdir():
+            deb.rename(deb.with_suffix(".udeb"))
+
+    scan_cache = cache.SharedScanCache(tmp_path / "scan.json")
+    with concurrent.futures.ThreadPoolExecutor(2) as pool:
+        assert batch.prescan(repos, scan_cache, pool) == 0
+        assert batch.prescan(repos, scan_cache, pool, debtype="udeb") == 2
@@ -0,0 +1,124 @@
+# coding: utf8
+
+import json
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from mothman import cache, cli, pydpkg, repo, tree, utils
+
+
+@pytest.fixture
+def reads(monkeypatch):
+    # the package files parsed, and the (file, hashes) hashed.
+    calls = {"parsed": [], "hashed": []}
+    fileinfo = utils.fileinfo
+
+    class CountingDpkg(pydpkg.Dpkg):
+        def __init__(self, filename, *args, **kwargs):
+            calls["parsed"].append(os.path.basename(filename))
+            super().__init__(filename, *args, **kwargs)
+
+    def counting_fileinfo(path, *args, hashes=utils.FILEINFO_HASHES, **kwargs):
+        calls["hashed"].append((os.path.basename(path), tuple(sorted(hashes))))
+        return fileinfo(path, *args, hashes=hashes, **kwargs)
+
+    monkeypatch.setattr(pydpkg, "Dpkg", CountingDpkg)
+    monkeypatch.setattr(utils, "fileinfo", counting_fileinfo)
+    return calls
+
+
+def _scan(root, **kwargs):
+    debian_tree = tree.DebianTree(root, **kwargs)
+    debian_tree.add_debs(root / "debs")
+    return debian_tree
+
+
+def test_hit_skips_reading(built_repo, reads):
+    first = _scan(built_repo).build()
+    assert len(reads["parsed"]) == 3
+    reads["parsed"].clear()
+    reads["hashed"].clear()
+
+    second = _scan(built_repo)
+
+    assert reads == {"parsed": [], "hashed": []}
+    assert second.metrics.get("mothman_scan_cache_hits") == 3
+    assert second.build() == first
+
+
+def test_new_digest_only_hashes_that(built_repo, reads):
+    _scan(built_repo, digests=("sha256",))
+    reads["parsed"].clear()
+    reads["hashed"].clear()
+
+    packages = _scan(built_repo, digests=("sha256", "sha512")).build()
+
+    assert reads["parsed"] == []
+    assert sorted(reads["hashed"]) == [
+        ("com.ex.a_1.0.deb", ("sha512",)),
+        ("com.ex.a_1.1.deb", ("sha512",)),
+        ("com.ex.b_2.0.deb", ("sha512",)),
+    ]
+    assert packages.count("SHA512: ") == 3
+    assert "MD5sum" not in packages
+
+
+def test_changed_file_is_rescanned(built_repo, reads, make_deb):
+    _scan(built_repo)
+    reads["parsed"].clear()
+
+    # a new mtime (same content), and new content (a different size).
+    deb = built_repo / "debs" / "com.ex.a_1.0.deb"
+    stat = deb.stat()
+    os.utime(deb, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    make_deb(built_repo / "debs" / "com.ex.b_2.0.deb", "com.ex.b", "2.0", fields={"Name": "B"})
+
+    debian_tree = _scan(built_repo)
+
+    assert sorted(reads["parsed"]) == ["com.ex.a_1.0.deb", "com.ex.b_2.0.deb"]
+    assert "Name: B" in debian_tree.build()
+
+
+def test_entry_validity(tmp_path):
+    file = tmp_path / "a.deb"
+    file.write_bytes(b"a")
+    scan_cache = cache.ScanCache(tmp_path / "scan.json")
+    scan_cache.put(file, file.stat(), (("Package", "a"),), {"sha256": "00"})
+    scan_cache.save()
+
+    loaded = cache.ScanCache(tmp_path / "scan.json")
+    assert loaded.get(file, file.stat()) == ((("Package", "a"),), {"sha256": "00"})
+
+    file.write_bytes(b"ab")
+    assert loaded.get(file, file.stat()) is None
+
+    file.unlink()
+    assert loaded.prune() == [str(file.resolve())]
+
+
+def test_corrupt_cache_is_ignored(tmp_path):
+    (tmp_path / "scan.json").write_text("{not json")
+
+    assert len(cache.ScanCache(tmp_path / "scan.json")) == 0
+
+
+@pytest.mark.parametrize(
+    "args, fields",
+    [
+        (["--fast"], ["SHA256"]),
+        (["-d", "sha1", "-d", "sha512"], ["SHA1", "SHA512"]),
+        ([], ["MD5sum", "SHA1", "SHA256"]),
+    ],
+)
+def test_cli_digests(repo_root, make_deb, monkeypatch, args, fields):
+    monkeypatch.setenv("MOTHMAN_CACHE_DIR", str(repo_root.parent / "cache"))
+    (repo_root / repo.CONFIG_NAME).write_text(json.dumps(repo.TEMPLATES["repo.me"]))
+    make_deb(repo_root / "debians" / "a.deb", "com.ex.a", "1.0", depends="firmware (>= 12.0)")
+
+    result = CliRunner().invoke(cli.cli, ["build", "example.com", "-p", str(repo_root), *args])
+    assert result.exit_code == 0, result.output
+
+    packages = (repo_root / "Packages").read_text()
+    assert [f for f in utils.PACKAGES_FIELDS.values() if f"\n{f}: " in packages] == fields
@@ -0,0 +1,130 @@
+# coding: utf8
+
+from mothman.check import Checker
+from mothman.record import PackageRecord
+
+
+def _record(name, version, depends=None, provides=None):
+    fields = [("Package", name), ("Version", version), ("Architecture", "iphoneos-arm")]
+    if depends is not None:
+        fields.append(("Depends", depends))
+    if provides is not None:
+        fields.append(("Provides", provides))
+    return PackageRecord(f"/repo/{name}_{version}.deb", tuple(fields), (), 0)
+
+
+def _uninstallable(*records):
+    return {"_".join(k[:2]): v for k, v in Checker(records).uninstallable().items()}
+
+
+def test_installable():
+    assert not _uninstallable(
+        _record("a", "1.0", "b (>= 1.0), c | d"),
+        _record("b", "1.2"),
+        _record("d", "1.0"),
+        _record("e", "1.0", "virtual (= 2.0), firmware (>= 12.0), mobilesubstrate"),
+        _record("f", "1.0", provides="virtual (= 2.0)"),
+        _record("mobilesubstrate", "0.9"),
+    )
+
+
+def test_missing_and_unsatisfiable():
+    assert _uninstallable(
+        _record("a", "1.0", "missing"),
+        _record("b", "1.0", "c (>> 2.0)"),
+        _record("c", "2.0"),
+        _record("d", "1.0", "c (<< 2.0) | missing"),
+    ) == {
+        "a_1.0": ["missing"],
+        "b_1.0": ["c (>> 2.0)"],
+        "d_1.0": ["c (<< 2.0) | missing"],
+    }
+
+
+def test_propagates_to_dependents():
+    assert _uninstallable(
+        _record("a", "1.0", "b"),
+        _record("b", "1.0", "c"),
+        _record("c", "1.0", "missing"),
+        # an alternative keeps it installable.
+        _record("d", "1.0", "b | c | e"),
+        _record("e", "1.0"),
+    ) == {
+        "a_1.0": ["b"],
+        "b_1.0": ["c"],
+        "c_1.0": ["missing"],
+    }
+
+
+def test_cycle_is_installable():
+    checker = Checker(
+        [
+            _record("a", "1.0", "b"),
+            _record("b", "1.0", "c"),
+            _record("c", "1.0", "a"),
+            _record("d", "1.0", "d"),
+            _record("e", "1.0", "a"),
+        ]
+    )
+
+    assert not checker.uninstallable()
+    assert checker.cycles() == [["a", "b", "c"], ["d"]]
+
+
+def test_firmware_ranges():
+    assert _uninstallable(
+        _record("ok", "1.0", "firmware (>= 12.0), firmware (<< 15.0)"),
+        _record("exact", "1.0", "firmware (>= 14.0), firmware (<= 14.0)"),
+        _record("empty", "1.0", "firmware (>= 14.0), firmware (<< 13.0)"),
+        _record("touching", "1.0", "firmware (>= 14.0), firmware (<< 14.0)"),
+        _record("equal", "1.0", "firmware (= 13.0), firmware (>> 13.0)"),
+        # alternatives are not checked.
+        _record("either", "1.0", "firmware (>= 14.0) | firmware (<< 13.0)"),
+        _record("dependent", "1.0", "empty"),
+    ) == {
+        "dependent_1.0": ["empty"],
+        "empty_1.0": ["firmware (>= 14.0), firmware (<< 13.0)"],
+        "equal_1.0": ["firmware (= 13.0), firmware (>> 13.0)"],
+        "touching_1.0": ["firmware (>= 14.0), firmware (<< 14.0)"],
+    }
+
+
+def test_check_report():
+    report = Checker([_record("a", "1.0", "missing"), _record("b", "1.0", "b")]).check()
+
+    assert report == {
+        "packages": 2,
+        "uninstallable": {"a_1.0_iphoneos-arm": ["missing"]},
+        "cycles": [["b"]],
+    }
+
+
+def test_mixed_case_names_and_versions():
+    assert _uninstallable(
+        _record("com.Ex.Lib", "1.0B"),
+        _record("a", "1.0", "com.ex.lib (>= 1.0B)"),
+        _record("b", "1.0", "COM.EX.LIB (>> 1.0B)"),
+        _record("c", "1.0", "virtual (= 2.0A)"),
+        _record("d", "1.0", provides="Virtual (= 2.0A)"),
+    ) == {"b_1.0": ["com.ex.lib (>> 1.0B)"]}
+
+
+def test_unversioned_relations():
+    checker = Checker(
+        [
+            _record("a", "1.0", "firmware, firmware (>= 14.0)"),
+            _record("b", "1.0", provides="virtual"),
+            _record("e", "1.0", "firmware, firmware (>= 14.0), firmware (<< 13.0)"),
+            _record("c", "1.0", "virtual, b"),
+        ]
+    )
+
+    assert checker.external_conflicts(("a", "1.0", "iphoneos-arm")) == []
+    # (only the versioned relations are part of the conflict)
+    assert checker.external_conflicts(("e", "1.0", "iphoneos-arm")) == [
+        "firmware (>= 14.0), firmware (<< 13.0)"
+    ]
+    assert checker.satisfying(("virtual", "", "")) == {("b", "1.0", "iphoneos-arm")}
+    # an unversioned provide doesn't satisfy a versioned relation.
+    assert checker.satisfying(("virtual", ">=", "1.0")) == set()
+    assert list(checker.uninstallable()) == [("e", "1.0", "iphoneos-arm")]
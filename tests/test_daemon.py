@@ -0,0 +1,179 @@
+# coding: utf8
+
+import asyncio
+import json
+
+import pytest
+
+from mothman import daemon, repo
+
+from conftest import deb_bytes
+
+# (depictions need a Depends field)
+FIRMWARE = "firmware (>= 12.0)"
+
+
+@pytest.fixture
+def repository(repo_root, make_deb, monkeypatch):
+    monkeypatch.setenv("MOTHMAN_CACHE_DIR", str(repo_root.parent / "cache"))
+
+    template = dict(repo.TEMPLATES["repo.me"])
+    (repo_root / repo.CONFIG_NAME).write_text(json.dumps(template))
+    make_deb(repo_root / "debians" / "com.ex.a_1.0.deb", "com.ex.a", "1.0", depends=FIRMWARE)
+    (repo_root / ".mothman").mkdir()
+    (repo_root / ".mothman" / "secret").write_text("secret")
+
+    return repo.Repository("example.com", repo_root, scan_cache=False)
+
+
+async def _request(port, method, path, body=b""):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    head = f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n"
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+    response = await reader.read()
+    writer.close()
+
+    head, _, content = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), content
+
+
+def _run(repository, *requests):
+    # start a daemon, make the requests in order, and return the responses.
+    async def main():
+        server = daemon.Daemon(repository)
+        await server.start("127.0.0.1", 0)
+        port = server._server.sockets[0].getsockname()[1]
+
+        try:
+            return [await _request(port, *request) for request in requests]
+        finally:
+            await server.close()
+
+    return asyncio.run(main())
+
+
+def test_upload_and_serve(repository):
+    deb = deb_bytes("com.ex.b", "1.0", depends=FIRMWARE)
+    (upload, _), (packages, content), (status, body) = _run(
+        repository,
+        ("PUT", "/api/debs/com.ex.b_1.0.deb", deb),
+        ("GET", "/Packages"),
+        ("GET", "/api/status"),
+    )
+
+    assert upload == 201
+    assert packages == 200
+    assert b"Package: com.ex.b" in content
+    assert json.loads(body) == {"generation": 2, "packages": 2}
+    assert (repository.deb_path / "com.ex.b_1.0.deb").read_bytes() == deb
+
+
+def test_hidden_files_not_served(repository):
+    responses = _run(
+        repository,
+        ("GET", "/.mothman/secret"),
+        ("GET", "/mothman.json"),
+        ("GET", "/debians/com.ex.a_1.0.deb"),
+    )
+
+    assert [status for status, _ in responses] == [404, 404, 200]
+
+
+def test_delete_last_package(repository):
+    (status, _), (_, content) = _run(
+        repository,
+        ("DELETE", "/api/packages/com.ex.a"),
+        ("GET", "/Packages"),
+    )
+
+    assert status == 200
+    assert content == b""
+    assert not (repository.deb_path / "com.ex.a_1.0.deb").exists()
+
+
+def test_failed_build_rolls_back(repository, monkeypatch):
+    build = repository.build
+    calls = []
+
+    def failing_build(*args, **kwargs):
+        calls.append(1)
+        # the first build (when the daemon starts) works.
+        if len(calls) > 1:
+            raise RuntimeError("build failed")
+        return build(*args, **kwargs)
+
+    monkeypatch.setattr(repository, "build", failing_build)
+    original = (repository.deb_path / "com.ex.a_1.0.deb").read_bytes()
+    rebuilt = deb_bytes("com.ex.a", "1.0", depends=FIRMWARE, fields={"Name": "A"})
+
+    (deleted, _), (replaced, _), (_, content) = _run(
+        repository,
+        ("DELETE", "/api/packages/com.ex.a"),
+        ("PUT", "/api/debs/com.ex.a_1.0.deb", rebuilt),
+        ("GET", "/Packages"),
+    )
+
+    assert deleted == replaced == 500
+    assert b"Package: com.ex.a" in content
+    # neither change was applied.
+    assert (repository.deb_path / "com.ex.a_1.0.deb").read_bytes() == original
+    assert [r.filename for r in repository._tree] == [
+        str(repository.deb_path / "com.ex.a_1.0.deb")
+    ]
+    assert not [p for p in repository.deb_path.iterdir() if p.name.startswith(".")]
+
+
+def test_upload_wont_overwrite_other_package(repository):
+    deb = deb_bytes("com.ex.b", "1.0", depends=FIRMWARE)
+    original = (repository.deb_path / "com.ex.a_1.0.deb").read_bytes()
+
+    ((status, _),) = _run(repository, ("PUT", "/api/debs/com.ex.a_1.0.deb", deb))
+
+    assert status == 409
+    assert (repository.deb_path / "com.ex.a_1.0.deb").read_bytes() == original
+    assert not [p for p in repository.deb_path.iterdir() if p.name.startswith(".")]
+
+
+def test_status_after_delete(repository):
+    (_, before), _, (_, after) = _run(
+        repository,
+        ("GET", "/api/status"),
+        ("DELETE", "/api/packages/com.ex.a"),
+        ("GET", "/api/status"),
+    )
+
+    assert json.loads(before) == {"generation": 1, "packages": 1}
+    assert json.loads(after) == {"generation": 2, "packages": 0}
+
+
+def test_negative_content_length(repository):
+    async def main():
+        server = daemon.Daemon(repository)
+        await server.start("127.0.0.1", 0)
+        port = server._server.sockets[0].getsockname()[1]
+
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(
+                b"PUT /api/debs/com.ex.b_1.0.deb HTTP/1.1\r\nContent-Length: -1\r\n\r\n"
+            )
+            await writer.drain()
+            response = await reader.readline()
+            writer.close()
+            return response
+        finally:
+            await server.close()
+
+    assert asyncio.run(main()).split()[1] == b"400"
+    assert not (repository.deb_path / "com.ex.b_1.0.deb").exists()
+
+
+def test_meta_not_served(repository):
+    (repository.root / "meta").mkdir()
+    (repository.root / "meta" / "packages.json").write_text("{}")
+
+    ((status, _),) = _run(repository, ("GET", "/meta/packages.json"))
+
+    assert status == 404
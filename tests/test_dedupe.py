@@ -0,0 +1,85 @@
+# coding: utf8
+
+import errno
+import os
+
+import pytest
+
+from mothman import dedupe
+
+
+@pytest.fixture
+def no_reflink(monkeypatch):
+    # (so the hardlink fallback is used, whatever the filesystem)
+    def _reflink(src, dst):
+        raise OSError(errno.EOPNOTSUPP, "reflinks not supported")
+
+    monkeypatch.setattr(dedupe, "_reflink", _reflink)
+
+
+@pytest.fixture
+def files(tmp_path):
+    paths = {name: tmp_path / f"{name}.deb" for name in ("a", "b", "c", "d")}
+    paths["a"].write_bytes(b"x" * 1000)
+    paths["b"].write_bytes(b"x" * 1000)
+    paths["c"].write_bytes(b"x" * 1000)
+    # the same size, different content.
+    paths["d"].write_bytes(b"y" * 1000)
+    return paths
+
+
+def _inode(path):
+    return path.stat().st_ino
+
+
+def test_hardlink_fallback(files, no_reflink):
+    d_stat = files["d"].stat()
+
+    report = dedupe.dedupe(files.values(), mode=dedupe.AUTO)
+
+    assert report == {
+        "groups": 1,
+        "replaced": {str(files["b"]): str(files["a"]), str(files["c"]): str(files["a"])},
+        "reclaimed": 2000,
+        "failed": {},
+    }
+    assert _inode(files["a"]) == _inode(files["b"]) == _inode(files["c"])
+    assert files["a"].stat().st_nlink == 3
+    # files that differ are left alone.
+    assert files["d"].stat().st_ino == d_stat.st_ino
+    assert files["d"].read_bytes() == b"y" * 1000
+    assert not [p for p in files["a"].parent.iterdir() if p.name.startswith(".")]
+
+    # linked files are not reported again.
+    assert dedupe.dedupe(files.values())["replaced"] == {}
+
+
+def test_dry_run(files, no_reflink):
+    report = dedupe.dedupe(files.values(), mode=dedupe.HARDLINK, dry_run=True)
+
+    assert report["reclaimed"] == 2000
+    assert len({_inode(p) for p in files.values()}) == 4
+
+
+def test_reflink_only_fails(files, no_reflink):
+    report = dedupe.dedupe(files.values(), mode=dedupe.REFLINK)
+
+    assert sorted(report["failed"]) == [str(files["b"]), str(files["c"])]
+    assert report["replaced"] == {}
+    assert len({_inode(p) for p in files.values()}) == 4
+
+
+def test_most_linked_is_kept(files, no_reflink, tmp_path):
+    os.link(files["b"], tmp_path / "elsewhere.deb")
+
+    report = dedupe.dedupe([files["a"], files["b"]], mode=dedupe.HARDLINK)
+
+    # b is already linked elsewhere, so only a is freed.
+    assert report["replaced"] == {str(files["a"]): str(files["b"])}
+    assert report["reclaimed"] == 1000
+    assert files["b"].stat().st_nlink == 3
+
+
+def test_invalid_mode(files):
+    with pytest.raises(ValueError):
+        dedupe.dedupe(files.values(), mode="copy")
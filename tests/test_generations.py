@@ -0,0 +1,70 @@
+# coding: utf8
+
+import os
+
+import pytest
+
+from mothman import generations, tree
+
+
+def _build(root, **kwargs):
+    debian_tree = tree.DebianTree(root, scan_cache=False, generations=2, **kwargs)
+    debian_tree.add_debs(debian_tree.root / "debs")
+    debian_tree.build()
+    return debian_tree
+
+
+def test_swap_and_rollback(repo_root, make_deb):
+    make_deb(repo_root / "debs" / "com.ex.a_1.0.deb", "com.ex.a", "1.0")
+    _build(repo_root)
+
+    history = generations.Generations(repo_root)
+    assert history.current() == 1
+    assert (repo_root / "Packages").is_symlink()
+    first_release = (repo_root / "Release").read_text()
+
+    make_deb(repo_root / "debs" / "com.ex.a_1.1.deb", "com.ex.a", "1.1")
+    _build(repo_root)
+
+    assert history.current() == 2
+    assert "Version: 1.1" in (repo_root / "Packages").read_text()
+
+    assert history.rollback() == 1
+    assert history.current() == 1
+    assert "Version: 1.1" not in (repo_root / "Packages").read_text()
+    assert (repo_root / "Release").read_text() == first_release
+
+    with pytest.raises(generations.GenerationError):
+        history.rollback()
+
+
+def test_unchanged_files_are_linked(repo_root, make_deb):
+    make_deb(repo_root / "debs" / "com.ex.a_1.0.deb", "com.ex.a", "1.0")
+    _build(repo_root)
+    _build(repo_root)
+
+    folder = repo_root / generations.GENERATIONS_PATH
+    assert os.path.samefile(folder / "1" / "Packages.gz", folder / "2" / "Packages.gz")
+
+
+def test_prune(repo_root, make_deb):
+    for version in ("1.0", "1.1", "1.2"):
+        make_deb(repo_root / "debs" / f"com.ex.a_{version}.deb", "com.ex.a", version)
+        _build(repo_root)
+
+    assert generations.Generations(repo_root).numbers() == [2, 3]
+
+
+def test_failed_stage_is_not_published(repo_root, make_deb):
+    make_deb(repo_root / "debs" / "com.ex.a_1.0.deb", "com.ex.a", "1.0")
+    _build(repo_root)
+
+    history = generations.Generations(repo_root, keep=2)
+    with pytest.raises(RuntimeError):
+        with history.stage() as stage:
+            (stage.path / "Packages").write_text("half-written")
+            raise RuntimeError("build failed")
+
+    assert history.numbers() == [1]
+    assert history.current() == 1
+    assert "half-written" not in (repo_root / "Packages").read_text()
@@ -0,0 +1,31 @@
+# coding: utf8
+
+from mothman import history
+
+
+def test_first_seen(tmp_path):
+    path = tmp_path / history.HISTORY_PATH
+    entries = history.History(path)
+
+    assert entries.first_seen("com.ex.a", "1.0", 1600000000.5) == 1600000000
+    # the first time is kept.
+    assert entries.first_seen("com.ex.a", "1.0", 1700000000) == 1600000000
+    assert entries.first_seen("com.ex.a", "1.1", 1700000000) == 1700000000
+    entries.save()
+
+    loaded = history.History(path)
+    assert loaded.first_seen("com.ex.a", "1.0", 1800000000) == 1600000000
+
+    # nothing changed, so nothing is written.
+    path.unlink()
+    loaded.save()
+    assert not path.exists()
+
+
+def test_corrupt_history(tmp_path):
+    path = tmp_path / "history.json"
+    path.write_text("{not json")
+
+    entries = history.History(path)
+
+    assert entries.first_seen("com.ex.a", "1.0", 1600000000) == 1600000000
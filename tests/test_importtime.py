@@ -0,0 +1,36 @@
+# coding: utf8
+
+import importlib.util
+import pathlib
+
+# (benchmarks isn't a package, so it is loaded from its path)
+_spec = importlib.util.spec_from_file_location(
+    "importtime", pathlib.Path(__file__).parents[1] / "benchmarks" / "importtime.py"
+)
+importtime = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(importtime)  # type: ignore
+
+# the CLI used to take ~8 times as long to import as click (which it can't start without),
+# so it is allowed half of that.
+MAX_CLICK_RATIO = 4
+RUNS = 3
+
+
+def _cumulative(imports, module):
+    return next(cumulative for name, _, cumulative, _ in imports if name == module)
+
+
+def test_no_forbidden_imports():
+    imports = importtime.importtime()
+
+    assert sorted({name for name, *_ in imports if name in importtime.FORBIDDEN}) == []
+
+
+def test_import_time_budget():
+    # (the best of a few runs, so a slow run doesn't fail the test)
+    ratio = min(
+        _cumulative(imports, "mothman.cli") / _cumulative(imports, "click")
+        for imports in (importtime.importtime() for _ in range(RUNS))
+    )
+
+    assert ratio <= MAX_CLICK_RATIO
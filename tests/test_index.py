@@ -0,0 +1,74 @@
+# coding: utf8
+
+from mothman.index import QueryIndex, parse_relations
+from mothman.record import PackageRecord
+
+
+def _record(name, version, **fields):
+    pairs = [("Package", name), ("Version", version), ("Architecture", "iphoneos-arm")]
+    pairs.extend((k.replace("_", "-"), v) for k, v in fields.items())
+    return PackageRecord(f"/repo/{name}_{version}.deb", tuple(pairs), (), 0)
+
+
+def _names(records):
+    return [r.name for r in records]
+
+
+def test_parse_relations():
+    assert parse_relations("Com.Ex.Lib (>= 1.0B), a | B:any (<< 2~Beta), c [iphoneos-arm]") == [
+        [("com.ex.lib", ">=", "1.0B")],
+        [("a", "", ""), ("b", "", "")],
+        [("c", "", "")],
+    ]
+    assert parse_relations(None) == parse_relations(" , ") == []
+
+
+def test_add_and_remove():
+    old = _record("com.ex.a", "1.0", Author="Someone", Section="Tweaks")
+    new = _record("com.ex.a", "1.0", Author="Someone Else", Section="Tweaks")
+    query = QueryIndex([old, _record("com.ex.b", "1.0", Section="tweaks")])
+
+    assert _names(query.by_field("section", " TWEAKS ")) == ["com.ex.a", "com.ex.b"]
+
+    # a record with the same key replaces the old one in every index.
+    query.add(new)
+    assert len(query) == 2
+    assert query.by_field("Author", "someone") == []
+    assert query.by_field("Author", "someone else") == [new]
+
+    # removing a record that was replaced does nothing.
+    query.remove(old)
+    assert len(query) == 2
+
+    query.remove(new)
+    assert _names(query.by_field("Package", "COM.EX.A")) == []
+    assert _names(query.by_field("Section", "tweaks")) == ["com.ex.b"]
+
+
+def test_rdepends_and_providers():
+    query = QueryIndex(
+        [
+            _record("com.ex.a", "1.0", Depends="Com.Ex.Lib (>= 1.0B), firmware (>= 12.0)"),
+            _record("com.ex.b", "1.0", Pre_Depends="com.ex.lib | Virtual"),
+            _record("com.ex.Lib", "1.0B", Provides="virtual (= 2.0)"),
+        ]
+    )
+
+    assert _names(query.rdepends("COM.EX.LIB")) == ["com.ex.a", "com.ex.b"]
+    assert _names(query.rdepends("virtual")) == ["com.ex.b"]
+    assert _names(query.providers("Virtual")) == ["com.ex.Lib"]
+    assert query.providers("com.ex.lib") == []
+
+
+def test_search():
+    query = QueryIndex(
+        [
+            _record("com.ex.a", "1.0", Name="Dark Mode", Description="A dark theme."),
+            _record("com.ex.b", "1.0", Name="Light", Description="Not DARK at all"),
+        ]
+    )
+
+    assert _names(query.search("dark")) == ["com.ex.a", "com.ex.b"]
+    assert _names(query.search("DARK theme")) == ["com.ex.a"]
+    assert query.search("dark missing") == []
+    assert query.search("!!") == []
@@ -0,0 +1,190 @@
+# coding: utf8
+
+import io
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from mothman import cli, ingest, pydpkg, repo, tree, utils
+
+from conftest import ar_archive, deb_bytes, tarball
+
+
+def _feed(data, size):
+    parser = ingest.ArParser(lambda name: name.startswith(ingest.CONTROL_PREFIX))
+    for i in range(0, len(data), size):
+        parser.feed(data[i : i + size])
+    parser.close()
+    return parser
+
+
+@pytest.mark.parametrize("size", [1, 7, 60, 1 << 16])
+def test_ar_parser_chunks(size):
+    data = deb_bytes("com.ex.a", "1.0")
+
+    parser = _feed(data, size)
+
+    assert parser.names == ["debian-binary", "control.tar.gz", "data.tar.gz"]
+    assert list(parser.members) == ["control.tar.gz"]
+    assert ingest.parse_control("control.tar.gz", parser.members["control.tar.gz"])[:2] == (
+        ("Package", "com.ex.a"),
+        ("Version", "1.0"),
+    )
+
+
+def test_ar_parser_odd_member():
+    parser = _feed(ar_archive([("a", b"odd"), ("control.tar.gz", b"xy")]), 1)
+
+    assert parser.names == ["a", "control.tar.gz"]
+    assert parser.members == {"control.tar.gz": b"xy"}
+
+
+def test_ar_parser_bad_magic():
+    parser = ingest.ArParser(lambda name: True)
+
+    with pytest.raises(ingest.IngestError, match="not an ar archive"):
+        parser.feed(b"PK\x03\x04 not an ar archive")
+
+
+def test_ar_parser_bad_header():
+    data = bytearray(ar_archive([("a", b"data")]))
+    data[8 + 58 : 8 + 60] = b"xx"
+
+    with pytest.raises(ingest.IngestError, match="header"):
+        _feed(bytes(data), 1 << 16)
+
+
+@pytest.mark.parametrize("cut", [4, 8 + 30, -3])
+def test_ar_parser_truncated(cut):
+    data = deb_bytes("com.ex.a", "1.0")
+
+    with pytest.raises(ingest.IngestError, match="ended early"):
+        _feed(data[:cut], 1 << 16)
+
+
+def test_parse_control_errors():
+    with pytest.raises(ingest.IngestError, match="no control file"):
+        ingest.parse_control("control.tar.gz", tarball({"./md5sums": b""}))
+
+    with pytest.raises(ingest.IngestError, match="can't read"):
+        ingest.parse_control("control.tar.gz", b"not a tarball")
+
+    with pytest.raises(ingest.IngestError, match="missing control fields: version"):
+        ingest.parse_control("control.tar.gz", tarball({"./control": b"Package: a\n"}))
+
+
+def test_copy_deb(tmp_path):
+    data = deb_bytes("com.ex.a", "1.0", fields={"Name": "A"})
+    out = io.BytesIO()
+
+    fields, info = ingest.copy_deb(io.BytesIO(data), out)
+
+    assert out.getvalue() == data
+    (tmp_path / "a.deb").write_bytes(data)
+    assert fields == tuple(pydpkg.Dpkg(tmp_path / "a.deb").message.items())
+    assert info == utils.fileinfo(tmp_path / "a.deb")
+
+
+def test_copy_deb_invalid():
+    with pytest.raises(ingest.IngestError):
+        ingest.copy_deb(io.BytesIO(ar_archive([("debian-binary", b"2.0\n")])), io.BytesIO())
+
+
+def test_tree_ingest(built_repo):
+    debian_tree = tree.DebianTree(built_repo, scan_cache=False)
+    debian_tree.add_debs(built_repo / "debs")
+    folder = built_repo / "debs"
+
+    replaced = debian_tree.ingest(
+        io.BytesIO(deb_bytes("com.ex.b", "2.0", fields={"Name": "B"})), folder=folder, delete=True
+    )
+
+    assert [r.debian_name for r in replaced] == ["com.ex.b_2.0_iphoneos-arm"]
+    assert (folder / "com.ex.b_2.0_iphoneos-arm.deb").is_file()
+    assert not (folder / "com.ex.b_2.0.deb").exists()
+
+    with pytest.raises(tree.DebError):
+        debian_tree.ingest(io.BytesIO(b"not a deb"), "c.deb", folder=folder)
+
+    assert not (folder / "c.deb").exists()
+    assert not [p for p in folder.iterdir() if p.name.startswith(".")]
+
+
+def test_ingest_wont_overwrite_other_package(built_repo):
+    debian_tree = tree.DebianTree(built_repo, scan_cache=False)
+    folder = built_repo / "debs"
+    original = (folder / "com.ex.a_1.0.deb").read_bytes()
+
+    # the file isn't in the tree, so it is checked on disk.
+    with pytest.raises(tree.DebError, match="com.ex.a_1.0"):
+        debian_tree.ingest(
+            io.BytesIO(deb_bytes("com.ex.c", "1.0")), "com.ex.a_1.0.deb", folder=folder
+        )
+
+    debian_tree.add_debs(folder)
+    with pytest.raises(tree.DebError):
+        debian_tree.ingest(
+            io.BytesIO(deb_bytes("com.ex.c", "1.0")), "com.ex.a_1.0.deb", folder=folder
+        )
+
+    assert (folder / "com.ex.a_1.0.deb").read_bytes() == original
+    assert [r.name for r in debian_tree._tree].count("com.ex.c") == 0
+    assert not [p for p in folder.iterdir() if p.name.startswith(".")]
+
+
+def test_cli_add_stdin(repo_root, monkeypatch):
+    monkeypatch.setenv("MOTHMAN_CACHE_DIR", str(repo_root.parent / "cache"))
+    (repo_root / repo.CONFIG_NAME).write_text(json.dumps(repo.TEMPLATES["repo.me"]))
+    data = deb_bytes("com.ex.a", "1.0", fields={"Name": "A"})
+
+    result = CliRunner().invoke(
+        cli.cli, ["add", "-p", str(repo_root), "--name", "a.deb", "-"], input=data
+    )
+    assert result.exit_code == 0, result.output
+
+    stored = repo_root / "debians" / "a.deb"
+    assert stored.read_bytes() == data
+
+    # the record is read back from the scan cache that add wrote to.
+    debian_tree = tree.DebianTree(repo_root)
+    debian_tree.add_debs(repo_root / "debians")
+    (package_record,) = debian_tree._tree
+
+    info = utils.fileinfo(stored)
+    assert package_record.fields == tuple(pydpkg.Dpkg(stored).message.items())
+    assert package_record.size == info.pop("filesize")
+    assert {h: d.hex() for h, d in package_record.digests} == info
+
+    result = CliRunner().invoke(cli.cli, ["add", "-p", str(repo_root), "-"], input=b"junk")
+    assert result.exit_code == 1
+    assert "Error: <stdin>" in result.output
+
+
+def test_parse_control_not_utf8():
+    control = tarball({"./control": b"Package: a\nVersion: 1.0\nDescription: \xff\n"})
+
+    with pytest.raises(ingest.IngestError, match="not UTF-8"):
+        ingest.parse_control("control.tar.gz", control)
+
+
+def test_commit_restores_file_if_move_fails(built_repo, monkeypatch):
+    debian_tree = tree.DebianTree(built_repo, scan_cache=False)
+    folder = built_repo / "debs"
+    original = (folder / "com.ex.a_1.0.deb").read_bytes()
+    received = debian_tree._receive(
+        io.BytesIO(deb_bytes("com.ex.a", "1.0", fields={"Name": "A"})), folder, "com.ex.a_1.0.deb"
+    )
+    replace = tree.os.replace
+
+    def failing_replace(src, dst):
+        if str(src).endswith(".part"):
+            raise OSError("disk full")
+        replace(src, dst)
+
+    monkeypatch.setattr(tree.os, "replace", failing_replace)
+    with pytest.raises(OSError):
+        debian_tree._commit(*received)
+
+    assert (folder / "com.ex.a_1.0.deb").read_bytes() == original
+    assert not (folder / ".com.ex.a_1.0.deb.old").exists()
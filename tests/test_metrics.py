@@ -0,0 +1,44 @@
+# coding: utf8
+
+from mothman import metrics, tree
+
+
+def test_textfile():
+    m = metrics.Metrics()
+    m.set("mothman_index_bytes", 10, file='a"b\\c\nd')
+    m.set("mothman_packages", 1.5)
+
+    assert m.textfile().splitlines() == [
+        "# HELP mothman_index_bytes Size of each index file.",
+        "# TYPE mothman_index_bytes gauge",
+        'mothman_index_bytes{file="a\\"b\\\\c\\nd"} 10',
+        "# HELP mothman_packages Unique packages in Packages.",
+        "# TYPE mothman_packages gauge",
+        "mothman_packages 1.5",
+    ]
+
+
+def test_progress_events():
+    events = []
+    m = metrics.Metrics(events.append, interval=3600)
+
+    for done in range(1, 4):
+        m.progress("scan", done, 3, 10)
+
+    # only the last event (when the stage is done) gets through the interval.
+    assert [(e.stage, e.done, e.total, e.size) for e in events] == [("scan", 3, 3, 30)]
+
+
+def test_scan_metrics_are_per_scan(built_repo):
+    debian_tree = tree.DebianTree(built_repo)
+    assert "mothman_scan_cache_hits 0" in debian_tree.metrics.textfile()
+
+    debian_tree.add_debs(built_repo / "debs")
+    assert debian_tree.metrics.get("mothman_scan_cache_misses") == 3
+    assert debian_tree.metrics.get("mothman_scan_cache_hits") == 0
+
+    # the second scan is not added to the first.
+    debian_tree.add_debs(built_repo / "debs")
+    assert debian_tree.metrics.get("mothman_scan_cache_misses") == 0
+    assert debian_tree.metrics.get("mothman_scan_cache_hits") == 3
+    assert "# TYPE mothman_scan_cache_hits gauge" in debian_tree.metrics.textfile()
@@ -0,0 +1,167 @@
+# coding: utf8
+
+import functools
+import gzip
+import http.server
+import re
+import threading
+
+import pytest
+
+from mothman import mirror, tree
+
+
+class _Handler(http.server.SimpleHTTPRequestHandler):
+    # a static file server that understands 'Range: bytes=N-' (like most web servers),
+    # and records the paths requested.
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.requested.append(self.path)
+
+        match = re.match(r"bytes=(\d+)-$", self.headers.get("Range", ""))
+        path = self.translate_path(self.path)
+
+        if match is None:
+            return super().do_GET()
+
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            return self.send_error(404)
+
+        offset = int(match.group(1))
+        if offset >= len(data):
+            return self.send_error(416)
+
+        self.send_response(206)
+        self.send_header("Content-Length", str(len(data) - offset))
+        self.send_header("Content-Range", f"bytes {offset}-{len(data) - 1}/{len(data)}")
+        self.end_headers()
+        self.wfile.write(data[offset:])
+
+
+@pytest.fixture
+def server(built_repo):
+    handler = functools.partial(_Handler, directory=str(built_repo))
+    httpd = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    httpd.requested = []
+
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+
+    yield httpd
+
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def _url(server):
+    return f"http://127.0.0.1:{server.server_address[1]}/"
+
+
+def _debs(server):
+    return [p for p in server.requested if p.endswith(".deb")]
+
+
+def test_mirror(server, built_repo, tmp_path):
+    dest = tmp_path / "mirror"
+    results = mirror.Mirror(_url(server), dest, workers=2).run()
+
+    assert sorted(results[mirror.DOWNLOADED]) == [
+        "debs/com.ex.a_1.0.deb",
+        "debs/com.ex.a_1.1.deb",
+        "debs/com.ex.b_2.0.deb",
+    ]
+    assert not results["failed"]
+
+    for deb in (built_repo / "debs").iterdir():
+        assert (dest / "debs" / deb.name).read_bytes() == deb.read_bytes()
+
+    # the remote Release is copied without hashes.
+    assert "SHA256" not in (dest / "Release").read_text()
+
+    # everything is skipped the second time.
+    server.requested.clear()
+    results = mirror.Mirror(_url(server), dest).run()
+    assert len(results[mirror.SKIPPED]) == 3
+    assert not _debs(server)
+
+
+def test_packages_not_matching_release(server, built_repo, tmp_path):
+    # a Packages file that doesn't match Release must not start any downloads.
+    text = (built_repo / "Packages").read_bytes().replace(b"com.ex.b_2.0", b"com.ex.b_2.1")
+    (built_repo / "Packages").write_bytes(text)
+    (built_repo / "Packages.gz").write_bytes(gzip.compress(text))
+
+    with pytest.raises(mirror.MirrorError, match="does not match Release"):
+        mirror.Mirror(_url(server), tmp_path / "mirror").run()
+
+    assert not _debs(server)
+
+
+def test_resume(server, built_repo, tmp_path):
+    dest = tmp_path / "mirror"
+    data = (built_repo / "debs" / "com.ex.a_1.0.deb").read_bytes()
+
+    # one download stopped halfway, one finished but was never renamed.
+    (dest / "debs").mkdir(parents=True)
+    (dest / "debs" / "com.ex.a_1.0.deb.part").write_bytes(data[:100])
+    (dest / "debs" / "com.ex.b_2.0.deb.part").write_bytes(
+        (built_repo / "debs" / "com.ex.b_2.0.deb").read_bytes()
+    )
+
+    results = mirror.Mirror(_url(server), dest).run()
+
+    assert sorted(results[mirror.RESUMED]) == ["debs/com.ex.a_1.0.deb", "debs/com.ex.b_2.0.deb"]
+    assert results[mirror.DOWNLOADED] == ["debs/com.ex.a_1.1.deb"]
+    assert (dest / "debs" / "com.ex.a_1.0.deb").read_bytes() == data
+    assert not list((dest / "debs").glob("*.part"))
+    # the finished download wasn't requested again.
+    assert "/debs/com.ex.b_2.0.deb" not in _debs(server)
+
+
+def test_corrupt_partial_download(server, built_repo, tmp_path):
+    dest = tmp_path / "mirror"
+    (dest / "debs").mkdir(parents=True)
+    (dest / "debs" / "com.ex.a_1.0.deb.part").write_bytes(b"x" * 100)
+
+    results = mirror.Mirror(_url(server), dest).run()
+
+    assert results["failed"] == ["debs/com.ex.a_1.0.deb"]
+    assert not (dest / "debs" / "com.ex.a_1.0.deb.part").exists()
+
+
+def test_unlisted_packages_not_used(server, built_repo, tmp_path):
+    # (xz is preferred, but Release doesn't list it)
+    (built_repo / "Packages.xz").write_bytes(b"not checked")
+
+    results = mirror.Mirror(_url(server), tmp_path / "mirror").run()
+
+    assert len(results[mirror.DOWNLOADED]) == 3
+    assert "/Packages.xz" not in server.requested
+
+
+def test_destination_collision(server, built_repo, make_deb, tmp_path):
+    # two package files with the same name, both mirrored into deb_path.
+    make_deb(built_repo / "other" / "com.ex.a_1.0.deb", "com.ex.c", "1.0")
+    debian_tree = tree.DebianTree(built_repo, scan_cache=False)
+    debian_tree.add_debs(built_repo / "debs")
+    debian_tree.add_debs(built_repo / "other")
+    debian_tree.build()
+
+    dest = tmp_path / "mirror"
+    results = mirror.Mirror(_url(server), dest, deb_path="debs", workers=4).run()
+
+    assert results["failed"] == ["other/com.ex.a_1.0.deb"]
+    assert sorted(results[mirror.DOWNLOADED]) == [
+        "debs/com.ex.a_1.0.deb",
+        "debs/com.ex.a_1.1.deb",
+        "debs/com.ex.b_2.0.deb",
+    ]
+    assert (dest / "debs" / "com.ex.a_1.0.deb").read_bytes() == (
+        built_repo / "debs" / "com.ex.a_1.0.deb"
+    ).read_bytes()
@@ -0,0 +1,95 @@
+# coding: utf8
+
+import json
+
+import pytest
+
+from mothman import publish
+
+
+def test_publish_delta(built_repo, tmp_path):
+    dest = tmp_path / "www"
+    (built_repo / ".mothman").mkdir(exist_ok=True)
+
+    report = publish.publish(built_repo, dest, workers=2)
+
+    assert sorted(report["copied"]) == [
+        "Packages",
+        "Packages.gz",
+        "Release",
+        "debs/com.ex.a_1.0.deb",
+        "debs/com.ex.a_1.1.deb",
+        "debs/com.ex.b_2.0.deb",
+    ]
+    assert report["deleted"] == []
+    for relpath in report["copied"]:
+        assert (dest / relpath).read_bytes() == (built_repo / relpath).read_bytes()
+
+    # only changed files are copied, and removed files are deleted.
+    (built_repo / "debs" / "com.ex.b_2.0.deb").unlink()
+    (built_repo / "Release").write_text((built_repo / "Release").read_text() + "Extra: 1\n")
+
+    report = publish.publish(built_repo, dest)
+
+    assert report == {
+        "copied": ["Release"],
+        "deleted": ["debs/com.ex.b_2.0.deb"],
+        "unchanged": 4,
+    }
+    assert not (dest / "debs" / "com.ex.b_2.0.deb").exists()
+    assert "Extra: 1" in (dest / "Release").read_text()
+
+    manifest = json.loads((dest / publish.MANIFEST_PATH).read_text())
+    assert "debs/com.ex.b_2.0.deb" not in manifest
+
+
+def test_publish_dry_run_and_exclude(built_repo, tmp_path):
+    dest = tmp_path / "www"
+
+    report = publish.publish(built_repo, dest, exclude=["debs/com.ex.a_*"], dry_run=True)
+
+    assert sorted(report["copied"]) == [
+        "Packages",
+        "Packages.gz",
+        "Release",
+        "debs/com.ex.b_2.0.deb",
+    ]
+    assert not dest.exists()
+
+
+def test_hidden_files_not_published(built_repo, tmp_path):
+    (built_repo / ".mothman").mkdir(exist_ok=True)
+    (built_repo / ".mothman" / "history.json").write_text("{}")
+
+    report = publish.publish(built_repo, tmp_path / "www")
+
+    assert not any(p.startswith(".") for p in report["copied"])
+
+
+def test_publish_into_itself(built_repo):
+    with pytest.raises(publish.PublishError):
+        publish.publish(built_repo, built_repo / "www")
+
+
+def test_broken_symlink_skipped(built_repo, tmp_path):
+    (built_repo / "Packages.xz").symlink_to(built_repo / ".mothman" / "generations" / "1" / "x")
+
+    report = publish.publish(built_repo, tmp_path / "www")
+
+    assert "Packages.xz" not in report["copied"]
+    assert (tmp_path / "www" / "Release").is_file()
+
+
+def test_private_files_not_published(built_repo, tmp_path):
+    (built_repo / "mothman.json").write_text(json.dumps({"deb_path": "debs", "meta": "info"}))
+    (built_repo / "info").mkdir()
+    (built_repo / "info" / "packages.json").write_text("{}")
+    (built_repo / "meta").mkdir()
+    (built_repo / "meta" / "readme.txt").write_text("public")
+
+    report = publish.publish(built_repo, tmp_path / "www")
+
+    assert "mothman.json" not in report["copied"]
+    assert "info/packages.json" not in report["copied"]
+    # (the metadata sources are in 'info', so 'meta' is just another folder)
+    assert "meta/readme.txt" in report["copied"]
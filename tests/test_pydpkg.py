@@ -0,0 +1,56 @@
+# coding: utf8
+
+import functools
+import itertools
+
+import pytest
+
+from mothman.pydpkg import Dpkg
+
+VERSIONS = [
+    "1.0",
+    "1.0-1",
+    "1.0-0",
+    "0:1.0",
+    "1:0.1",
+    "1.0~beta",
+    "1.0~beta1",
+    "1.0~~",
+    "1.0~",
+    "1.0a",
+    "1.0+b1",
+    "1.0.1",
+    "1.00",
+    "1.10",
+    "1.9",
+    "2",
+    "2.0-1~bpo1",
+    "2.0-1",
+    "10",
+    "a1",
+]
+
+
+def _sign(n):
+    return (n > 0) - (n < 0)
+
+
+@pytest.mark.parametrize("a, b", list(itertools.product(VERSIONS, repeat=2)))
+def test_version_key_matches_compare_versions(a, b):
+    key_a, key_b = Dpkg.version_key(a), Dpkg.version_key(b)
+    expected = _sign(Dpkg.compare_versions(a, b))
+
+    assert (key_a > key_b) - (key_a < key_b) == expected
+
+
+def test_version_key_sort():
+    expected = sorted(VERSIONS, key=functools.cmp_to_key(Dpkg.compare_versions))
+    assert sorted(VERSIONS, key=Dpkg.version_key) == expected
+
+
+def test_version_key_known_order():
+    assert Dpkg.version_key("1.0~beta") < Dpkg.version_key("1.0")
+    assert Dpkg.version_key("1.0") < Dpkg.version_key("1.0a")
+    assert Dpkg.version_key("1.9") < Dpkg.version_key("1.10")
+    assert Dpkg.version_key("9.9") < Dpkg.version_key("1:0.1")
+    assert Dpkg.version_key("1.0") == Dpkg.version_key("0:1.0")
@@ -0,0 +1,102 @@
+# coding: utf8
+
+import pickle
+
+import pytest
+
+from mothman.record import PackageIndex, PackageRecord
+
+
+def _record(name, version, arch="iphoneos-arm"):
+    return PackageRecord(
+        f"/repo/debs/{name}_{version}_{arch}.deb",
+        (("Package", name), ("Version", version), ("Architecture", arch)),
+        (("sha256", bytes(32)),),
+        100,
+    )
+
+
+def _index(*keys):
+    index = PackageIndex()
+    for key in keys:
+        index.add(_record(*key))
+    return index
+
+
+def test_record_fields():
+    record = _record("com.ex.a", "1.0")
+
+    assert record.key == ("com.ex.a", "1.0", "iphoneos-arm")
+    assert record["package"] == "com.ex.a"
+    assert record.get("Depends") is None
+    assert "Version" in record
+    assert record.hexdigests == {"sha256": "00" * 32}
+    assert record.message["Package"] == "com.ex.a"
+
+
+def test_record_immutable():
+    record = _record("com.ex.a", "1.0")
+
+    with pytest.raises(AttributeError):
+        record.size = 0
+
+    assert pickle.loads(pickle.dumps(record)) == record
+
+
+def test_index_order():
+    index = _index(
+        ("com.ex.b", "1.0"),
+        ("com.ex.a", "1.0~beta"),
+        ("com.ex.a", "1.10"),
+        ("com.ex.a", "1.9", "iphoneos-arm64"),
+        ("com.ex.a", "1.9", "iphoneos-arm"),
+    )
+
+    assert index.names() == ["com.ex.a", "com.ex.b"]
+    assert index.versions("com.ex.a") == ["1.10", "1.9", "1.0~beta"]
+    assert [r.key for r in index] == [
+        ("com.ex.a", "1.10", "iphoneos-arm"),
+        ("com.ex.a", "1.9", "iphoneos-arm"),
+        ("com.ex.a", "1.9", "iphoneos-arm64"),
+        ("com.ex.a", "1.0~beta", "iphoneos-arm"),
+        ("com.ex.b", "1.0", "iphoneos-arm"),
+    ]
+
+
+def test_index_equal_versions_spelled_differently():
+    # '1.0' and '0:1.0' compare equal, but are different versions in the index.
+    index = _index(
+        ("com.ex.a", "1.0", "iphoneos-arm"),
+        ("com.ex.a", "0:1.0", "iphoneos-arm"),
+        ("com.ex.a", "1.0", "iphoneos-arm64"),
+        ("com.ex.a", "0:1.0", "iphoneos-arm64"),
+        ("com.ex.a", "0.9", "iphoneos-arm"),
+    )
+
+    versions = index.versions("com.ex.a")
+    assert sorted(versions[:2]) == ["0:1.0", "1.0"]
+    assert versions[2:] == ["0.9"]
+
+    # records of the same version string are next to each other.
+    keys = [r.key[1] for r in index]
+    assert keys == sorted(keys[:4], key=versions.index) + ["0.9"]
+
+    for version in versions:
+        assert {r.version for r in index.records("com.ex.a", version)} == {version}
+
+
+def test_index_replace_and_remove():
+    index = _index(("com.ex.a", "1.0"), ("com.ex.a", "2.0"), ("com.ex.b", "1.0"))
+
+    old = index.add(_record("com.ex.a", "1.0"))
+    assert old == _record("com.ex.a", "1.0")
+    assert len(index) == 3
+
+    removed = index.remove("com.ex.a", "2.0")
+    assert [r.key for r in removed] == [("com.ex.a", "2.0", "iphoneos-arm")]
+    assert index.versions("com.ex.a") == ["1.0"]
+
+    index.remove("com.ex.a")
+    assert "com.ex.a" not in index
+    assert index.names() == ["com.ex.b"]
+    assert index.get("com.ex.b", "1.0", "iphoneos-arm") is not None
@@ -0,0 +1,333 @@
+# coding: utf8
+
+import concurrent.futures
+import gzip
+import json
+import os
+import shutil
+import threading
+import time
+
+import pytest
+
+from mothman import depictions, history, meta, repo, tree
+
+# (depictions need a Depends field)
+FIRMWARE = "firmware (>= 12.0)"
+
+DEPICTIONS = [
+    "depictions/web/{package}/info.xml",
+    "depictions/native/{package}/depiction.json",
+]
+
+
+@pytest.fixture
+def repo_dir(repo_root, make_deb, monkeypatch):
+    monkeypatch.setenv("MOTHMAN_CACHE_DIR", str(repo_root.parent / "cache"))
+    (repo_root / repo.CONFIG_NAME).write_text(json.dumps(repo.TEMPLATES["repo.me"]))
+
+    for name, version in [("com.ex.a", "1.0"), ("com.ex.b", "2.0")]:
+        make_deb(
+            repo_root / "debians" / f"{name}_{version}.deb",
+            name,
+            version,
+            depends=FIRMWARE,
+            fields={"Name": name.upper(), "Section": "Tweaks"},
+        )
+
+    return repo_root
+
+
+def _repository(root, **kwargs):
+    return repo.Repository("example.com", root, scan_cache=False, **kwargs)
+
+
+def _depictions(root, package):
+    return [root / path.format(package=package) for path in DEPICTIONS]
+
+
+def test_compact_depictions(repo_dir):
+    _repository(repo_dir, compact=True).build()
+
+    gzipped = {}
+    for path in _depictions(repo_dir, "com.ex.a") + [repo_dir / repo.MANIFEST_PATH]:
+        gz_path = path.with_name(path.name + ".gz")
+        assert gzip.decompress(gz_path.read_bytes()) == path.read_bytes()
+        gzipped[gz_path] = gz_path.read_bytes()
+
+    # rendered again from scratch, the .gz files are byte-for-byte the same.
+    (repo_dir / repo.RENDERED_PATH).unlink()
+    for gz_path in gzipped:
+        gz_path.unlink()
+    _repository(repo_dir, compact=True).build()
+
+    assert {p: p.read_bytes() for p in gzipped} == gzipped
+
+    # a non-compact build drops the stale .gz copies.
+    (repo_dir / repo.RENDERED_PATH).unlink()
+    _repository(repo_dir, compact=False).build()
+
+    for path in _depictions(repo_dir, "com.ex.a"):
+        assert path.is_file()
+        assert not path.with_name(path.name + ".gz").exists()
+
+
+def test_manifest_after_incremental_build(repo_dir, make_deb):
+    repository = _repository(repo_dir, compact=True)
+    repository.build()
+
+    manifest = json.loads((repo_dir / repo.MANIFEST_PATH).read_text())
+    assert manifest == {
+        "com.ex.a": {
+            "name": "COM.EX.A",
+            "version": "1.0",
+            "section": "Tweaks",
+            "author": None,
+            "description": "The com.ex.a package",
+            "depictions": {
+                "Depiction": "example.com/depictions/web/?p=com.ex.a",
+                "SileoDepiction": "example.com/depictions/native/com.ex.a/depiction.json",
+            },
+        },
+        "com.ex.b": {
+            **manifest["com.ex.b"],
+            "name": "COM.EX.B",
+            "version": "2.0",
+        },
+    }
+
+    # a new version of a, and b removed.
+    repository.add_deb(
+        make_deb(
+            repo_dir / "debians" / "com.ex.a_1.1.deb",
+            "com.ex.a",
+            "1.1",
+            depends=FIRMWARE,
+            fields={"Name": "A"},
+        )
+    )
+    repository.remove_package("com.ex.b")
+    repository.build()
+
+    updated = json.loads((repo_dir / repo.MANIFEST_PATH).read_text())
+    assert list(updated) == ["com.ex.a"]
+    assert updated["com.ex.a"] == {
+        **manifest["com.ex.a"],
+        "name": "A",
+        "version": "1.1",
+        "section": None,
+    }
+    assert gzip.decompress((repo_dir / (repo.MANIFEST_PATH + ".gz")).read_bytes()) == (
+        repo_dir / repo.MANIFEST_PATH
+    ).read_bytes()
+
+
+def _sileo(root, package):
+    # the text of the table rows (by title) and the header image of a Sileo depiction.
+    depiction = json.loads(_depictions(root, package)[1].read_text())
+    rows = {v["title"]: v.get("text") for v in depiction["tabs"][0]["views"] if "title" in v}
+    return rows, depiction["headerImage"]
+
+
+def _price_and_header(root, package):
+    rows, header = _sileo(root, package)
+    return rows["Price"], header
+
+
+def _write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data))
+
+
+def test_meta_store(tmp_path):
+    store = meta.MetaStore(tmp_path)
+    assert store.get("com.ex.a") == {}
+
+    _write_json(tmp_path / meta.MAP_NAME, {"com.ex.a": {"price": "$1", "icon": "a.png"}})
+    _write_json(tmp_path / "com.ex.a.json", {"price": "$2"})
+
+    # the keys in <package>.json take precedence.
+    assert store.get("com.ex.a") == {"price": "$2", "icon": "a.png"}
+    assert store.get("com.ex.b") == {}
+
+    (tmp_path / "com.ex.b.json").write_text("[]")
+    with pytest.raises(meta.MetaError, match="JSON object"):
+        store.get("com.ex.b")
+
+    (tmp_path / "com.ex.b.json").write_text("{not json")
+    with pytest.raises(meta.MetaError, match="invalid"):
+        store.get("com.ex.b")
+
+
+def test_meta_change_rerenders(repo_dir):
+    meta_dir = repo_dir / repo.META_PATH
+    _write_json(meta_dir / meta.MAP_NAME, {"com.ex.a": {"price": "$1", "header_image": "h.png"}})
+    _write_json(meta_dir / "com.ex.a.json", {"price": "$2"})
+
+    repository = _repository(repo_dir)
+    repository.build()
+
+    assert _price_and_header(repo_dir, "com.ex.a") == ("$2", "h.png")
+    assert _price_and_header(repo_dir, "com.ex.b") == ("Free", "headerImage")
+    unchanged = _depictions(repo_dir, "com.ex.b")[1].stat().st_mtime_ns
+
+    # nothing changed, so nothing is rendered.
+    repository.build()
+    assert repository.metrics.get("mothman_depictions_rendered") == 0
+
+    path = meta_dir / "com.ex.a.json"
+    stat = path.stat()
+    _write_json(path, {"price": "$30"})
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    repository.build()
+
+    assert repository.metrics.get("mothman_depictions_rendered") == 1
+    assert _price_and_header(repo_dir, "com.ex.a") == ("$30", "h.png")
+    assert _depictions(repo_dir, "com.ex.b")[1].stat().st_mtime_ns == unchanged
+
+    # removing the file falls back to packages.json.
+    path.unlink()
+    repository.build()
+
+    assert _price_and_header(repo_dir, "com.ex.a") == ("$1", "h.png")
+
+
+def _files(root, *names):
+    # relative path -> content, of the files (and every file in the folders).
+    paths = [root / name for name in names if (root / name).is_file()]
+    for name in names:
+        paths.extend(p for p in (root / name).rglob("*") if p.is_file())
+
+    return {str(path.relative_to(root)): path.read_bytes() for path in sorted(paths)}
+
+
+@pytest.fixture
+def many_packages(repo_dir, make_deb):
+    for i in range(8):
+        make_deb(
+            repo_dir / "debians" / f"com.ex.p{i}_1.0.deb",
+            f"com.ex.p{i}",
+            "1.0",
+            depends=FIRMWARE,
+            fields={"Name": f"P{i}"},
+        )
+
+    return repo_dir
+
+
+def test_parallel_matches_serial(many_packages, tmp_path):
+    outputs = []
+
+    for workers in (1, 4):
+        # (copied with the mtimes, so the release dates are the same)
+        root = shutil.copytree(many_packages, tmp_path / f"j{workers}", symlinks=True)
+        _repository(root, workers=workers).build(compress_using=[tree.CAT, tree.GZIP])
+        outputs.append(_files(root, "Packages", "Packages.gz", "depictions"))
+
+    assert len(outputs[0]) == 2 + 2 * 10
+    assert outputs[0] == outputs[1]
+
+
+def _render_hook(monkeypatch, hook):
+    # call hook(package) before each Sileo depiction is rendered.
+    build = depictions.Sileo.build
+
+    def hooked(self):
+        hook(self.control["Package"])
+        return build(self)
+
+    monkeypatch.setattr(depictions.Sileo, "build", hooked)
+
+
+def _temp_files(root):
+    return [p for p in root.rglob("*") if p.name.endswith(".tmp")]
+
+
+def test_failed_render(many_packages, monkeypatch):
+    def hook(package):
+        if package == "com.ex.p3":
+            raise RuntimeError("render failed")
+
+    _render_hook(monkeypatch, hook)
+    with pytest.raises(RuntimeError, match="render failed"):
+        _repository(many_packages, workers=4).build()
+
+    assert not _temp_files(many_packages)
+    assert not any(p.exists() for p in _depictions(many_packages, "com.ex.p3")[1:])
+    assert not (many_packages / repo.RENDERED_PATH).exists()
+
+    # nothing was recorded as rendered, so the next build renders everything.
+    monkeypatch.undo()
+    repository = _repository(many_packages, workers=4)
+    repository.build()
+
+    assert repository.metrics.get("mothman_depictions_rendered") == 10
+    assert _depictions(many_packages, "com.ex.p3")[1].is_file()
+
+
+def _slow_render(package):
+    time.sleep(0.05)
+    if package == "com.ex.a":
+        raise RuntimeError("render failed")
+
+
+@pytest.mark.parametrize("cancel", [True, False])
+def test_stopped_build_waits_for_renders(many_packages, monkeypatch, cancel):
+    _render_hook(monkeypatch, (lambda package: time.sleep(0.05)) if cancel else _slow_render)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        repository = _repository(many_packages, executor=executor)
+        if cancel:
+            repository._cancelled = threading.Event()
+            repository._cancelled.set()
+
+        with pytest.raises(concurrent.futures.CancelledError if cancel else RuntimeError):
+            repository.build()
+
+        # (the executor is shared, so it would still be rendering if the build didn't wait)
+        written = _files(many_packages, "depictions")
+
+    assert _files(many_packages, "depictions") == written
+    assert not _temp_files(many_packages)
+    for content in written.values():
+        # every depiction is complete.
+        assert content.endswith((b"}", b">"))
+
+
+def _released(root, package):
+    return _sileo(root, package)[0]["Released"]
+
+
+def test_release_date_is_kept(repo_dir, make_deb):
+    deb = repo_dir / "debians" / "com.ex.a_1.0.deb"
+    # 2020-09-13 (UTC)
+    os.utime(deb, (1600000000, 1600000000))
+    _repository(repo_dir).build()
+
+    assert _released(repo_dir, "com.ex.a") == "09-13-2020"
+
+    # the package file is touched, and everything is rendered again.
+    os.utime(deb, (1700000000, 1700000000))
+    (repo_dir / repo.RENDERED_PATH).unlink()
+    _repository(repo_dir).build()
+
+    assert _released(repo_dir, "com.ex.a") == "09-13-2020"
+
+    # a new version has its own date.
+    os.utime(
+        make_deb(repo_dir / "debians" / "com.ex.a_1.1.deb", "com.ex.a", "1.1", depends=FIRMWARE),
+        (1700000000, 1700000000),
+    )
+    _repository(repo_dir).build()
+
+    assert _released(repo_dir, "com.ex.a") == "11-14-2023"
+
+
+def test_released_override(repo_dir):
+    _write_json(repo_dir / repo.META_PATH / "com.ex.a.json", {"released": 0})
+    _repository(repo_dir).build()
+
+    assert _released(repo_dir, "com.ex.a") == "01-01-1970"
+    # (overridden dates aren't recorded)
+    recorded = json.loads((repo_dir / history.HISTORY_PATH).read_text())
+    assert list(recorded) == ["com.ex.b"]
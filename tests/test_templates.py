@@ -0,0 +1,142 @@
+# coding: utf8
+
+import io
+import zipfile
+
+import pytest
+import requests
+
+from mothman import repo, templates
+
+
+def _zip(path, members):
+    with zipfile.ZipFile(path, "w") as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+    return path
+
+
+def test_extract_excludes(tmp_path):
+    zip_path = _zip(
+        tmp_path / "template.zip",
+        {
+            "repo.me-master/index.html": "index",
+            "repo.me-master/Packages": "",
+            "repo.me-master/assets/repo/repo.conf": "conf",
+            "repo.me-master/assets/repo/Banners/a.png": "banner",
+            "repo.me-master/depictions/web/me.syns.samplepackage/info.xml": "sample",
+            "repo.me-master/depictions/web/me.syns.other/info.xml": "other",
+        },
+    )
+    dest = tmp_path / "repo"
+
+    templates.extract(zip_path, dest, repo.TEMPLATES["repo.me"]["exclude"])
+
+    assert sorted(str(p.relative_to(dest)) for p in dest.rglob("*") if p.is_file()) == [
+        "assets/repo/repo.conf",
+        "depictions/web/me.syns.other/info.xml",
+        "index.html",
+    ]
+    # (excluded folders aren't made either)
+    assert not (dest / "depictions" / "web" / "me.syns.samplepackage").exists()
+
+
+@pytest.mark.parametrize(
+    "name", ["repo-master/../evil", "repo-master/a/../../evil", "repo-master//evil"]
+)
+def test_extract_traversal(tmp_path, name):
+    zip_path = _zip(tmp_path / "template.zip", {name: "evil"})
+    dest = tmp_path / "a" / "repo"
+
+    with pytest.raises(templates.TemplateError, match="refusing"):
+        templates.extract(zip_path, dest)
+
+    assert not list(tmp_path.rglob("evil"))
+
+
+class _Response:
+    def __init__(self, status_code, content=b"", headers=None):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} error")
+
+    def iter_content(self, size):
+        stream = io.BytesIO(self.content)
+        return iter(lambda: stream.read(size), b"")
+
+
+@pytest.fixture
+def github(monkeypatch, tmp_path):
+    # responses are popped in order, and the request headers are recorded.
+    monkeypatch.setenv("MOTHMAN_CACHE_DIR", str(tmp_path / "cache"))
+    server = {"responses": [], "headers": []}
+
+    def get(url, headers=None, **kwargs):
+        assert url == "https://github.com/syns/repo.me/archive/master.zip"
+        server["headers"].append(headers)
+        response = server["responses"].pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    monkeypatch.setattr(templates.requests, "get", get)
+    return server
+
+
+def test_fetch_etag(github):
+    template = repo.TEMPLATES["repo.me"]
+    github["responses"] = [
+        _Response(200, b"zip v1", {"ETag": '"v1"'}),
+        _Response(304),
+        _Response(200, b"zip v2"),
+    ]
+
+    zip_path = templates.fetch("repo.me", template)
+    assert zip_path.read_bytes() == b"zip v1"
+
+    # not modified, so the cached archive is used.
+    assert templates.fetch("repo.me", template) == zip_path
+    assert zip_path.read_bytes() == b"zip v1"
+
+    # (without an ETag, the old one is dropped)
+    templates.fetch("repo.me", template)
+    assert zip_path.read_bytes() == b"zip v2"
+    assert not zip_path.with_suffix(".etag").exists()
+
+    assert github["headers"] == [{}, {"If-None-Match": '"v1"'}, {"If-None-Match": '"v1"'}]
+    assert [p.name for p in zip_path.parent.iterdir()] == ["repo.me.zip"]
+
+
+def test_fetch_offline(github):
+    template = repo.TEMPLATES["repo.me"]
+
+    assert templates.fetch("repo.me", template, offline=True) is None
+
+    github["responses"] = [requests.ConnectionError("no network")]
+    with pytest.raises(templates.TemplateError, match="no network"):
+        templates.fetch("repo.me", template)
+
+    github["responses"] = [
+        _Response(200, b"zip v1"),
+        requests.ConnectionError("no network"),
+        _Response(500),
+    ]
+    zip_path = templates.fetch("repo.me", template)
+
+    # the cached archive is used if the download fails.
+    assert templates.fetch("repo.me", template) == zip_path
+    assert templates.fetch("repo.me", template) == zip_path
+    assert zip_path.read_bytes() == b"zip v1"
+
+    assert templates.fetch("repo.me", template, offline=True) == zip_path
+    assert github["responses"] == []
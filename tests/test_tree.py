@@ -0,0 +1,180 @@
+# coding: utf8
+
+import asyncio
+
+import pytest
+
+from mothman import tree, verify
+
+
+@pytest.fixture
+def debian_tree(built_repo):
+    debian_tree = tree.DebianTree(built_repo, scan_cache=False)
+    debian_tree.add_debs(debian_tree.root / "debs")
+    return debian_tree
+
+
+def _keys(debian_tree):
+    return [r.key[:2] for r in debian_tree._tree]
+
+
+def test_build(debian_tree):
+    packages = debian_tree.build()
+
+    assert packages.count("Package: ") == 3
+    assert "Filename: debs/com.ex.a_1.1.deb" in packages
+    assert (debian_tree.root / "Packages.gz").is_file()
+    assert "Packages.gz" in (debian_tree.root / "Release").read_text()
+
+
+def test_remove_and_replace(debian_tree, make_deb):
+    debian_tree.build()
+
+    removed = debian_tree.remove_package("com.ex.a", "1.0", delete=True)
+    assert [r.version for r in removed] == ["1.0"]
+    assert not (debian_tree.root / "debs" / "com.ex.a_1.0.deb").exists()
+
+    rebuilt = make_deb(debian_tree.root / "debs" / "b-rebuilt.deb", "com.ex.b", "2.0")
+    replaced = debian_tree.replace_deb(rebuilt, delete=True)
+    assert [r.version for r in replaced] == ["2.0"]
+    assert not (debian_tree.root / "debs" / "com.ex.b_2.0.deb").exists()
+
+    packages = debian_tree.build()
+    assert "com.ex.a_1.0" not in packages
+    assert "Filename: debs/b-rebuilt.deb" in packages
+
+
+def test_batch_rollback(debian_tree, make_deb):
+    before = _keys(debian_tree)
+    new = make_deb(debian_tree.root / "debs" / "com.ex.c_1.0.deb", "com.ex.c", "1.0")
+
+    with pytest.raises(RuntimeError):
+        with debian_tree.batch():
+            debian_tree.remove_package("com.ex.a", delete=True)
+            debian_tree.replace_deb(new)
+            # nested batches are part of the outer one.
+            with debian_tree.batch():
+                debian_tree.remove_package("com.ex.b", "2.0", delete=True)
+            raise RuntimeError("oops")
+
+    assert _keys(debian_tree) == before
+    # files are only deleted once the batch succeeds.
+    assert len(list((debian_tree.root / "debs").glob("com.ex.[ab]_*.deb"))) == 3
+
+    packages = debian_tree.build()
+    assert "com.ex.c" not in packages
+    assert packages.count("Package: ") == 3
+
+
+def test_batch_commit(debian_tree):
+    with debian_tree.batch():
+        debian_tree.remove_package("com.ex.a", delete=True)
+        assert (debian_tree.root / "debs" / "com.ex.a_1.0.deb").exists()
+
+    assert _keys(debian_tree) == [("com.ex.b", "2.0")]
+    assert not list((debian_tree.root / "debs").glob("com.ex.a_*.deb"))
+
+
+def test_keep_versions(built_repo, make_deb):
+    make_deb(built_repo / "debs" / "com.ex.a_0:1.1.deb", "com.ex.a", "0:1.1")
+
+    debian_tree = tree.DebianTree(built_repo, scan_cache=False, keep_versions=2)
+    debian_tree.add_debs(debian_tree.root / "debs")
+    packages = debian_tree.build()
+
+    # '0:1.1' and '1.1' are different versions (that compare equal), each built once.
+    assert packages.count("Package: com.ex.a") == 2
+    assert "Version: 1.0" not in packages
+
+
+def _cancel_at(debian_tree, monkeypatch, at):
+    # cancel the build (as build_async() does) when a stage reports its first progress.
+    report = debian_tree._report
+
+    def cancelling_report(stage, *args):
+        if stage == at:
+            debian_tree._cancelled.set()
+        report(stage, *args)
+
+    monkeypatch.setattr(debian_tree, "_report", cancelling_report)
+
+
+def test_build_async_cancelled(debian_tree, monkeypatch):
+    debian_tree.build()
+    release = (debian_tree.root / "Release").read_text()
+    debian_tree.remove_package("com.ex.b")
+
+    _cancel_at(debian_tree, monkeypatch, "stanzas")
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(debian_tree.build_async())
+
+    # nothing was replaced.
+    assert (debian_tree.root / "Release").read_text() == release
+    assert "com.ex.b" in (debian_tree.root / "Packages").read_text()
+    assert debian_tree._cancelled is None
+
+
+def test_build_async_not_cancelled_while_writing(debian_tree, monkeypatch):
+    debian_tree.build()
+    debian_tree.remove_package("com.ex.b")
+
+    # once the Packages files are being replaced, the build finishes.
+    _cancel_at(debian_tree, monkeypatch, "compress")
+    asyncio.run(debian_tree.build_async())
+
+    assert "com.ex.b" not in (debian_tree.root / "Packages").read_text()
+    assert (debian_tree.root / "Release").read_text().count("SHA256:") == 1
+    assert verify.verify(debian_tree.root, workers=1)["ok"]
+
+
+def test_build_async_reentry(debian_tree):
+    async def main():
+        return await asyncio.gather(
+            debian_tree.build_async(), debian_tree.build_async(), return_exceptions=True
+        )
+
+    packages, error = asyncio.run(main())
+
+    assert packages.count("Package: ") == 3
+    assert isinstance(error, RuntimeError)
+    assert debian_tree._cancelled is None
+
+
+FORMATS = [tree.CAT, tree.GZIP, tree.BZIP2, tree.XZ]
+
+
+def _outputs(root):
+    names = ["Release", *(f"Packages{fmt}" for fmt in FORMATS)]
+    return {name: (root / name).read_bytes() for name in names}
+
+
+@pytest.mark.parametrize("max_memory", [0, 1 << 20])
+def test_streamed_build_is_identical(built_repo, make_deb, max_memory):
+    def build(stream, debian_tree=None):
+        if debian_tree is None:
+            debian_tree = tree.DebianTree(built_repo, scan_cache=False)
+            debian_tree.add_debs(built_repo / "debs")
+
+        packages = debian_tree.build(
+            compress_using=FORMATS, max_memory=max_memory if stream else None
+        )
+        return debian_tree, packages, _outputs(built_repo)
+
+    _, packages, expected = build(False)
+    debian_tree, streamed, outputs = build(True)
+
+    assert streamed is None
+    assert outputs == expected
+    assert outputs["Packages"].decode() == packages
+
+    # again, with the stanzas of the unchanged packages (if they were cached).
+    debian_tree.replace_deb(
+        make_deb(built_repo / "debs" / "com.ex.b_2.0.deb", "com.ex.b", "2.0", fields={"Name": "B"})
+    )
+    _, _, outputs = build(True, debian_tree)
+    _, packages, expected = build(False)
+
+    # (with no memory, nothing is cached)
+    assert debian_tree.metrics.get("mothman_stanzas_rebuilt") == (1 if max_memory else 2)
+    assert "Name: B" in packages
+    assert outputs == expected
@@ -0,0 +1,91 @@
+# coding: utf8
+
+import bz2
+import gzip
+import hashlib
+import io
+import lzma
+
+import pytest
+
+from mothman import tree, utils, verify
+
+
+def test_hashing_writer():
+    out = io.BytesIO()
+    sink = utils.HashingWriter(out, ["md5", "sha256"])
+
+    sink.write(b"hello ")
+    sink.write(memoryview(b"world"))
+
+    assert out.getvalue() == b"hello world"
+    assert sink.fileinfo() == {
+        "md5": hashlib.md5(b"hello world").hexdigest(),
+        "sha256": hashlib.sha256(b"hello world").hexdigest(),
+        "filesize": 11,
+    }
+
+
+@pytest.mark.parametrize(
+    "fmt, decompress",
+    [
+        (utils.CAT, bytes),
+        (utils.GZIP, gzip.decompress),
+        (utils.BZIP2, bz2.decompress),
+        (utils.XZ, lzma.decompress),
+    ],
+)
+def test_open_hashed(tmp_path, fmt, decompress):
+    path = tmp_path / f"Packages{fmt}"
+
+    with utils.open_hashed(path, fmt, ["sha256"]) as (f, sink):
+        f.write("Package: a\n")
+
+    data = path.read_bytes()
+    assert decompress(data) == b"Package: a\n"
+    assert sink.fileinfo() == {"sha256": hashlib.sha256(data).hexdigest(), "filesize": len(data)}
+
+
+def test_open_atomic_failure(tmp_path):
+    path = tmp_path / "Release"
+    path.write_text("old")
+
+    with pytest.raises(RuntimeError):
+        with utils.open_atomic(path) as f:
+            f.write("half")
+            raise RuntimeError("failed")
+
+    assert path.read_text() == "old"
+    assert list(tmp_path.iterdir()) == [path]
+
+
+def _build(root, **kwargs):
+    debian_tree = tree.DebianTree(root, scan_cache=False, **kwargs)
+    debian_tree.add_debs(root / "debs")
+    debian_tree.build(compress_using=[tree.CAT, tree.GZIP, tree.XZ])
+
+
+def test_release_matches_files(built_repo):
+    _build(built_repo, digests=("md5", "sha1", "sha256", "sha512"))
+
+    entries, malformed = verify.release_entries(
+        verify.email.message_from_string((built_repo / "Release").read_text())
+    )
+
+    assert not malformed
+    assert sorted(entries) == ["Packages", "Packages.gz", "Packages.xz"]
+    for filename, (size, digests) in entries.items():
+        data = (built_repo / filename).read_bytes()
+        assert size == len(data)
+        assert digests == {name: hashlib.new(name, data).hexdigest() for name in digests}
+        assert sorted(digests) == ["md5", "sha1", "sha256", "sha512"]
+
+
+def test_gzip_is_reproducible(built_repo, monkeypatch):
+    first = (built_repo / "Packages.gz").read_bytes()
+
+    # (gzip would otherwise put the current time in the header)
+    monkeypatch.setattr(gzip.time, "time", lambda: 2000000000.0)
+    _build(built_repo)
+
+    assert (built_repo / "Packages.gz").read_bytes() == first
@@ -0,0 +1,104 @@
+# coding: utf8
+
+import email
+
+import pytest
+
+from mothman import verify
+
+
+def _append_release(root, text):
+    release = root / "Release"
+    release.write_text(release.read_text().rstrip("\n") + "\n" + text + "\n")
+
+
+def test_verify_ok(built_repo):
+    report = verify.verify(built_repo, workers=1)
+
+    assert report == {
+        "ok": True,
+        "indexes": {"Packages": None, "Packages.gz": None},
+        "packages": 3,
+        "failed": {},
+    }
+
+
+def test_verify_tampered_files(built_repo):
+    deb = built_repo / "debs" / "com.ex.a_1.0.deb"
+    data = bytearray(deb.read_bytes())
+    data[-1] ^= 0xFF
+    deb.write_bytes(bytes(data))
+    (built_repo / "debs" / "com.ex.b_2.0.deb").unlink()
+    with (built_repo / "Packages.gz").open("ab") as f:
+        f.write(b"junk")
+
+    report = verify.verify(built_repo, workers=1)
+
+    assert not report["ok"]
+    assert report["indexes"]["Packages"] is None
+    assert report["indexes"]["Packages.gz"].startswith("size mismatch")
+    assert report["failed"] == {
+        "debs/com.ex.a_1.0.deb": "md5, sha1, sha256 mismatch",
+        "debs/com.ex.b_2.0.deb": "missing",
+    }
+
+
+def test_release_outside_of_repo(built_repo, tmp_path):
+    (tmp_path / "outside").write_text("secret")
+    _append_release(built_repo, f"SHA512:\n {'0' * 128} 6 ../outside")
+
+    report = verify.verify(built_repo, workers=1)
+
+    assert report["indexes"]["../outside"] == "outside of the repo"
+    assert not report["ok"]
+
+
+def test_release_malformed_lines():
+    release = email.message_from_string(
+        "SHA256:\n"
+        f" {'a' * 64} 10 Packages\n"
+        f" {'b' * 64} ten Packages.gz\n"
+        f" {'c' * 64} Packages.xz\n"
+    )
+
+    entries, malformed = verify.release_entries(release)
+
+    assert entries == {"Packages": (10, {"sha256": "a" * 64})}
+    assert set(malformed) == {"Packages.gz", f"{'c' * 64} Packages.xz"}
+
+
+def test_verify_reports_malformed_lines(built_repo):
+    _append_release(built_repo, f"SHA512:\n {'0' * 128} -1 Packages")
+
+    report = verify.verify(built_repo, workers=1)
+
+    assert "invalid size" in report["indexes"]["Packages"]
+    assert not report["ok"]
+
+
+def test_verify_no_release(tmp_path):
+    with pytest.raises(verify.VerifyError):
+        verify.verify(tmp_path)
+
+
+def test_verify_malformed_stanza_size(built_repo):
+    # (so the plaintext Packages file is the one that is read)
+    (built_repo / "Packages.gz").unlink()
+    packages = built_repo / "Packages"
+    packages.write_text(packages.read_text().replace("Size: ", "Size: x", 1))
+
+    report = verify.verify(built_repo, workers=1)
+
+    assert report["packages"] == 3
+    ((filename, reason),) = report["failed"].items()
+    assert filename == "debs/com.ex.a_1.1.deb"
+    assert reason.startswith("malformed stanza (invalid size 'x")
+
+
+def test_resolve():
+    root = verify.pathlib.Path("/repo")
+
+    assert verify._resolve(root, "debs/..a.deb") == root / "debs" / "..a.deb"
+    assert verify._resolve(root, "..a.deb") == root / "..a.deb"
+    assert verify._resolve(root, "debs/../../a.deb") is None
+    assert verify._resolve(root, "/a.deb") is None